@@ -3,15 +3,29 @@
 # =============================================================================
 import os
 import re
+import json
+import base64
+import hashlib
+import hmac
+import time
+import queue
+import random
+import bisect
+import heapq
+import threading
+from collections import deque
 import uuid
 import mimetypes
+import unicodedata
 from datetime import datetime, date, time as dtime, timedelta
 from typing import Optional, Callable
 from functools import wraps
+from difflib import SequenceMatcher
 # ↑ al inicio de app.py (zona imports), agrega:
 from sqlalchemy.exc import OperationalError, ProgrammingError, IntegrityError
 from flask import (
-    Flask, request, jsonify, send_file, render_template, redirect, url_for, make_response, g
+    Flask, request, jsonify, send_file, render_template, redirect, url_for, make_response, g,
+    Response, has_request_context
 )
 from flask_cors import CORS
 
@@ -25,16 +39,25 @@ from passlib.hash import bcrypt
 from db import (
     engine, SessionLocal,
     Sexo, Partido, Usuario,
-    Actor, Persona, Invitacion, Notificacion, Region, RegionMunicipio
+    Actor, Persona, Invitacion, Notificacion, Region, RegionMunicipio,
+    ColeccionVersion, NotificacionArchivo, Blob, archive_notificaciones, fold_text
 )
 from uuid import uuid4
-from sqlalchemy.orm import joinedload
-from sqlalchemy import or_
+from sqlalchemy.orm import defer, joinedload
+from sqlalchemy.orm.attributes import flag_modified
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy import text
+from sqlalchemy import (
+    or_, tuple_, event, insert, update, delete, select, func, literal_column, union_all,
+    inspect as sa_inspect, table as sa_table, column as sa_column
+)
 from pathlib import Path
 from werkzeug.utils import secure_filename
-from flask import send_from_directory, abort, redirect
-from io import BytesIO
-import pandas as pd
+from flask import abort, redirect
+import tempfile
+from urllib.parse import quote
+from openpyxl import Workbook
 from flask import send_file
 from datetime import timedelta, datetime as _dt  # asegúrate de tener esto importado
 
@@ -55,6 +78,49 @@ app = Flask(
 CORS(app, supports_credentials=True)
 app.config["MAX_CONTENT_LENGTH"] = 50 * 1024 * 1024  # 50MB
 
+# =============================================================================
+# JSON (orjson opcional)
+# =============================================================================
+# Con orjson instalado jsonify serializa en C directo a bytes. Misma salida que el
+# proveedor de Flask: llaves ordenadas y fechas/Decimal/UUID por su `default` (las fechas
+# quedan como HTTP date). Diferencia: los acentos van en UTF-8, no como \uXXXX. Lo que
+# orjson rechaza (enteros enormes, llaves no-str) y la salida indentada (debug) pasan
+# por el proveedor estándar. JSON_ORJSON=0 lo apaga.
+try:
+    import orjson
+except ImportError:
+    orjson = None
+from flask.json.provider import DefaultJSONProvider
+
+class OrjsonProvider(DefaultJSONProvider):
+    def _orjson(self, obj) -> bytes:
+        opts = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_PASSTHROUGH_DATACLASS
+        if self.sort_keys:
+            opts |= orjson.OPT_SORT_KEYS
+        return orjson.dumps(obj, default=self.default, option=opts)
+
+    def dumps(self, obj, **kwargs) -> str:
+        if not kwargs:
+            try:
+                return self._orjson(obj).decode("utf-8")
+            except TypeError:   # orjson.JSONEncodeError es subclase de TypeError
+                pass
+        return super().dumps(obj, **kwargs)
+
+    def response(self, *args, **kwargs):
+        if (self.compact is None and self._app.debug) or self.compact is False:
+            return super().response(*args, **kwargs)
+        obj = self._prepare_response_obj(args, kwargs)
+        try:
+            body = self._orjson(obj) + b"\n"
+        except TypeError:
+            body = f"{super().dumps(obj, separators=(',', ':'))}\n"
+        return self._app.response_class(body, mimetype=self.mimetype)
+
+if orjson is not None and os.getenv("JSON_ORJSON", "1") == "1":
+    app.json_provider_class = OrjsonProvider
+    app.json = OrjsonProvider(app)
+
 # =============================================================================
 # Helpers: JWT & Auth
 # =============================================================================
@@ -71,6 +137,57 @@ def verify_token(token: str) -> Optional[dict]:
     except jwt.InvalidTokenError:
         return None
 
+# ----- Caché de usuarios (por proceso) -----
+# Evita abrir una sesión extra por request sólo para validar al usuario. Cada worker
+# tiene su propio caché: un cambio de rol o una baja hecha desde otro proceso (o
+# directo en la BD) se nota, a más tardar, AUTH_CACHE_TTL segundos después.
+AUTH_CACHE_TTL = int(os.getenv("AUTH_CACHE_TTL", "60"))   # segundos
+
+_auth_cache = {}   # uid -> (expira_monotonic, Usuario | None)
+_auth_stats = {"hits": 0, "misses": 0, "invalidations": 0}
+_auth_lock = threading.Lock()
+
+def invalidate_user_cache(uid) -> None:
+    """
+    Saca al usuario del caché de este proceso. Los listeners de abajo lo llaman cuando este
+    proceso modifica un Usuario; los demás workers se enteran al vencer su AUTH_CACHE_TTL.
+    """
+    if uid is None:
+        return
+    uid = int(uid)
+    with _auth_lock:
+        _auth_cache.pop(uid, None)
+        _auth_stats["invalidations"] += 1
+
+@event.listens_for(Usuario, "after_update")
+@event.listens_for(Usuario, "after_delete")
+def _usuario_changed(mapper, connection, target):
+    invalidate_user_cache(target.id)
+
+def auth_cache_stats() -> dict:
+    with _auth_lock:
+        return {**_auth_stats, "size": len(_auth_cache), "ttl": AUTH_CACHE_TTL}
+
+def _load_user_cached(uid: int) -> Optional[Usuario]:
+    now = time.monotonic()
+    with _auth_lock:
+        hit = _auth_cache.get(uid)
+        if hit and hit[0] > now:
+            _auth_stats["hits"] += 1
+            return hit[1]
+        _auth_stats["misses"] += 1
+
+    db = SessionLocal()
+    try:
+        u = db.get(Usuario, uid)
+        u = u if (u and u.activo) else None
+    finally:
+        db.close()
+
+    with _auth_lock:
+        _auth_cache[uid] = (now + AUTH_CACHE_TTL, u)
+    return u
+
 def get_user_from_token() -> Optional[Usuario]:
     token = request.cookies.get(COOKIE_NAME)
     if not token:
@@ -81,14 +198,7 @@ def get_user_from_token() -> Optional[Usuario]:
     uid = data.get("uid")
     if not uid:
         return None
-    db = SessionLocal()
-    try:
-        u = db.get(Usuario, int(uid))
-        if u and u.activo:
-            return u
-        return None
-    finally:
-        db.close()
+    return _load_user_cached(int(uid))
 
 # Helper pequeño: convierte input roles a set o None
 def _normalize_roles(roles):
@@ -153,6 +263,175 @@ def auth_required(roles=None):
         return wrapper
     return decorator
 
+# =============================================================================
+# Presupuesto de consultas por endpoint (modo dev/CI)
+# =============================================================================
+# QUERY_CHECK=warn|raise cuenta las sentencias de cada petición, agrupa las de la
+# misma forma (mismo SQL con listas IN colapsadas) y compara contra el presupuesto
+# que el endpoint declara con @query_budget. "raise" convierte la violación en 500
+# (para check_queries.py); "warn" sólo la imprime. Vacío = apagado, sin costo.
+QUERY_CHECK         = os.getenv("QUERY_CHECK", "").strip().lower()
+QUERY_REPEAT_MAX    = int(os.getenv("QUERY_REPEAT_MAX", "3"))   # misma forma más veces = N+1
+_QUERY_IN_LIST      = re.compile(r"\(\s*(?:\?|%\(\w+\)s(?:::\w+)?)(?:\s*,\s*(?:\?|%\(\w+\)s(?:::\w+)?))*\s*\)")
+
+def query_budget(max_queries: int, repeat: Optional[int] = None):
+    """
+    Declara cuántas sentencias puede emitir el endpoint (incluye la del usuario si la
+    sesión no viene en caché) y cuántas veces puede repetirse una misma forma.
+    Va debajo de @auth_required (el wrapper copia el atributo con @wraps).
+    """
+    def decorator(fn):
+        fn.query_budget = {"max": max_queries, "repeat": repeat}
+        return fn
+    return decorator
+
+def sql_shape(statement: str) -> str:
+    return _QUERY_IN_LIST.sub("(?)", " ".join(statement.split()))
+
+def _query_log_statement(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context() and "_query_log" in g:
+        g._query_log.append(sql_shape(statement))
+
+if QUERY_CHECK:
+    event.listen(engine, "before_cursor_execute", _query_log_statement)
+
+def query_report(endpoint: str, shapes: list) -> dict:
+    """Conteo, presupuesto y formas repetidas de una petición (None si todo en orden)."""
+    view = app.view_functions.get(endpoint)
+    budget = getattr(view, "query_budget", None) or {}
+    repeat_max = budget.get("repeat") or QUERY_REPEAT_MAX
+    veces = {}
+    for s in shapes:
+        veces[s] = veces.get(s, 0) + 1
+    repetidas = [{"sql": s[:300], "veces": n} for s, n in veces.items() if n > repeat_max]
+    excedido = budget.get("max") is not None and len(shapes) > budget["max"]
+    return {
+        "endpoint": endpoint, "queries": len(shapes), "budget": budget.get("max"),
+        "repetidas": sorted(repetidas, key=lambda r: -r["veces"]),
+        "violacion": bool(excedido or repetidas),
+    }
+
+@app.before_request
+def _query_check_start():
+    if QUERY_CHECK:
+        g._query_log = []
+
+@app.after_request
+def _query_check_end(resp):
+    shapes = g.pop("_query_log", None)
+    if shapes is None or request.endpoint is None:
+        return resp
+    rep = query_report(request.endpoint, shapes)
+    resp.headers["X-Query-Count"] = str(rep["queries"])
+    if rep["budget"] is not None:
+        resp.headers["X-Query-Budget"] = str(rep["budget"])
+    if not rep["violacion"]:
+        return resp
+    print(f"⚠️ Presupuesto de consultas: {request.method} {request.path} -> "
+          f"{rep['queries']}/{rep['budget']} sentencias, repetidas: {[r['veces'] for r in rep['repetidas']]}")
+    if QUERY_CHECK != "raise":
+        return resp
+    out = jsonify({"ok": False, "error": "Presupuesto de consultas excedido", "detalle": rep})
+    out.status_code = 500
+    out.headers["X-Query-Count"] = str(rep["queries"])
+    return out
+
+# =============================================================================
+# Planes de carga (las relaciones de db.py son lazy="raise")
+# =============================================================================
+# Cada consulta ORM que toca relaciones declara aquí lo que su serializador lee; lo
+# demás se queda en la BD (sobre todo `busqueda`, que duplica el texto de la fila).
+
+# Snapshots de notificación (notif_values / notif_snapshot): actor y persona completos
+INV_RESPONSABLES = (joinedload(Invitacion.actor), joinedload(Invitacion.persona))
+
+# inv_to_dict (detalles de choque, /updates): la invitación sin `busqueda` + nombres
+INV_DICT_LOAD = (
+    defer(Invitacion.busqueda),
+    joinedload(Invitacion.actor).load_only(Actor.nombre),
+    joinedload(Invitacion.persona).load_only(Persona.nombre),
+)
+
+# =============================================================================
+# Modelos de lectura (Core)
+# =============================================================================
+# Los listados sólo copian columnas a dicts: en lugar de hidratar objetos ORM (identity
+# map + estado por atributo) cada modelo declara pares (llave JSON, columna), selecciona
+# justo esas columnas y arma los dicts con zip sobre la tupla de la fila (leer atributos
+# de Row cuesta ~1 µs por campo). Los `or ""` del serializador van como coalesce en SQL.
+# read_rows() ejecuta por la conexión: los filtros con atributos ORM (Invitacion.fecha)
+# vuelven "ORM-enabled" al select y Session.execute lo pasaría por la capa de carga.
+_INV, _ACT, _PER, _REG = Invitacion.__table__, Actor.__table__, Persona.__table__, Region.__table__
+
+def _vacio(col):
+    return func.coalesce(col, "").label(col.key)
+
+class ReadModel:
+    def __init__(self, campos, select_from=None):
+        self.keys = tuple(k for k, _ in campos)
+        self._cols = [c for _, c in campos]
+        self._from = select_from
+
+    def select(self):
+        stmt = select(*self._cols)
+        return stmt.select_from(self._from) if self._from is not None else stmt
+
+    def dicts(self, rows, **fmt) -> list:
+        """Filas -> dicts; `fmt` = {llave: fn} se aplica a los valores no nulos."""
+        out = [dict(zip(self.keys, r)) for r in rows]
+        for k, fn in fmt.items():
+            for d in out:
+                if d[k] is not None:
+                    d[k] = fn(d[k])
+        return out
+
+def read_rows(db, stmt) -> list:
+    return db.connection().execute(stmt).all()
+
+# /api/invitations: la fila + nombre/cargo de actor y persona (LEFT JOIN)
+INV_LISTA = ReadModel([
+    ("ID", _INV.c.id), ("Fecha", _INV.c.fecha), ("Hora", _INV.c.hora),
+    ("Evento", _INV.c.evento), ("ConvocaCargo", _INV.c.convoca_cargo), ("Convoca", _INV.c.convoca),
+    ("Partido", _INV.c.partido_politico), ("Municipio", _INV.c.municipio), ("Lugar", _INV.c.lugar),
+    ("Estatus", _INV.c.estatus), ("Observaciones", _INV.c.observaciones),
+    ("ActorID", _ACT.c.id.label("actor_id")), ("ActorNombre", _ACT.c.nombre.label("actor_nombre")),
+    ("ActorCargo", _ACT.c.cargo.label("actor_cargo")),
+    ("PersonaID", _PER.c.id.label("persona_id")), ("PersonaNombre", _PER.c.nombre.label("persona_nombre")),
+    ("PersonaCargo", _PER.c.cargo.label("persona_cargo")),
+    ("ArchivoNombre", _INV.c.archivo_nombre), ("ArchivoMime", _INV.c.archivo_mime),
+    ("ArchivoTamano", _INV.c.archivo_tamano), ("ArchivoURL", _INV.c.archivo_url),
+    ("ArchivoSHA256", _INV.c.archivo_sha256),
+    ("GrupoToken", _vacio(_INV.c.grupo_token)), ("SubTipo", _vacio(_INV.c.sub_tipo)),
+], _INV.outerjoin(_ACT, _ACT.c.id == _INV.c.actor_id).outerjoin(_PER, _PER.c.id == _INV.c.persona_id))
+
+# /api/invitaciones/by_persona (fecha dos veces: ISO y dd/mm/aa)
+INV_POR_PERSONA = ReadModel([
+    ("ID", _INV.c.id), ("FechaISO", _INV.c.fecha), ("Fecha", _INV.c.fecha.label("fecha_tabla")),
+    ("Hora", _INV.c.hora), ("Evento", _vacio(_INV.c.evento)), ("Municipio", _vacio(_INV.c.municipio)),
+    ("Lugar", _vacio(_INV.c.lugar)), ("Convoca", _vacio(_INV.c.convoca)),
+    ("ConvocaCargo", _vacio(_INV.c.convoca_cargo)), ("Rol", _vacio(_INV.c.rol)),
+    ("Estatus", _vacio(_INV.c.estatus)), ("Partido", _vacio(_INV.c.partido_politico)),
+])
+
+# /api/personas: la persona + nombre de su región
+PERSONAS = ReadModel([
+    ("ID", _PER.c.id), ("Nombre", _vacio(_PER.c.nombre)), ("Cargo", _vacio(_PER.c.cargo)),
+    ("Teléfono", _vacio(_PER.c.telefono)), ("Correo", _vacio(_PER.c.correo)),
+    ("Unidad/Región", _vacio(_PER.c.unidad_region)), ("SexoID", _PER.c.sexo_id),
+    ("ParticularNombre", _vacio(_PER.c.particular_nombre)),
+    ("ParticularCargo", _vacio(_PER.c.particular_cargo)),
+    ("ParticularTel", _vacio(_PER.c.particular_tel)), ("Activo", _PER.c.activo),
+    ("RegionID", _PER.c.region_id), ("RegionNombre", _REG.c.nombre.label("region_nombre")),
+], _PER.outerjoin(_REG, _REG.c.id == _PER.c.region_id))
+
+# /api/actores
+ACTORES = ReadModel([
+    ("ID", _ACT.c.id), ("Nombre", _vacio(_ACT.c.nombre)), ("Cargo", _vacio(_ACT.c.cargo)),
+    ("Teléfono", _vacio(_ACT.c.telefono)), ("SexoID", _ACT.c.sexo_id),
+    ("ParticularNombre", _ACT.c.particular_nombre), ("ParticularCargo", _ACT.c.particular_cargo),
+    ("ParticularTel", _ACT.c.particular_tel),
+])
+
 MUNICIPIOS_EDOMEX = [
     "Acambay de Ruíz Castañeda", "Acolman", "Aculco", "Almoloya de Alquisiras",
     "Almoloya de Juárez", "Almoloya del Río", "Amanalco", "Amatepec",
@@ -184,7 +463,146 @@ MUNICIPIOS_EDOMEX = [
     "Tonanitla", "Valle de Chalco Solidaridad"
     # ... (resto de municipios) ...
 ]
-VALID_MUNICIPIOS_LOWER = {m.casefold(): m for m in MUNICIPIOS_EDOMEX}
+
+# =============================================================================
+# Resolución de municipios (índice normalizado compartido)
+# =============================================================================
+def normalize_muni(s) -> str:
+    """Normaliza: strip, colapsa espacios, quita diacríticos, casefold."""
+    return fold_text(s)
+
+def _trigrams(key: str) -> set:
+    k = f"  {key} "
+    return {k[i:i + 3] for i in range(len(k) - 2)}
+
+MUNI_RESOLVER_TTL   = int(os.getenv("MUNI_RESOLVER_TTL", "300"))   # seg. antes de recargar region_municipios
+MUNI_FUZZY_MIN      = float(os.getenv("MUNI_FUZZY_MIN", "0.8"))    # similitud mínima (difflib ratio)
+
+class MunicipioResolver:
+    """
+    Índice único para municipios:
+      - clave normalizada -> nombre canónico (MUNICIPIOS_EDOMEX), O(1)
+      - clave normalizada -> region_ids (tabla region_municipios), O(1)
+      - índice de trigramas que preselecciona candidatos para casi-coincidencias
+        (typos, "Mpio. de Toluca", etc.), calificados con difflib
+    La parte de regiones se carga perezosamente y se marca sucia cuando cambia RegionMunicipio
+    (listeners abajo) o al vencer MUNI_RESOLVER_TTL (cambios hechos por otro worker).
+    """
+
+    def __init__(self, canonicos):
+        self._canon = {normalize_muni(m): m for m in canonicos}
+        self._regions = {}
+        self._grams = {}
+        self._fuzzy_memo = {}
+        self._loaded_at = None
+        self._lock = threading.Lock()
+        self._rebuild_fuzzy()
+
+    # ----- construcción -----
+    def _rebuild_fuzzy(self):
+        grams = {}
+        for key in set(self._canon) | set(self._regions):
+            for gr in _trigrams(key):
+                grams.setdefault(gr, set()).add(key)
+        self._grams = grams
+        self._fuzzy_memo = {}
+
+    def load_regions(self, pairs):
+        """pairs: iterable de (region_id, municipio) tal como están en region_municipios."""
+        regions = {}
+        for region_id, municipio in pairs:
+            key = normalize_muni(municipio)
+            if key and region_id is not None:
+                ids = regions.setdefault(key, [])
+                if int(region_id) not in ids:
+                    ids.append(int(region_id))
+        with self._lock:
+            self._regions = regions
+            self._loaded_at = time.monotonic()
+            self._rebuild_fuzzy()
+
+    def invalidate(self):
+        with self._lock:
+            self._loaded_at = None
+
+    def ensure_loaded(self, db=None):
+        loaded_at = self._loaded_at
+        if loaded_at is not None and time.monotonic() - loaded_at < MUNI_RESOLVER_TTL:
+            return
+        own = db is None
+        db = db or SessionLocal()
+        try:
+            pairs = db.query(RegionMunicipio.region_id, RegionMunicipio.municipio).all()
+        except (OperationalError, ProgrammingError):
+            db.rollback()
+            pairs = []
+        finally:
+            if own:
+                db.close()
+        self.load_regions(pairs)
+
+    # ----- consultas -----
+    def _fuzzy_key(self, key: str) -> Optional[str]:
+        if key in self._fuzzy_memo:
+            return self._fuzzy_memo[key]
+        best, best_score = None, 0.0
+        qg = _trigrams(key)
+        candidatos = set()
+        for gr in qg:
+            candidatos |= self._grams.get(gr, set())
+        for cand in candidatos:
+            score = SequenceMatcher(None, key, cand).ratio()
+            # "municipio de toluca" contiene "toluca" (palabra completa): cuenta como match
+            if f" {cand} " in f" {key} " or f" {key} " in f" {cand} ":
+                score = max(score, 0.9 + len(cand) / 1000.0)
+            if score > best_score:
+                best, best_score = cand, score
+        hit = best if best_score >= MUNI_FUZZY_MIN else None
+        if len(self._fuzzy_memo) < 10000:
+            self._fuzzy_memo[key] = hit
+        return hit
+
+    def canonical(self, raw) -> Optional[str]:
+        """Nombre canónico para cualquier grafía exacta (acentos/mayúsculas/espacios no importan)."""
+        return self._canon.get(normalize_muni(raw))
+
+    def suggest(self, raw) -> Optional[str]:
+        """Canónico más parecido (para sugerir en mensajes de error)."""
+        key = self._fuzzy_key(normalize_muni(raw)) if raw else None
+        return self._canon.get(key) if key else None
+
+    def region_ids(self, raw, fuzzy: bool = True) -> list:
+        key = normalize_muni(raw)
+        if not key:
+            return []
+        ids = self._regions.get(key)
+        if ids is None and fuzzy:
+            fk = self._fuzzy_key(key)
+            ids = self._regions.get(fk) if fk else None
+        return list(ids or [])
+
+municipio_resolver = MunicipioResolver(MUNICIPIOS_EDOMEX)
+
+# Se invalida al hacer commit (no en el flush): antes, una recarga concurrente leería
+# las filas previas y un rollback invalidaría para nada.
+@event.listens_for(SessionLocal, "after_flush")
+def _collect_region_municipio(session, flush_context):
+    if any(isinstance(o, RegionMunicipio) for o in (*session.new, *session.dirty, *session.deleted)):
+        session.info["municipios_cambiados"] = True
+
+@event.listens_for(SessionLocal, "after_commit")
+def _region_municipio_changed(session):
+    if session.info.pop("municipios_cambiados", False):
+        municipio_resolver.invalidate()
+
+@event.listens_for(SessionLocal, "after_rollback")
+def _discard_region_municipio(session):
+    session.info.pop("municipios_cambiados", None)
+
+def _muni_error(muni_in: str) -> str:
+    sug = municipio_resolver.suggest(muni_in)
+    return f"Municipio inválido: '{muni_in}'" + (f" (¿quisiste decir '{sug}'?)" if sug else "")
+
 # ===== Perillas de tiempo (ajústalas a tu operación) =====
 DEFAULT_DURATION_MIN = 30   # duración lógica de cada evento (si no tienes hora_fin)
 BUFFER_MIN           = 10    # colchón antes/después (traslados)
@@ -236,6 +654,102 @@ def _traslapan_con_gap(a_ini, a_fin, b_ini, b_fin,
     min_sep = sep1 if sep1 < sep2 else sep2
 
     return min_sep < gap
+
+# ===== Agenda por responsable (persona o actor) y día =====
+AGENDA_ESTATUS = ("Confirmado", "Sustituido")
+# Con duración fija, dos eventos sólo pueden chocar si sus inicios distan menos que esto
+_AGENDA_WINDOW = timedelta(minutes=DEFAULT_DURATION_MIN + max(2 * BUFFER_MIN, MIN_GAP_MIN))
+
+class DayAgenda:
+    """
+    Eventos de un responsable en un día, ordenados por inicio.
+    conflicts() localiza con bisect los vecinos dentro de _AGENDA_WINDOW y confirma
+    cada uno con _traslapan_con_gap (misma regla de siempre, sin comparar contra todo el día).
+    """
+
+    def __init__(self):
+        self._starts = []
+        self._items = []    # (ini, fin, inv_id), paralelo a _starts
+
+    def add(self, inv_id, ini, fin):
+        i = bisect.bisect_right(self._starts, ini)
+        self._starts.insert(i, ini)
+        self._items.insert(i, (ini, fin, inv_id))
+
+    def conflicts(self, ini, fin, exclude_id=None) -> list:
+        lo = bisect.bisect_left(self._starts, ini - _AGENDA_WINDOW)
+        hi = bisect.bisect_right(self._starts, ini + _AGENDA_WINDOW)
+        return [
+            inv_id for (m_ini, m_fin, inv_id) in self._items[lo:hi]
+            if inv_id != exclude_id and _traslapan_con_gap(ini, fin, m_ini, m_fin)
+        ]
+
+    def discard(self, inv_id):
+        for i, (_, _, m_id) in enumerate(self._items):
+            if m_id == inv_id:
+                del self._starts[i]
+                del self._items[i]
+                return
+
+    def __len__(self):
+        return len(self._items)
+
+def _agenda_filter(q, persona_id=None, actor_id=None):
+    q = q.filter(Invitacion.estatus.in_(AGENDA_ESTATUS))
+    if persona_id is not None:
+        return q.filter(Invitacion.persona_id == persona_id)
+    # actor como responsable: asignado directo (sin persona); si hay persona, el actor sólo convoca
+    return q.filter(Invitacion.actor_id == actor_id, Invitacion.persona_id.is_(None))
+
+def load_day_agenda(db, fecha, persona_id=None, actor_id=None) -> DayAgenda:
+    """
+    Agenda del día desde BD: un range scan sobre idx_invitaciones_persona_agenda /
+    idx_invitaciones_actor_agenda, trayendo sólo (id, fecha, hora).
+    """
+    q = db.query(Invitacion.id, Invitacion.fecha, Invitacion.hora).filter(Invitacion.fecha == fecha)
+    agenda = DayAgenda()
+    for inv_id, f, h in _agenda_filter(q, persona_id, actor_id):
+        ini = _as_dt(f, h)
+        if ini:
+            agenda.add(inv_id, ini, ini + timedelta(minutes=DEFAULT_DURATION_MIN))
+    return agenda
+
+def load_agendas(db, fechas, persona_ids=(), actor_ids=()) -> dict:
+    """
+    Agendas de varios responsables y días con una consulta por tipo de responsable
+    (asignación masiva). Llave: ("persona" | "actor", id, fecha).
+    """
+    agendas = {}
+    fechas = list(set(fechas))
+    for tipo, ids, col in (("persona", set(persona_ids), Invitacion.persona_id),
+                           ("actor",   set(actor_ids),   Invitacion.actor_id)):
+        if not ids or not fechas:
+            continue
+        q = (db.query(Invitacion.id, Invitacion.fecha, Invitacion.hora, col)
+               .filter(Invitacion.fecha.in_(fechas), col.in_(ids),
+                       Invitacion.estatus.in_(AGENDA_ESTATUS)))
+        if tipo == "actor":
+            q = q.filter(Invitacion.persona_id.is_(None))
+        for inv_id, f, h, resp_id in q:
+            ini = _as_dt(f, h)
+            if ini:
+                agendas.setdefault((tipo, resp_id, f), DayAgenda()).add(
+                    inv_id, ini, ini + timedelta(minutes=DEFAULT_DURATION_MIN))
+    return agendas
+
+def agenda_conflicts(db, inv, persona_id=None, actor_id=None, agenda: Optional[DayAgenda] = None) -> list:
+    """Invitaciones (ORM) que chocan con `inv` en la agenda del responsable indicado."""
+    inv_ini, inv_fin = _rango(inv)
+    if agenda is None:
+        agenda = load_day_agenda(db, inv.fecha, persona_id=persona_id, actor_id=actor_id)
+    ids = agenda.conflicts(inv_ini, inv_fin, exclude_id=inv.id)
+    if not ids:
+        return []
+    return (db.query(Invitacion)
+              .options(*INV_DICT_LOAD)
+              .filter(Invitacion.id.in_(ids))
+              .order_by(Invitacion.hora.asc())
+              .all())
 # =============================================================================
 # Parseo/formatos
 # =============================================================================
@@ -313,9 +827,96 @@ app.config["MAX_CONTENT_LENGTH"] = 20 * 1024 * 1024  # 20 MB
 def _allowed_file(filename: str) -> bool:
     return "." in filename and filename.rsplit(".", 1)[1].lower() in ALLOWED_EXTS
 
-def save_invitation_file(file_storage, inv_id: str):
+# ===== Almacén por contenido (blobs/) =====
+# Cada archivo se guarda una sola vez en UPLOAD_ROOT/blobs/ab/cd/<sha256>; la tabla blobs lleva
+# cuántas invitaciones lo usan. El archivo temporal se mueve a su lugar al hacer commit y un
+# blob que llega a refcount 0 se borra también tras el commit (hooks de SessionLocal abajo).
+UPLOAD_CAS        = os.getenv("UPLOAD_CAS", "1") == "1"
+UPLOAD_BLOB_PATH  = UPLOAD_ROOT / "blobs"
+UPLOAD_CHUNK      = 256 * 1024
+
+def blob_relpath(digest: str) -> str:
+    return f"blobs/{digest[:2]}/{digest[2:4]}/{digest}"
+
+def write_hashed(stream):
+    """Copia el stream a un temporal dentro de blobs/tmp calculando sha256 al vuelo."""
+    tmp_dir = UPLOAD_BLOB_PATH / "tmp"
+    tmp_dir.mkdir(parents=True, exist_ok=True)
+    h, n = hashlib.sha256(), 0
+    fd, tmp = tempfile.mkstemp(dir=tmp_dir)
+    try:
+        with os.fdopen(fd, "wb") as out:
+            for chunk in iter(lambda: stream.read(UPLOAD_CHUNK), b""):
+                h.update(chunk)
+                out.write(chunk)
+                n += len(chunk)
+    except Exception:
+        os.unlink(tmp)
+        raise
+    return h.hexdigest(), n, Path(tmp)
+
+def _blob_pending(session) -> dict:
+    return session.info.setdefault("blob_pending", {"mover": [], "borrar": [], "previews": []})
+
+def blob_ref(db, digest: str, tamano=None, mime=None):
+    """refcount + 1 (crea la fila si no existe) con un upsert atómico."""
+    B = Blob.__table__
+    if engine.dialect.name in ("postgresql", "sqlite"):
+        ins = (pg_insert if engine.dialect.name == "postgresql" else sqlite_insert)(B)
+        db.execute(
+            ins.values(digest=digest, tamano=tamano, mime=mime, refcount=1, creado=datetime.utcnow())
+               .on_conflict_do_update(index_elements=[B.c.digest], set_={"refcount": B.c.refcount + 1})
+        )
+        return
+    b = db.get(Blob, digest)
+    if b is None:
+        db.add(Blob(digest=digest, tamano=tamano, mime=mime, refcount=1))
+    else:
+        b.refcount = (b.refcount or 0) + 1
+
+def blob_unref(db, digest: str):
+    """refcount - 1; al llegar a 0 borra la fila y agenda el borrado del archivo tras el commit."""
+    B = Blob.__table__
+    db.execute(update(B).where(B.c.digest == digest).values(refcount=B.c.refcount - 1))
+    if db.execute(delete(B).where(B.c.digest == digest, B.c.refcount <= 0)).rowcount:
+        _blob_pending(db)["borrar"].append(digest)
+
+@event.listens_for(SessionLocal, "after_commit")
+def _blob_after_commit(session):
+    pend = session.info.pop("blob_pending", None)
+    if not pend:
+        return
+    for tmp, final in pend["mover"]:
+        final.parent.mkdir(parents=True, exist_ok=True)
+        os.replace(tmp, final)     # mismo contenido si ya existía: reemplazo atómico
+    for digest, mime in pend["previews"]:
+        enqueue_preview(digest, mime)
+    for digest in pend["borrar"]:
+        # si otra subida lo volvió a referenciar entre tanto, se conserva
+        with engine.connect() as conn:
+            if conn.execute(select(Blob.digest).where(Blob.digest == digest)).first():
+                continue
+        blob = UPLOAD_ROOT / blob_relpath(digest)
+        for path in (blob, *blob.parent.glob(f"{digest}.preview-*")):
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                pass
+
+@event.listens_for(SessionLocal, "after_rollback")
+def _blob_after_rollback(session):
+    pend = session.info.pop("blob_pending", None)
+    for tmp, _ in (pend or {}).get("mover", []):
+        try:
+            tmp.unlink()
+        except FileNotFoundError:
+            pass
+
+def save_invitation_file(file_storage, inv_id: str, db=None):
     """
-    Guarda el archivo en: UPLOAD_ROOT/invitaciones/<inv_id>/<secure_filename>
+    Guarda el archivo subido. Con UPLOAD_CAS (y `db`): en blobs/<sha256>, una sola copia por
+    contenido y refcount en la misma transacción que la invitación. Si no:
+    UPLOAD_ROOT/invitaciones/<inv_id>/<secure_filename>.
     Devuelve metadatos y la ruta relativa (para guardar en archivo_url).
     """
     if not file_storage or not getattr(file_storage, "filename", ""):
@@ -323,6 +924,20 @@ def save_invitation_file(file_storage, inv_id: str):
     if not _allowed_file(file_storage.filename):
         raise ValueError("Extensión no permitida")
 
+    if UPLOAD_CAS and db is not None:
+        digest, tamano, tmp = write_hashed(file_storage.stream)
+        blob_ref(db, digest, tamano, file_storage.mimetype)
+        relpath = blob_relpath(digest)
+        _blob_pending(db)["mover"].append((tmp, UPLOAD_ROOT / relpath))
+        _blob_pending(db)["previews"].append((digest, file_storage.mimetype))
+        return {
+            "nombre": file_storage.filename,
+            "mime": file_storage.mimetype,
+            "tamano": tamano,
+            "relpath": relpath,
+            "sha256": digest,
+        }
+
     fname = secure_filename(file_storage.filename)
     target_dir = UPLOAD_INV_PATH / inv_id
     target_dir.mkdir(parents=True, exist_ok=True)
@@ -336,6 +951,7 @@ def save_invitation_file(file_storage, inv_id: str):
         "mime": file_storage.mimetype,
         "tamano": target_path.stat().st_size,
         "relpath": relpath,
+        "sha256": None,
     }
 def _is_http_url(s: str) -> bool:
     """
@@ -345,35 +961,107 @@ def _is_http_url(s: str) -> bool:
     return s.startswith("http://") or s.startswith("https://")
 
 
-def delete_file_if_local(url_or_path: str):
+def delete_file_if_local(url_or_path: str, db=None, digest: Optional[str] = None):
     """
-    Elimina un archivo físico si la URL/ruta apunta a tu carpeta local de uploads.
+    Suelta el archivo de una invitación. Blobs (digest o ruta blobs/...): refcount - 1 en la
+    transacción de `db`; el archivo sólo se borra cuando nadie más lo usa.
+    Archivos propios (invitaciones/<id>/...): se borran de UPLOAD_ROOT.
     Evita borrar rutas externas (http/https) o vacías.
     """
     if not url_or_path or _is_http_url(url_or_path):
         return
 
+    rel = url_or_path.strip().lstrip("/")
+    if digest is None and rel.startswith("blobs/"):
+        digest = rel.rsplit("/", 1)[-1]
+    if digest:
+        if db is not None:
+            blob_unref(db, digest)
+        return
+
     # Normaliza y busca la ruta física dentro de tu carpeta de uploads
-    full_path = os.path.join(os.getcwd(), url_or_path.strip("/"))
-    if os.path.exists(full_path):
+    full_path = (UPLOAD_ROOT / rel).resolve()
+    if UPLOAD_ROOT not in full_path.parents:
+        return
+    if full_path.exists():
         try:
-            os.remove(full_path)
+            full_path.unlink()
             print(f"🗑️ Archivo eliminado: {full_path}")
         except Exception as e:
             print(f"⚠️ No se pudo eliminar el archivo {full_path}: {e}")
             
+# ===== Descarga de adjuntos: Range, validadores, caché y offload al proxy =====
+ATTACH_MAX_AGE      = int(os.getenv("ATTACH_MAX_AGE", str(30 * 24 * 3600)))  # caché privada del navegador
+# "" = Flask envía los bytes; "x-accel" = nginx (X-Accel-Redirect); "x-sendfile" = Apache/lighttpd
+ATTACH_OFFLOAD      = os.getenv("ATTACH_OFFLOAD", "").strip().lower()
+ATTACH_ACCEL_PREFIX = "/" + os.getenv("ATTACH_ACCEL_PREFIX", "/_uploads/").strip("/") + "/"   # location internal → UPLOAD_ROOT
+
+def _inline_disposition(name: str) -> str:
+    simple = unicodedata.normalize("NFKD", name).encode("ascii", "ignore").decode().replace('"', "") or "archivo"
+    return f"inline; filename=\"{simple}\"; filename*=UTF-8''{quote(name)}"
+
+def send_attachment(root: Path, relpath: str, mime: Optional[str] = None, download_name: Optional[str] = None,
+                    etag: Optional[str] = None, last_modified: Optional[datetime] = None,
+                    immutable: bool = False):
+    """
+    Sirve root/relpath con ETag fuerte + Last-Modified (304 con If-None-Match / If-Modified-Since)
+    y Range (206). Con ATTACH_OFFLOAD el worker sólo devuelve encabezados y el proxy manda los
+    bytes (y resuelve Range).
+    Cache-Control: immutable=True sólo si la URL identifica el contenido (ruta por sha256 o
+    ?v=<sha256> vigente): privado por ATTACH_MAX_AGE. Si no (URL por id, el adjunto puede
+    cambiar): private, no-cache, y el navegador revalida con el ETag (304).
+    """
+    root = Path(root).resolve()
+    full = (root / relpath.lstrip("/")).resolve()
+    if root not in full.parents or not full.is_file():
+        abort(404)
+    st = full.stat()
+    etag = etag or etag_for(st.st_mtime_ns, st.st_size)
+    last_modified = last_modified or datetime.utcfromtimestamp(st.st_mtime)
+    download_name = download_name or full.name
+    mime = mime or mimetypes.guess_type(download_name)[0] or "application/octet-stream"
+
+    offload = ATTACH_OFFLOAD in ("x-accel", "x-sendfile") and UPLOAD_ROOT in full.parents
+    if not offload:
+        resp = send_file(full, mimetype=mime, as_attachment=False, download_name=download_name,
+                         conditional=True, etag=etag, last_modified=last_modified,
+                         max_age=ATTACH_MAX_AGE if immutable else None)
+    else:
+        resp = Response(status=200, mimetype=mime)
+        resp.set_etag(etag)
+        resp.last_modified = last_modified
+        resp.headers["Content-Disposition"] = _inline_disposition(download_name)
+        # sin Range aquí: el proxy lo atiende sobre el archivo real
+        resp = resp.make_conditional(request, accept_ranges=False)
+        if resp.status_code == 200:
+            if ATTACH_OFFLOAD == "x-accel":
+                resp.headers["X-Accel-Redirect"] = ATTACH_ACCEL_PREFIX + quote(full.relative_to(UPLOAD_ROOT).as_posix())
+            else:
+                resp.headers["X-Sendfile"] = str(full)
+    resp.cache_control.public = False
+    resp.cache_control.private = True
+    if immutable:
+        resp.cache_control.max_age = ATTACH_MAX_AGE
+    else:
+        resp.cache_control.max_age = None
+        resp.cache_control.no_cache = True
+    return resp
+
+def _ruta_por_contenido(relpath: str) -> bool:
+    """blobs/... se nombra por sha256 (y sus derivados también): el contenido no cambia."""
+    return relpath.lstrip("/").startswith("blobs/")
+
 @app.route("/api/files/<path:filename>")
+@query_budget(0)
 def serve_uploaded_file(filename):
-    from flask import send_from_directory, abort
-    try:
-        return send_from_directory(UPLOAD_FOLDER, filename, as_attachment=False)
-    except FileNotFoundError:
-        abort(404)
+    return send_attachment(Path(UPLOAD_FOLDER), filename, immutable=_ruta_por_contenido(filename))
 # =============================================================================
 # Bitácora / utilidades dominio
 # =============================================================================
-def add_notif(db, inv: Invitacion, campo: str, old_val: str, new_val: str, comentario: str = ""):
-    n = Notificacion(
+def notif_values(inv: Invitacion, campo: str, old_val: str, new_val: str, comentario: str = "") -> dict:
+    """Columnas de la notificación de add_notif (sirve también para un insert multi-fila)."""
+    return dict(
+        ts=datetime.utcnow(),
         invitacion_id=str(inv.id),
         evento=inv.evento or "",
         convoca=inv.convoca or "",
@@ -394,13 +1082,13 @@ def add_notif(db, inv: Invitacion, campo: str, old_val: str, new_val: str, comen
         actor_nombre=(inv.actor.nombre if inv.actor else None),
         actor_cargo=(inv.actor.cargo if inv.actor else None),
         actor_tel=(inv.actor.telefono if inv.actor else None),
-        actor_sexo=(inv.actor.sexo.nombre if (inv.actor and inv.actor.sexo) else None),
+        actor_sexo=(catalog_cache.sexo_nombre(inv.actor.sexo_id) if inv.actor else None),
         actor_particular_nombre=(inv.actor.particular_nombre if inv.actor else None),
         actor_particular_cargo=(inv.actor.particular_cargo if inv.actor else None),
         actor_particular_tel=(inv.actor.particular_tel if inv.actor else None),
 
         persona_tel=(inv.persona.telefono if inv.persona else None),
-        persona_sexo=(inv.persona.sexo.nombre if (inv.persona and inv.persona.sexo) else None),
+        persona_sexo=(catalog_cache.sexo_nombre(inv.persona.sexo_id) if inv.persona else None),
         persona_particular_nombre=(inv.persona.particular_nombre if inv.persona else None),
         persona_particular_cargo=(inv.persona.particular_cargo if inv.persona else None),
         persona_particular_tel=(inv.persona.particular_tel if inv.persona else None),
@@ -408,7 +1096,9 @@ def add_notif(db, inv: Invitacion, campo: str, old_val: str, new_val: str, comen
         enviado=False,
         enviado_ts=None,
     )
-    db.add(n)
+
+def add_notif(db, inv: Invitacion, campo: str, old_val: str, new_val: str, comentario: str = ""):
+    db.add(Notificacion(**notif_values(inv, campo, old_val, new_val, comentario)))
 
 def validar_partido(db, partido_nombre: str) -> str:
     if not partido_nombre:
@@ -460,6 +1150,7 @@ def inv_to_dict(inv: Invitacion) -> dict:
         "ArchivoMime": inv.archivo_mime or "",
         "ArchivoTamano": inv.archivo_tamano or 0,
         "ArchivoTS": fmt_dt(inv.archivo_ts),
+        "ArchivoSHA256": inv.archivo_sha256 or "",
 
         "DiasParaEvento": dias,
     }
@@ -468,6 +1159,7 @@ def inv_to_dict(inv: Invitacion) -> dict:
 # Rutas de páginas (Jinja)
 # =============================================================================
 @app.get("/")
+@query_budget(1)
 def home():
     u = get_user_from_token()
     if not u:
@@ -475,6 +1167,7 @@ def home():
     return render_template("index.html")
 
 @app.get("/login")
+@query_budget(1)
 def login_page():
     u = get_user_from_token()
     if u:
@@ -485,6 +1178,7 @@ def login_page():
 # AUTH (token en cookie HttpOnly)
 # =============================================================================
 @app.post("/api/auth/login")
+@query_budget(1)
 def api_login():
     data = request.get_json() or {}
     user = (data.get("usuario") or "").strip()
@@ -515,48 +1209,247 @@ def api_login():
         db.close()
 
 @app.post("/api/auth/logout")
+@query_budget(0)
 def api_logout():
     resp = make_response(jsonify({"ok": True}))
     resp.set_cookie(COOKIE_NAME, "", expires=0, path="/")
     return resp
 
 @app.get("/api/auth/me")
+@query_budget(1)
 def api_me():
     u = get_user_from_token()
     if not u:
         return jsonify({"ok": False, "auth": False}), 200
     return jsonify({"ok": True, "auth": True, "id": u.id, "usuario": u.usuario, "rol": u.rol})
 
+@app.get("/api/auth/cache")
+@auth_required(['admin'])
+@query_budget(1)
+def api_auth_cache_stats():
+    return jsonify({"ok": True, **auth_cache_stats()})
+
+# =============================================================================
+# Respuestas condicionales (ETag / If-None-Match)
+# =============================================================================
+def etag_for(*parts) -> str:
+    h = hashlib.sha1()
+    for part in parts:
+        h.update(part if isinstance(part, bytes) else str(part).encode("utf-8"))
+        h.update(b"\x1f")
+    return h.hexdigest()
+
+def with_etag(resp, etag: Optional[str]):
+    if etag:
+        resp.set_etag(etag)
+        resp.headers["Cache-Control"] = "private, no-cache"
+    return resp
+
+def not_modified(etag: Optional[str]):
+    """Respuesta 304 si el cliente ya tiene esta versión (If-None-Match); si no, None."""
+    if etag and request.if_none_match.contains(etag):
+        return with_etag(make_response("", 304), etag)
+    return None
+
+def conditional_json(body: bytes, etag: str):
+    """
+    Responde 304 si el cliente ya tiene esta versión (If-None-Match); si no, el JSON con su ETag.
+    """
+    resp = not_modified(etag)
+    if resp is None:
+        resp = make_response(body)
+        resp.mimetype = "application/json"
+    return with_etag(resp, etag)
+
+# ----- Versión de colecciones (contador en BD, válido entre workers) -----
+_COLECCION_DE = {
+    Invitacion: "invitaciones",
+    Persona: "personas",
+    Actor: "actores",
+    Region: "regiones",
+    RegionMunicipio: "regiones",
+}
+
+@event.listens_for(SessionLocal, "before_flush")
+def _bump_colecciones(session, flush_context, instances):
+    """Incrementa colecciones_version en la misma transacción que el cambio."""
+    nombres = set()
+    for obj in session.new:
+        nombres.add(_COLECCION_DE.get(type(obj)))
+    for obj in session.deleted:
+        nombres.add(_COLECCION_DE.get(type(obj)))
+    for obj in session.dirty:
+        if type(obj) in _COLECCION_DE and session.is_modified(obj):
+            nombres.add(_COLECCION_DE[type(obj)])
+    nombres.discard(None)
+    if nombres:
+        bump_colecciones(session, *nombres, desde_orm=True)
+
+def bump_colecciones(session, *nombres, desde_orm: bool = False):
+    """
+    Para escrituras fuera del ORM (bulk/Core): marca las colecciones como cambiadas.
+    Deja en session.info["colecciones_bump"] nombre -> (versión previa, versión nueva,
+    sólo_orm) de esta transacción; los índices en memoria lo usan al hacer commit.
+    """
+    rows = session.execute(
+        update(ColeccionVersion)
+        .where(ColeccionVersion.nombre.in_(sorted(nombres)))
+        .values(version=ColeccionVersion.version + 1)
+        .returning(ColeccionVersion.nombre, ColeccionVersion.version)
+    ).all()
+    bumps = session.info.setdefault("colecciones_bump", {})
+    for nombre, version in rows:
+        previa, _, solo_orm = bumps.get(nombre, (version - 1, None, True))
+        bumps[nombre] = (previa, version, solo_orm and desde_orm)
+
+@event.listens_for(SessionLocal, "after_rollback")
+def _olvidar_bumps(session):
+    session.info.pop("colecciones_bump", None)
+
+def collection_etag(db, *colecciones) -> Optional[str]:
+    """
+    ETag = ruta + filtros (sin _ts) + versión de cada colección que alimenta la respuesta.
+    Una lectura por PK; None si la tabla de versiones no existe aún (sin caché condicional).
+    """
+    try:
+        rows = (db.query(ColeccionVersion.nombre, ColeccionVersion.version)
+                  .filter(ColeccionVersion.nombre.in_(colecciones))
+                  .all())
+    except (OperationalError, ProgrammingError):
+        db.rollback()
+        return None
+    if len(rows) != len(colecciones):
+        return None
+    args = sorted((k, v) for k, v in request.args.items(multi=True) if k != "_ts")
+    return etag_for(request.path, args, sorted((n, v) for n, v in rows))
+
+# =============================================================================
+# Caché de catálogos (Sexo, Partido, Region, RegionMunicipio)
+# =============================================================================
+CATALOG_TTL = int(os.getenv("CATALOG_TTL", "300"))  # seg.; acota el desfase entre workers
+
+class CatalogCache:
+    """
+    Snapshot en memoria de los catálogos que casi no cambian. Cada endpoint sirve
+    bytes JSON ya serializados con un ETag derivado del contenido (igual en todos los
+    workers). `version` sube con cada commit de este proceso que escribe en estas tablas
+    (listeners abajo) y obliga a recargar en la siguiente lectura.
+    """
+
+    def __init__(self):
+        self.version = 0
+        self._snap = None
+        self._lock = threading.Lock()
+
+    def bump(self):
+        with self._lock:
+            self.version += 1
+            self._snap = None
+
+    def _load(self, version: int) -> dict:
+        db = SessionLocal()
+        try:
+            sexos = db.query(Sexo.id, Sexo.nombre).order_by(Sexo.nombre.asc()).all()
+            partidos = db.query(Partido.nombre).order_by(Partido.nombre.asc()).all()
+            regs = db.query(Region.id, Region.nombre, Region.slug, Region.color).all()
+            rms = (db.query(RegionMunicipio.id, RegionMunicipio.region_id, RegionMunicipio.municipio)
+                     .order_by(RegionMunicipio.region_id.asc(), RegionMunicipio.municipio.asc())
+                     .all())
+        finally:
+            db.close()
+
+        regiones = [{"id": r.id, "nombre": r.nombre, "slug": r.slug, "color": r.color} for r in regs]
+        rm_out = [{"id": r.id, "region_id": r.region_id, "municipio": r.municipio} for r in rms]
+        # municipio_normalizado -> region_id (cliente-friendly)
+        muni_map = {" ".join(str(r["municipio"]).split()).casefold(): r["region_id"] for r in rm_out}
+
+        payloads = {
+            "sexo": [{"id": x.id, "nombre": x.nombre} for x in sexos],
+            "partidos": [{"nombre": (x.nombre or "")} for x in partidos],
+            "regiones": sorted(regiones, key=lambda r: r["nombre"] or ""),
+            "region_municipios_all": {
+                "ok": True,
+                "regiones": sorted(regiones, key=lambda r: r["id"]),
+                "region_municipios": rm_out,
+                "muni_to_region": muni_map,
+            },
+        }
+        bodies = {}
+        for name, payload in payloads.items():
+            body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+            bodies[name] = (body, etag_for(name, body))
+        return {
+            "version": version,
+            "loaded_at": time.monotonic(),
+            "sexo_by_id": {x.id: x.nombre for x in sexos},
+            "bodies": bodies,
+        }
+
+    def snapshot(self) -> dict:
+        snap = self._snap
+        if snap is not None and time.monotonic() - snap["loaded_at"] < CATALOG_TTL:
+            return snap
+        version = self.version
+        snap = self._load(version)
+        with self._lock:
+            if self.version == version:   # nadie escribió mientras cargábamos
+                self._snap = snap
+        return snap
+
+    def response(self, name: str):
+        body, etag = self.snapshot()["bodies"][name]
+        return conditional_json(body, etag)
+
+    def sexo_nombre(self, sexo_id) -> Optional[str]:
+        if not sexo_id:
+            return None
+        try:
+            return self.snapshot()["sexo_by_id"].get(int(sexo_id))
+        except (TypeError, ValueError):
+            return None
+
+catalog_cache = CatalogCache()
+
+_CATALOGOS = (Sexo, Partido, Region, RegionMunicipio)
+
+# Como en el resolver de municipios: se anota en el flush y se aplica tras el commit,
+# para que un snapshot() concurrente no recargue las filas previas con la versión nueva.
+@event.listens_for(SessionLocal, "after_flush")
+def _collect_catalogos(session, flush_context):
+    if any(isinstance(o, _CATALOGOS) for o in (*session.new, *session.dirty, *session.deleted)):
+        session.info["catalogos_cambiados"] = True
+
+@event.listens_for(SessionLocal, "after_commit")
+def _bump_catalogos(session):
+    if session.info.pop("catalogos_cambiados", False):
+        catalog_cache.bump()
+
+@event.listens_for(SessionLocal, "after_rollback")
+def _discard_catalogos(session):
+    session.info.pop("catalogos_cambiados", None)
+
 # =============================================================================
 # Catálogos
 # =============================================================================
 @app.get("/api/partidos")
 @auth_required(['admin'])
+@query_budget(5)
 def api_partidos():
-    db = SessionLocal()
-    try:
-        q = db.query(Partido)
-        # En tu modelo Partido no existe 'activo' → no filtramos por ello
-        rows = q.order_by(Partido.nombre.asc()).all()
-        return jsonify([{"nombre": (r.nombre or "")} for r in rows])
-    finally:
-        db.close()
+    # En tu modelo Partido no existe 'activo' → no filtramos por ello
+    return catalog_cache.response("partidos")
 
 @app.get("/api/catalogo/sexo")
 @auth_required(['admin'])
+@query_budget(5)
 def api_catalogo_sexo():
-    db = SessionLocal()
-    try:
-        rows = db.query(Sexo).order_by(Sexo.nombre.asc()).all()
-        return jsonify([{"id": s.id, "nombre": s.nombre} for s in rows])
-    finally:
-        db.close()
+    return catalog_cache.response("sexo")
 
 # =============================================================================
 # Personas
 # =============================================================================
 @app.get("/api/invitaciones/by_persona")
 @auth_required(['admin','viewer'])
+@query_budget(2)
 def api_invitaciones_by_persona():
     """
     Parámetros (query):
@@ -584,7 +1477,7 @@ def api_invitaciones_by_persona():
 
     db = SessionLocal()
     try:
-        q = db.query(Invitacion).filter(Invitacion.persona_id == int(persona_id))
+        q = INV_POR_PERSONA.select().where(Invitacion.persona_id == int(persona_id))
 
         if desde:
             q = q.filter(Invitacion.fecha >= desde)
@@ -593,29 +1486,11 @@ def api_invitaciones_by_persona():
         if estatus:
             q = q.filter(Invitacion.estatus == estatus)
 
-        rows = q.order_by(Invitacion.fecha.asc(), Invitacion.hora.asc(), Invitacion.id.asc()).all()
-
-        out = []
-        for inv in rows:
-            # Formatos amigables
-            fecha_txt = inv.fecha.strftime("%Y-%m-%d") if inv.fecha else ""
-            fecha_tabla = inv.fecha.strftime("%d/%m/%y") if inv.fecha else ""
-            hora_txt = inv.hora.strftime("%H:%M") if inv.hora else ""
+        rows = read_rows(db, q.order_by(Invitacion.fecha.asc(), Invitacion.hora.asc(), Invitacion.id.asc()))
 
-            out.append({
-                "ID": inv.id,
-                "FechaISO": fecha_txt,
-                "Fecha": fecha_tabla,
-                "Hora": hora_txt,
-                "Evento": inv.evento or "",
-                "Municipio": inv.municipio or "",
-                "Lugar": inv.lugar or "",
-                "Convoca": inv.convoca or "",
-                "ConvocaCargo": inv.convoca_cargo or "",
-                "Rol": inv.rol or "",
-                "Estatus": inv.estatus or "",
-                "Partido": inv.partido_politico or "",
-            })
+        out = INV_POR_PERSONA.dicts(rows, FechaISO=date.isoformat,
+                                    Fecha=lambda d: d.strftime("%d/%m/%y"),
+                                    Hora=lambda h: h.isoformat("minutes"))
         return jsonify(out)
     except Exception as e:
         db.rollback()
@@ -625,6 +1500,7 @@ def api_invitaciones_by_persona():
         
 @app.get("/api/catalog")
 @auth_required(['admin','viewer'])
+@query_budget(2)
 def api_catalog():
     qtxt = (request.args.get("q") or "").strip().lower()
     db = SessionLocal()
@@ -681,51 +1557,23 @@ def api_catalog():
 
 @app.get("/api/personas")
 @auth_required(['admin','viewer'])   # cambia a ['admin'] si quieres permitir solo admin
+@query_budget(3)
 def api_personas():
     db = SessionLocal()
     try:
-        # Intentamos usar joinedload si la relación Persona.region está definida en tu modelo
-        try:
-            rows = db.query(Persona).options(joinedload(Persona.region)).order_by(Persona.nombre.asc()).all()
-        except Exception:
-            # Si no existe la relación, fallback a consulta sin joinedload
-            rows = db.query(Persona).order_by(Persona.nombre.asc()).all()
+        etag = collection_etag(db, "personas", "regiones")
+        resp304 = not_modified(etag)
+        if resp304 is not None:
+            return resp304
 
-        out = []
-        for p in rows:
-            # obtener region_id directo
-            region_id = getattr(p, 'region_id', None)
-
-            # intentar obtener nombre de region desde relación si existe
-            region_nombre = None
-            try:
-                if getattr(p, 'region', None):
-                    region_nombre = getattr(p.region, 'nombre', None)
-            except Exception:
-                region_nombre = None
-
-            out.append({
-                "ID": p.id,
-                "Nombre": p.nombre or "",
-                "Cargo": p.cargo or "",
-                "Teléfono": p.telefono or "",
-                "Correo": p.correo or "",
-                "Unidad/Región": p.unidad_region or "",
-                "SexoID": p.sexo_id,
-                "ParticularNombre": p.particular_nombre or "",
-                "ParticularCargo":  p.particular_cargo  or "",
-                "ParticularTel":    p.particular_tel    or "",
-                "Activo": bool(p.activo),
-                # campos nuevos para frontend
-                "RegionID": region_id,
-                "RegionNombre": region_nombre
-            })
-        return jsonify(out)
+        out = PERSONAS.dicts(read_rows(db, PERSONAS.select().order_by(Persona.nombre.asc())))
+        return with_etag(jsonify(out), etag)
     finally:
         db.close()
 
 @app.post("/api/person/create")
 @auth_required(['admin'])
+@query_budget(3)
 def api_person_create():
     data = request.get_json() or {}
 
@@ -771,6 +1619,7 @@ def api_person_create():
 
 @app.post("/api/person/update")
 @auth_required(['admin'])
+@query_budget(4)
 def api_person_update():
     import re
     data = request.get_json() or {}
@@ -825,6 +1674,7 @@ def api_person_update():
 
 @app.post("/api/person/delete")
 @auth_required(['admin'])
+@query_budget(12)
 def api_person_delete():
     data = request.get_json() or {}
     pid  = data.get("ID") or data.get("id")
@@ -839,7 +1689,8 @@ def api_person_delete():
 
         # 1) Poner en 'Pendiente' todas las invitaciones donde estaba asignada la persona
         from datetime import datetime
-        invs = db.query(Invitacion).filter(Invitacion.persona_id == p.id).all()
+        invs = db.query(Invitacion).options(*INV_RESPONSABLES).filter(Invitacion.persona_id == p.id).all()
+        notifs = []
         for inv in invs:
             # Guarda valores anteriores (para notificaciones / auditoría, si ya usas add_notif)
             prev_asignado = inv.asignado_a or ""
@@ -854,15 +1705,20 @@ def api_person_delete():
             inv.ultima_modificacion = datetime.utcnow()
             inv.modificado_por = getattr(getattr(g, "user", None), "usuario", "atiapp")
 
-            # Opcional: registra cambios si ya usas add_notif
+            # Opcional: registra cambios (mismas columnas que add_notif)
             try:
-                add_notif(db, inv, "Asignado A", prev_asignado, "")
-                add_notif(db, inv, "Rol", prev_rol, "")
+                notifs.append(notif_values(inv, "Asignado A", prev_asignado, ""))
+                notifs.append(notif_values(inv, "Rol", prev_rol, ""))
                 if prev_status != "Pendiente":
-                    add_notif(db, inv, "Estatus", prev_status, "Pendiente")
+                    notifs.append(notif_values(inv, "Estatus", prev_status, "Pendiente"))
             except Exception:
                 pass
 
+        # Un INSERT multi-fila por lote en lugar de uno por notificación (el ORM no
+        # agrupa inserts con id autoincremental en SQLite)
+        for k in range(0, len(notifs), NOTIF_INSERT_CHUNK):
+            db.execute(insert(Notificacion.__table__).values(notifs[k:k + NOTIF_INSERT_CHUNK]))
+
         # 2) Borrar o desactivar la persona
         # 2a) Borrado duro:
         db.delete(p)
@@ -881,18 +1737,14 @@ def api_person_delete():
 # Lista de regiones (para poblar #regRegion)
 @app.get("/api/regiones")
 @auth_required(['admin','viewer'])
+@query_budget(5)
 def api_regiones_list():
-    db = SessionLocal()
-    try:
-        rows = db.query(Region).order_by(Region.nombre.asc()).all()
-        out = [{"id": r.id, "nombre": r.nombre, "slug": r.slug, "color": r.color} for r in rows]
-        return jsonify(out)
-    finally:
-        db.close()
+    return catalog_cache.response("regiones")
 
 # Personas por region_id
 @app.get("/api/regiones/<int:region_id>/personas")
 @auth_required(['admin','viewer'])
+@query_budget(2)
 def api_regiones_personas(region_id):
     db = SessionLocal()
     try:
@@ -926,41 +1778,14 @@ def api_regiones_personas(region_id):
 # ---- Region: todos los municipios (cache cliente) ----
 @app.get("/api/region_municipios_all")
 @auth_required(['admin','viewer'])
+@query_budget(5)
 def api_region_municipios_all():
-    db = SessionLocal()
-    try:
-        # devuelve regiones y la tabla region_municipios
-        regs = db.query(Region).order_by(Region.id.asc()).all()  # ajustar modelo: Regione/Region/Regiones
-        # use the real model name, e.g. Regiones or Region
-        regiones_out = [{"id": r.id, "nombre": r.nombre, "slug": getattr(r, "slug", None), "color": getattr(r, "color", None)} for r in regs]
-
-        rms = db.query(RegionMunicipio).order_by(RegionMunicipio.region_id.asc(), RegionMunicipio.municipio.asc()).all()
-        rm_out = [{"id": r.id, "region_id": r.region_id, "municipio": r.municipio} for r in rms]
-
-        # build mapping municipio_normalizado -> region_id (cliente-friendly)
-        muni_map = {}
-        for r in rm_out:
-            key = " ".join(str(r["municipio"]).split()).casefold()
-            muni_map[key] = r["region_id"]
-
-        return jsonify({"ok": True, "regiones": regiones_out, "region_municipios": rm_out, "muni_to_region": muni_map})
-    finally:
-        db.close()
-        
-def _normalize_muni_key(s: str) -> str:
-    """Normalize: strip, collapse spaces, remove diacritics, casefold."""
-    if not s:
-        return ""
-    t = " ".join(str(s).split())        # collapse whitespace
-    try:
-        t = unicodedata.normalize("NFD", t)
-        t = "".join(ch for ch in t if unicodedata.category(ch) != "Mn")
-    except Exception:
-        pass
-    return t.casefold()
+    # regiones + tabla region_municipios + mapa municipio_normalizado -> region_id
+    return catalog_cache.response("region_municipios_all")
 
 @app.get("/api/personas/recomendadas")
 @auth_required(['admin','viewer'])
+@query_budget(3)
 def api_personas_recomendadas():
     """
     GET /api/personas/recomendadas?municipio=Aculco
@@ -972,29 +1797,20 @@ def api_personas_recomendadas():
     if not muni_raw:
         return jsonify({"ok": False, "error": "Falta municipio"}), 400
 
-    # Normaliza entrada
-    muni_key = _normalize_muni_key(muni_raw)
-
     db = SessionLocal()
     try:
-        # 1) Buscar filas de region_municipios que coincidan (comparando normalizado)
-        #    Para evitar depender de cómo se guardó en BD, traemos todas y comparamos aquí.
-        #    Si prefieres hacerlo sólo con SQL, asegúrate de almacenar una columna normalizada previo.
-        all_rm = db.query(RegionMunicipio).all()
-        matched_region_ids = []
-        for rm in all_rm:
-            rm_key = _normalize_muni_key(rm.municipio or "")
-            if rm_key and rm_key == muni_key:
-                matched_region_ids.append(rm.region_id)
-
-        matched_region_ids = list(dict.fromkeys(matched_region_ids))  # unique, keep order
+        # 1) Regiones del municipio (índice normalizado en memoria; tolera casi-coincidencias)
+        municipio_resolver.ensure_loaded(db)
+        matched_region_ids = municipio_resolver.region_ids(muni_raw)
 
         if not matched_region_ids:
             # No hay región configurada para ese municipio
             return jsonify({"ok": True, "municipio": muni_raw, "region_ids": [], "personas": []})
 
         # 2) Obtener personas activas de esas regiones
-        q = db.query(Persona).filter(Persona.region_id.in_(matched_region_ids))
+        q = (db.query(Persona)
+               .options(joinedload(Persona.region).load_only(Region.nombre))
+               .filter(Persona.region_id.in_(matched_region_ids)))
         try:
             # Si tu modelo tiene columna 'activo', aplicarla
             _ = Persona.activo
@@ -1035,36 +1851,27 @@ def api_personas_recomendadas():
 # =============================================================================
 @app.get("/api/actores")
 @auth_required(['admin'])
+@query_budget(3)
 def api_actores_list():
     q = (request.args.get("q") or "").strip().lower()
     db = SessionLocal()
     try:
-        rows = (db.query(Actor)
-                  .filter(Actor.activo == True)
-                  .order_by(Actor.nombre.asc())
-                  .all())
-        out = []
-        for a in rows:
-            if q:
-                txt = f"{a.nombre} {a.cargo or ''} {a.telefono or ''}".lower()
-                if q not in txt:
-                    continue
-            out.append({
-                "ID": a.id,
-                "Nombre": a.nombre or "",
-                "Cargo": a.cargo or "",
-                "Teléfono": a.telefono or "",
-                "SexoID": a.sexo_id,
-                "ParticularNombre": a.particular_nombre,
-                "ParticularCargo": a.particular_cargo,
-                "ParticularTel": a.particular_tel,
-            })
-        return jsonify(out)
+        etag = collection_etag(db, "actores")
+        resp304 = not_modified(etag)
+        if resp304 is not None:
+            return resp304
+
+        out = ACTORES.dicts(read_rows(db, ACTORES.select().where(Actor.activo == True)
+                                                .order_by(Actor.nombre.asc())))
+        if q:
+            out = [a for a in out if q in f"{a['Nombre']} {a['Cargo']} {a['Teléfono']}".lower()]
+        return with_etag(jsonify(out), etag)
     finally:
         db.close()
 
 @app.post("/api/actor/create")
 @auth_required(['admin'])
+@query_budget(3)
 def api_actor_create():
     data = request.get_json() or {}
     nombre = (data.get("Nombre") or "").strip()
@@ -1095,6 +1902,7 @@ def api_actor_create():
 
 @app.post("/api/actor/update")
 @auth_required(['admin'])
+@query_budget(4)
 def api_actor_update():
     data = request.get_json() or {}
     actor_id = data.get("id")
@@ -1128,6 +1936,7 @@ def api_actor_update():
 # ===== Eliminar actor (bloqueado si tiene invitaciones) =====
 @app.delete("/api/actor/delete/<int:actor_id>")
 @auth_required(['admin'])
+@query_budget(4)
 def api_actor_delete(actor_id: int):
     db = SessionLocal()
     try:
@@ -1165,18 +1974,392 @@ def api_actor_delete(actor_id: int):
     finally:
         db.close()
 
+# =============================================================================
+# Typeahead (índice en memoria de personas y actores)
+# =============================================================================
+TYPEAHEAD_CHECK = int(os.getenv("TYPEAHEAD_CHECK", "5"))   # seg. entre chequeos de versión en BD
+TYPEAHEAD_MAX   = 50
+_TOKEN_RE = re.compile(r"[0-9a-z]+")
+
+def _ta_tokens(s) -> list:
+    return _TOKEN_RE.findall(fold_text(s))
+
+class TypeaheadIndex:
+    """
+    Índice por prefijo de tokens (sin acentos) sobre nombre, cargo, teléfono, correo y unidad.
+      - token -> {doc_key}; lista ordenada de tokens para resolver prefijos con bisect
+      - doc_key = ("personas"|"actores", id)
+    Se actualiza incrementalmente con los commits de este proceso (listeners abajo) y se
+    reconstruye si colecciones_version muestra cambios hechos por otro worker.
+    """
+
+    def __init__(self):
+        self._docs = {}         # doc_key -> (fila para el cliente, tokens nombre, tokens resto)
+        self._postings = {}     # token -> set(doc_key)
+        self._sorted = []       # tokens ordenados
+        self._versions = None   # {"personas": v, "actores": v} con que se construyó
+        self._checked_at = 0.0
+        self._lock = threading.RLock()
+
+    # ----- mantenimiento -----
+    def _add_token(self, tok, key):
+        docs = self._postings.get(tok)
+        if docs is None:
+            docs = self._postings[tok] = set()
+            bisect.insort(self._sorted, tok)
+        docs.add(key)
+
+    def _drop_token(self, tok, key):
+        docs = self._postings.get(tok)
+        if docs is None:
+            return
+        docs.discard(key)
+        if not docs:
+            del self._postings[tok]
+            i = bisect.bisect_left(self._sorted, tok)
+            if i < len(self._sorted) and self._sorted[i] == tok:
+                del self._sorted[i]
+
+    def remove(self, key):
+        with self._lock:
+            doc = self._docs.pop(key, None)
+            if doc:
+                for tok in set(doc[1]) | set(doc[2]):
+                    self._drop_token(tok, key)
+
+    def upsert(self, tipo: str, row: dict):
+        key = (tipo, row["ID"])
+        nombre_toks = _ta_tokens(row.get("Nombre"))
+        otros = " ".join(str(row.get(k) or "") for k in ("Cargo", "Teléfono", "Correo", "Unidad/Región"))
+        otros_toks = _ta_tokens(otros)
+        with self._lock:
+            self.remove(key)
+            self._docs[key] = (row, nombre_toks, otros_toks)
+            for tok in set(nombre_toks) | set(otros_toks):
+                self._add_token(tok, key)
+
+    def rebuild(self, db):
+        personas = (db.query(Persona.id, Persona.nombre, Persona.cargo, Persona.telefono,
+                             Persona.correo, Persona.unidad_region)
+                      .filter(Persona.activo == True).all())
+        actores = (db.query(Actor.id, Actor.nombre, Actor.cargo, Actor.telefono)
+                     .filter(Actor.activo == True).all())
+        versions = dict(db.query(ColeccionVersion.nombre, ColeccionVersion.version)
+                          .filter(ColeccionVersion.nombre.in_(("personas", "actores"))).all())
+        with self._lock:
+            self._docs, self._postings, self._sorted = {}, {}, []
+            for p in personas:
+                self.upsert("personas", _ta_persona_row(p))
+            for a in actores:
+                self.upsert("actores", _ta_actor_row(a))
+            self._versions = versions
+            self._checked_at = time.monotonic()
+
+    def ensure_fresh(self, db):
+        now = time.monotonic()
+        if self._versions is not None and now - self._checked_at < TYPEAHEAD_CHECK:
+            return
+        try:
+            versions = dict(db.query(ColeccionVersion.nombre, ColeccionVersion.version)
+                              .filter(ColeccionVersion.nombre.in_(("personas", "actores"))).all())
+        except (OperationalError, ProgrammingError):
+            db.rollback()
+            versions = {}
+        if self._versions is None or versions != self._versions:
+            self.rebuild(db)
+        else:
+            self._checked_at = now
+
+    def apply_commit(self, pend: dict, bumps: dict):
+        """
+        Aplica los cambios de un commit de este proceso y avanza _versions a las versiones
+        que ese mismo commit dejó en colecciones_version. Sólo avanza una colección si el
+        índice estaba justo en la versión previa y todos los incrementos vinieron del ORM;
+        si no (cambios de otro worker o escrituras Core), ensure_fresh reconstruye.
+        """
+        with self._lock:
+            if self._versions is None:
+                return
+            for key, row in pend.items():
+                if row is None:
+                    self.remove(key)
+                else:
+                    self.upsert(key[0], row)
+            for nombre in ("personas", "actores"):
+                b = bumps.get(nombre)
+                if b and b[2] and self._versions.get(nombre) == b[0]:
+                    self._versions = {**self._versions, nombre: b[1]}
+
+    def invalidate(self):
+        with self._lock:
+            self._versions = None
+
+    # ----- consulta -----
+    def _prefix(self, p: str):
+        i = bisect.bisect_left(self._sorted, p)
+        j = bisect.bisect_left(self._sorted, p + "\uffff")
+        return self._sorted[i:j]
+
+    def search(self, q: str, tipos=("personas", "actores"), limit: int = 10) -> list:
+        qtoks = _ta_tokens(q)
+        if not qtoks:
+            return []
+        with self._lock:
+            scores = None
+            for qt in qtoks:
+                matched = {}
+                for tok in self._prefix(qt):
+                    exacto = tok == qt
+                    for key in self._postings[tok]:
+                        if key[0] not in tipos:
+                            continue
+                        doc = self._docs[key]
+                        en_nombre = tok in doc[1]
+                        pts = (2 if en_nombre else 1) + (1 if exacto else 0)
+                        if pts > matched.get(key, 0):
+                            matched[key] = pts
+                # AND: cada palabra de la consulta debe coincidir
+                if scores is None:
+                    scores = matched
+                else:
+                    scores = {k: v + matched[k] for k, v in scores.items() if k in matched}
+                if not scores:
+                    return []
+            def rank(key):
+                doc = self._docs[key]
+                bonus = 2 if doc[1] and doc[1][0].startswith(qtoks[0]) else 0
+                return (scores[key] + bonus, -len(doc[0].get("Nombre") or ""))
+            top = heapq.nlargest(limit, scores, key=rank)
+            return [{"Tipo": k[0], **self._docs[k][0], "Score": rank(k)[0]} for k in top]
+
+def _ta_persona_row(p) -> dict:
+    return {
+        "ID": p.id,
+        "Nombre": p.nombre or "",
+        "Cargo": p.cargo or "",
+        "Teléfono": p.telefono or "",
+        "Correo": p.correo or "",
+        "Unidad/Región": p.unidad_region or "",
+    }
+
+def _ta_actor_row(a) -> dict:
+    return {
+        "ID": a.id,
+        "Nombre": a.nombre or "",
+        "Cargo": a.cargo or "",
+        "Teléfono": a.telefono or "",
+    }
+
+typeahead_index = TypeaheadIndex()
+
+@event.listens_for(SessionLocal, "after_flush")
+def _collect_typeahead(session, flush_context):
+    pend = session.info.setdefault("typeahead", {})
+    for obj in list(session.new) + list(session.dirty):
+        if isinstance(obj, Persona):
+            pend[("personas", obj.id)] = _ta_persona_row(obj) if obj.activo else None
+        elif isinstance(obj, Actor):
+            pend[("actores", obj.id)] = _ta_actor_row(obj) if obj.activo else None
+    for obj in session.deleted:
+        if isinstance(obj, (Persona, Actor)):
+            pend[("personas" if isinstance(obj, Persona) else "actores", obj.id)] = None
+
+@event.listens_for(SessionLocal, "after_commit")
+def _apply_typeahead(session):
+    pend = session.info.pop("typeahead", None)
+    bumps = session.info.pop("colecciones_bump", None) or {}
+    if not pend or typeahead_index._versions is None:
+        return   # índice aún no construido: se arma completo en la primera consulta
+    typeahead_index.apply_commit(pend, bumps)
+
+@event.listens_for(SessionLocal, "after_rollback")
+def _discard_typeahead(session):
+    session.info.pop("typeahead", None)
+
+@app.get("/api/typeahead")
+@auth_required(['admin','viewer'])
+@query_budget(5)
+def api_typeahead():
+    """
+    GET /api/typeahead?q=jose per&tipo=personas|actores|todos&limit=10
+    Prefijos por palabra (todas deben coincidir), sin acentos; devuelve sólo los mejores N.
+    """
+    qtxt = (request.args.get("q") or "").strip()
+    tipo = (request.args.get("tipo") or "todos").strip()
+    try:
+        limit = max(1, min(int(request.args.get("limit") or 10), TYPEAHEAD_MAX))
+    except ValueError:
+        limit = 10
+
+    tipos = ("personas", "actores") if tipo == "todos" else (tipo,)
+    if (g.current_user.rol or "") != "admin":
+        tipos = tuple(t for t in tipos if t != "actores")   # /api/actores es sólo admin
+    if not qtxt or not tipos:
+        return jsonify({"ok": True, "items": []})
+
+    db = SessionLocal()
+    try:
+        typeahead_index.ensure_fresh(db)
+    finally:
+        db.close()
+    return jsonify({"ok": True, "items": typeahead_index.search(qtxt, tipos, limit)})
+
+# =============================================================================
+# Paginación por cursor (keyset) para /api/invitations
+# =============================================================================
+INV_PAGE_DEFAULT = int(os.getenv("INV_PAGE_DEFAULT", "200"))
+INV_PAGE_MAX     = int(os.getenv("INV_PAGE_MAX", "1000"))
+
+def encode_inv_cursor(inv: Invitacion) -> str:
+    """
+    Cursor opaco con la llave de orden (fecha, hora, id) de la última fila enviada.
+    """
+    raw = json.dumps([
+        inv.fecha.isoformat() if inv.fecha else None,
+        inv.hora.isoformat() if inv.hora else None,
+        inv.id,
+    ], separators=(",", ":"))
+    return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii").rstrip("=")
+
+def decode_inv_cursor(token: str) -> Optional[tuple]:
+    """
+    Inverso de encode_inv_cursor. Devuelve (fecha, hora, id) o None si el token es inválido.
+    """
+    try:
+        pad = "=" * (-len(token) % 4)
+        fecha_s, hora_s, inv_id = json.loads(base64.urlsafe_b64decode(token + pad).decode("utf-8"))
+        return (date.fromisoformat(fecha_s), dtime.fromisoformat(hora_s), str(inv_id))
+    except Exception:
+        return None
+
+def _parse_page_limit(raw: Optional[str]) -> int:
+    try:
+        n = int(raw)
+    except (TypeError, ValueError):
+        return INV_PAGE_DEFAULT
+    return max(1, min(n, INV_PAGE_MAX))
+
+# =============================================================================
+# Búsqueda de invitaciones (índice trigram / FTS5)
+# =============================================================================
+# INV_SEARCH_MODE: "auto" usa el índice instalado por init_db (pg_trgm o FTS5) y cae a
+# "ilike" (comportamiento original, escaneo secuencial) si no existe.
+INV_SEARCH_MODE = os.getenv("INV_SEARCH_MODE", "auto")
+_search_backend = None
+
+_fts = sa_table("invitaciones_fts", sa_column("rowid"), sa_column("busqueda"))
+
+def _detect_search_backend(db) -> str:
+    global _search_backend
+    if _search_backend is not None:
+        return _search_backend
+    backend = "ilike"
+    try:
+        if engine.dialect.name == "postgresql":
+            ok = db.execute(text(
+                "SELECT 1 FROM pg_indexes WHERE indexname = 'idx_invitaciones_busqueda_trgm'"
+            )).first()
+            backend = "pg_trgm" if ok else "ilike"
+        elif engine.dialect.name == "sqlite":
+            ddl = db.execute(text(
+                "SELECT sql FROM sqlite_master WHERE name = 'invitaciones_fts'"
+            )).scalar()
+            # índices previos ligados al rowid implícito: no usarlos hasta correr init_db
+            backend = "fts5" if ddl and "content_rowid='fts_id'" in ddl else "ilike"
+    except (OperationalError, ProgrammingError):
+        db.rollback()
+    _search_backend = backend
+    return backend
+
+def _like_escape(s: str) -> str:
+    return s.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+def apply_inv_search(db, q, term: str, mode: Optional[str] = None):
+    """
+    Aplica el filtro de texto libre. Devuelve (query, expresión de relevancia | None).
+    Modos indexados: cada palabra (sin acentos, minúsculas) debe aparecer como subcadena
+    de Invitacion.busqueda, igual que el ilike original pero usando el índice.
+    """
+    mode = mode or INV_SEARCH_MODE
+    if mode == "auto":
+        mode = _detect_search_backend(db)
+
+    if mode == "ilike":
+        like = f"%{term}%"
+        return q.filter(
+            or_(
+                Invitacion.evento.ilike(like),
+                Invitacion.lugar.ilike(like),
+                Invitacion.convoca.ilike(like),
+                Invitacion.partido_politico.ilike(like),
+                Invitacion.municipio.ilike(like),
+            )
+        ), None
+
+    folded = fold_text(term)
+    tokens = folded.split()
+    if not tokens:
+        return q, None
+
+    if mode == "pg_trgm":
+        for tok in tokens:
+            q = q.filter(Invitacion.busqueda.like(f"%{_like_escape(tok)}%", escape="\\"))
+        return q, func.word_similarity(folded, Invitacion.busqueda)
+
+    if mode == "fts5":
+        # el tokenizer trigram sólo indexa términos de 3+ caracteres
+        largos = [t for t in tokens if len(t) >= 3]
+        for tok in tokens:
+            if len(tok) < 3:
+                q = q.filter(Invitacion.busqueda.like(f"%{_like_escape(tok)}%", escape="\\"))
+        if not largos:
+            return q, None
+        match = " ".join('"' + t.replace('"', '""') + '"' for t in largos)
+        hits = (select(_fts.c.rowid, func.bm25(literal_column("invitaciones_fts")).label("rank"))
+                .where(_fts.c.busqueda.op("MATCH")(match))
+                .subquery())
+        q = q.join(hits, hits.c.rowid == literal_column("invitaciones.fts_id"))
+        return q, -hits.c.rank   # bm25: menor es mejor
+
+    raise ValueError(f"INV_SEARCH_MODE desconocido: {mode}")
+
 # =============================================================================
 # Invitaciones
 # =============================================================================
 @app.get("/api/invitations")
 @auth_required(['admin','viewer'])
+@query_budget(4)
 def api_invitations_list():
+    """
+    Sin `limit`/`cursor` responde la lista completa (compatibilidad con el front).
+    Con `limit` y/o `cursor` responde por páginas ordenadas por (fecha desc, hora desc, id desc):
+      { ok, items: [...], next_cursor: "<token>" | null, limit }
+    El cursor se aplica como condición de llave (keyset), no como OFFSET,
+    así que la página N cuesta lo mismo que la página 1.
+    `q` usa el índice de búsqueda (ver apply_inv_search); `orden=relevancia` ordena
+    primero por relevancia (sólo con `limit`, sin cursor).
+    """
+    limit_raw  = (request.args.get("limit") or "").strip()
+    cursor_raw = (request.args.get("cursor") or "").strip()
+    paginado   = bool(limit_raw or cursor_raw)
+    por_relevancia = (request.args.get("orden") or "").strip() == "relevancia"
+    if por_relevancia and cursor_raw:
+        return jsonify({"ok": False, "error": "cursor no soportado con orden=relevancia (usa limit)"}), 400
+
+    cursor = None
+    if cursor_raw:
+        cursor = decode_inv_cursor(cursor_raw)
+        if cursor is None:
+            return jsonify({"ok": False, "error": "cursor inválido"}), 400
+
     db = SessionLocal()
     try:
-        q = db.query(Invitacion).options(
-            joinedload(Invitacion.actor),
-            joinedload(Invitacion.persona)
-        )
+        etag = collection_etag(db, "invitaciones", "personas", "actores")
+        resp304 = not_modified(etag)
+        if resp304 is not None:
+            return resp304
+
+        q = INV_LISTA.select()
 
         # Filtros (opcionales)
         estatus = (request.args.get("estatus") or "").strip()
@@ -1204,57 +2387,32 @@ def api_invitations_list():
         if municipio:
             q = q.filter(Invitacion.municipio.ilike(f"%{municipio}%"))
 
-        # Búsqueda libre (evento / lugar / convoca)
+        # Búsqueda libre (evento / lugar / convoca / partido / municipio)
         term = (request.args.get("q") or "").strip()
+        rank = None
         if term:
-            like = f"%{term}%"
-            q = q.filter(
-                or_(
-                    Invitacion.evento.ilike(like),
-                    Invitacion.lugar.ilike(like),
-                    Invitacion.convoca.ilike(like),
-                    Invitacion.partido_politico.ilike(like),
-                    Invitacion.municipio.ilike(like),
-                )
-            )
+            q, rank = apply_inv_search(db, q, term)
+
+        if por_relevancia and rank is not None:
+            q = q.order_by(rank.desc())
+        q = q.order_by(Invitacion.fecha.desc(), Invitacion.hora.desc(), Invitacion.id.desc())
+
+        next_cursor = None
+        if paginado:
+            limit = _parse_page_limit(limit_raw)
+            if cursor:
+                q = q.filter(tuple_(Invitacion.fecha, Invitacion.hora, Invitacion.id) < tuple_(*cursor))
+            invs = read_rows(db, q.limit(limit + 1))
+            if len(invs) > limit:
+                invs = invs[:limit]
+                next_cursor = encode_inv_cursor(invs[-1])
+        else:
+            invs = read_rows(db, q)
 
-        q = q.order_by(Invitacion.fecha.desc(), Invitacion.hora.desc())
-
-        rows = []
-        for inv in q.all():
-            actor = inv.actor
-            persona = inv.persona
-            rows.append({
-                "ID": inv.id,
-                "Fecha": inv.fecha.isoformat() if inv.fecha else None,
-                "Hora": inv.hora.strftime("%H:%M") if inv.hora else None,
-                "Evento": inv.evento,
-                "ConvocaCargo": inv.convoca_cargo,           # 👈 AÑADE ESTO
-                "Convoca": inv.convoca,
-                "Partido": inv.partido_politico,
-                "Municipio": inv.municipio,
-                "Lugar": inv.lugar,
-                "Estatus": inv.estatus,
-                "Observaciones": inv.observaciones,
-
-                "ActorID": actor.id if actor else None,
-                "ActorNombre": getattr(actor, "nombre", None) if actor else None,
-                "ActorCargo": getattr(actor, "cargo", None) if actor else None,
-
-                "PersonaID": persona.id if persona else None,
-                "PersonaNombre": getattr(persona, "nombre", None) if persona else None,
-                "PersonaCargo": getattr(persona, "cargo", None) if persona else None,
-
-                "ArchivoNombre": inv.archivo_nombre,
-                "ArchivoMime": inv.archivo_mime,
-                "ArchivoTamano": inv.archivo_tamano,
-                "ArchivoURL": inv.archivo_url,  # si lo usas
-                    # ⬇️ nuevos
-                "GrupoToken": inv.grupo_token or "",
-                "SubTipo": inv.sub_tipo or "",
-                
-            })
-        return jsonify(rows)
+        rows = INV_LISTA.dicts(invs, Fecha=date.isoformat, Hora=lambda h: h.isoformat("minutes"))
+        if paginado:
+            return with_etag(jsonify({"ok": True, "items": rows, "next_cursor": next_cursor, "limit": limit}), etag)
+        return with_etag(jsonify(rows), etag)
     except Exception as e:
         return jsonify({"error": str(e)}), 500
     finally:
@@ -1321,6 +2479,7 @@ def inv_to_dict(inv):
         "ArchivoMime": getattr(inv, "archivo_mime", "") or "",
         "ArchivoTamano": getattr(inv, "archivo_tamano", 0) or 0,
         "ArchivoTS": safe_fmt_dt(getattr(inv, "archivo_ts", None)),
+        "ArchivoSHA256": getattr(inv, "archivo_sha256", "") or "",
 
         "DiasParaEvento": dias,
     }
@@ -1337,6 +2496,7 @@ def allowed_file(filename: str) -> bool:
 # ---- Crear invitación (solo actor_id obligatorio en tu flujo actual) ----
 @app.post("/api/invitation/create")
 @auth_required(['admin'])
+@query_budget(4)
 def api_invitation_create():
     db = SessionLocal()
     try:
@@ -1365,11 +2525,10 @@ def api_invitation_create():
         if faltan:
             return jsonify({"ok": False, "error": f"Faltan campos obligatorios: {', '.join(faltan)}"}), 400
 
-        # === VALIDACIÓN DE MUNICIPIO (case-insensitive, normalizado) ===
-        muni_key = " ".join(muni_in.split()).casefold()   # colapsa espacios y baja a minúsculas
-        muni_can = VALID_MUNICIPIOS_LOWER.get(muni_key)
+        # === VALIDACIÓN DE MUNICIPIO (sin importar acentos/mayúsculas/espacios) ===
+        muni_can = municipio_resolver.canonical(muni_in)
         if not muni_can:
-            return jsonify({"ok": False, "error": f"Municipio inválido: '{muni_in}'"}), 400
+            return jsonify({"ok": False, "error": _muni_error(muni_in)}), 400
         # usa siempre el nombre canónico:
         muni = muni_can
 
@@ -1415,7 +2574,8 @@ def api_invitation_create():
         # archivo (opcional)
         up = files.get("archivo")
         if up and getattr(up, "filename", ""):
-            meta = save_invitation_file(up, inv_id)
+            meta = save_invitation_file(up, inv_id, db)
+            inv.archivo_sha256 = meta["sha256"]
             inv.archivo_nombre = meta["nombre"]
             inv.archivo_mime   = meta["mime"]
             inv.archivo_tamano = meta["tamano"]
@@ -1435,6 +2595,7 @@ def api_invitation_create():
 
 @app.get("/api/invitation/<id>/archivo")
 @auth_required(['admin','viewer'])
+@query_budget(2)
 def api_invitation_get_file(id):
     db = SessionLocal()
     try:
@@ -1450,24 +2611,137 @@ def api_invitation_get_file(id):
         if path_or_url.startswith("http://") or path_or_url.startswith("https://"):
             return redirect(path_or_url, code=302)
 
-        # Si es ruta relativa almacenada (nuestro flujo local)
-        return send_from_directory(
-            directory=str(UPLOAD_ROOT),
-            path=path_or_url,                        # p.ej. "invitaciones/<id>/x.pdf"
-            as_attachment=False,
+        # Si es ruta relativa almacenada (nuestro flujo local). ETag: el sha256 del blob si
+        # existe; si no, archivo_ts + tamaño (cambian con cada reemplazo del archivo).
+        # La URL es por id: sólo se cachea a largo plazo con ?v=<sha256> del adjunto actual
+        etag = inv.archivo_sha256 or (
+            etag_for("archivo", inv.id, inv.archivo_ts, inv.archivo_tamano) if inv.archivo_ts else None
+        )
+        return send_attachment(
+            UPLOAD_ROOT, path_or_url,               # p.ej. "blobs/ab/cd/<sha256>"
+            mime=(inv.archivo_mime or None),
             download_name=(inv.archivo_nombre or "archivo"),
-            mimetype=(inv.archivo_mime or None)
+            etag=etag,
+            last_modified=inv.archivo_ts,
+            immutable=bool(inv.archivo_sha256) and request.args.get("v") == inv.archivo_sha256,
         )
     finally:
         db.close()
         
+# ===== Vista previa (derivados chicos junto al blob, por hash de contenido) =====
+# PDF: primera página rasterizada (pypdfium2); imágenes: reducidas. Ambas dependencias son
+# opcionales: sin Pillow no hay vistas previas y sin pypdfium2 sólo se generan las de imágenes.
+try:
+    from PIL import Image, ImageOps, features as pil_features
+except ImportError:
+    Image = None
+try:
+    import pypdfium2 as pdfium
+except ImportError:
+    pdfium = None
+from concurrent.futures import ThreadPoolExecutor
+
+PREVIEW_ENABLED  = os.getenv("PREVIEW_ENABLED", "1") == "1" and Image is not None
+PREVIEW_MAX_PX   = int(os.getenv("PREVIEW_MAX_PX", "640"))      # lado mayor
+PREVIEW_QUALITY  = int(os.getenv("PREVIEW_QUALITY", "70"))
+PREVIEW_WORKERS  = int(os.getenv("PREVIEW_WORKERS", "2"))
+PREVIEW_WAIT_SEC = float(os.getenv("PREVIEW_WAIT_SEC", "5"))    # espera en /preview si aún no existe
+PREVIEW_FORMAT   = ("webp" if Image is not None and pil_features.check("webp") else "jpeg")
+
+_preview_pool = ThreadPoolExecutor(max_workers=PREVIEW_WORKERS, thread_name_prefix="preview")
+_preview_jobs = {}              # digest -> Future en curso
+_preview_lock = threading.Lock()
+
+def _preview_kind(mime: Optional[str]) -> Optional[str]:
+    mime = (mime or "").lower()
+    if mime == "application/pdf":
+        return "pdf" if pdfium is not None else None
+    if mime.startswith("image/"):
+        return "image"
+    return None
+
+def preview_relpath(digest: str) -> str:
+    return f"{blob_relpath(digest)}.preview-{PREVIEW_MAX_PX}.{PREVIEW_FORMAT}"
+
+def build_preview(digest: str, mime: Optional[str]) -> Optional[Path]:
+    """Genera (si falta) el derivado del blob y devuelve su ruta; None si el tipo no aplica."""
+    kind = _preview_kind(mime)
+    if not PREVIEW_ENABLED or kind is None:
+        return None
+    dest = UPLOAD_ROOT / preview_relpath(digest)
+    if dest.exists():
+        return dest
+    src = UPLOAD_ROOT / blob_relpath(digest)
+    if kind == "pdf":
+        pdf = pdfium.PdfDocument(str(src))
+        try:
+            page = pdf[0]
+            img = page.render(scale=PREVIEW_MAX_PX / max(page.get_size())).to_pil()
+        finally:
+            pdf.close()
+    else:
+        with Image.open(src) as im:
+            img = ImageOps.exif_transpose(im)
+            img.thumbnail((PREVIEW_MAX_PX, PREVIEW_MAX_PX))
+    if img.mode not in ("RGB", "L"):
+        img = img.convert("RGB")
+    tmp = dest.with_name(dest.name + f".{threading.get_ident()}.tmp")
+    img.save(tmp, format=PREVIEW_FORMAT.upper(), quality=PREVIEW_QUALITY)
+    os.replace(tmp, dest)
+    return dest
+
+def enqueue_preview(digest: str, mime: Optional[str]):
+    """Encola la generación en el pool (una sola vez por digest a la vez). Devuelve el Future o None."""
+    if not PREVIEW_ENABLED or _preview_kind(mime) is None:
+        return None
+    with _preview_lock:
+        fut = _preview_jobs.get(digest)
+        if fut is None:
+            fut = _preview_pool.submit(build_preview, digest, mime)
+            _preview_jobs[digest] = fut
+            fut.add_done_callback(lambda _f: _preview_jobs.pop(digest, None))
+        return fut
+
+@app.get("/api/invitation/<id>/preview")
+@auth_required(['admin','viewer'])
+@query_budget(2)
+def api_invitation_preview(id):
+    """Derivado chico del adjunto (PDF: 1a página; imagen: reducida). 404 si no aplica."""
+    db = SessionLocal()
+    try:
+        inv = db.get(Invitacion, id)
+        if not inv:
+            return jsonify({"ok": False, "error": "Invitación no encontrada"}), 404
+        digest, mime = inv.archivo_sha256, inv.archivo_mime
+    finally:
+        db.close()
+
+    if not digest or _preview_kind(mime) is None or not PREVIEW_ENABLED:
+        return jsonify({"ok": False, "error": "Sin vista previa"}), 404
+    rel = preview_relpath(digest)
+    if not (UPLOAD_ROOT / rel).exists():
+        fut = enqueue_preview(digest, mime)
+        try:
+            if fut is None or fut.result(timeout=PREVIEW_WAIT_SEC) is None:
+                return jsonify({"ok": False, "error": "Sin vista previa"}), 404
+        except TimeoutError:
+            resp = jsonify({"ok": False, "error": "Vista previa en proceso"})
+            resp.headers["Retry-After"] = "2"
+            return resp, 503
+        except Exception as e:
+            return jsonify({"ok": False, "error": f"No se pudo generar la vista previa: {e}"}), 422
+    # URL por id: caché larga sólo con ?v=<sha256> del adjunto actual (ver send_attachment)
+    return send_attachment(UPLOAD_ROOT, rel, mime=f"image/{PREVIEW_FORMAT}",
+                           download_name=f"preview.{PREVIEW_FORMAT}",
+                           etag=f"{digest}-p{PREVIEW_MAX_PX}",
+                           immutable=request.args.get("v") == digest)
+
 # Endpoint: Editar invitación
 @app.post("/api/invitation/update")
 @auth_required(['admin'])
+@query_budget(10)
 def api_invitation_update():
     from datetime import datetime as dt, date
-    import unicodedata
-    from datetime import datetime as dt
 
     def _parse_date_flex(s):
         s = (s or "").strip()
@@ -1485,22 +2759,14 @@ def api_invitation_update():
             except Exception:
                 pass
         raise ValueError("Hora inválida (usa HH:MM)")
-        # Normaliza (quita acentos/diacríticos) y pasa a minúsculas para comparar
-    def _norm(s: str) -> str:
-        s = (s or "").strip()
-        s = unicodedata.normalize("NFD", s)
-        s = "".join(ch for ch in s if unicodedata.category(ch) != "Mn")
-        return s.casefold()
-    
-        # Mapa {normalizado: canónico}
-    _MUNI_MAP = {_norm(m): m for m in MUNICIPIOS_EDOMEX}
+
     inv_id = (request.form.get("id") or request.form.get("ID") or "").strip()
     if not inv_id:
         return jsonify({"ok": False, "error": "Falta ID"}), 400
 
     db = SessionLocal()
     try:
-        inv = db.get(Invitacion, inv_id)
+        inv = db.get(Invitacion, inv_id, options=INV_RESPONSABLES)
         if not inv:
             return jsonify({"ok": False, "error": "Invitación no encontrada"}), 404
 
@@ -1509,7 +2775,7 @@ def api_invitation_update():
             "fecha": inv.fecha, "hora": inv.hora, "evento": inv.evento,
             "convoca_cargo": inv.convoca_cargo, "partido_politico": inv.partido_politico,
             "municipio": inv.municipio, "lugar": inv.lugar, "observaciones": inv.observaciones,
-            "archivo_url": inv.archivo_url
+            "archivo_url": inv.archivo_url, "archivo_sha256": inv.archivo_sha256
         }
 
         # Helper: emite una única notificación "Reprogramado" con antes→ahora
@@ -1572,14 +2838,13 @@ def api_invitation_update():
             # VALIDACIÓN: municipio debe existir en la lista blanca
             muni_in = (f_muni or "").strip()
             if muni_in:
-                muni_key = _norm(muni_in)
-                if muni_key not in _MUNI_MAP:
+                muni_canon = municipio_resolver.canonical(muni_in)
+                if not muni_canon:
                     return jsonify({
                         "ok": False,
                         "error": "Municipio inválido",
-                        "detalle": f"'{muni_in}' no está en el catálogo permitido."
+                        "detalle": _muni_error(muni_in)
                     }), 400
-                muni_canon = _MUNI_MAP[muni_key]  # canónico
             else:
                 muni_canon = ""  # permitir limpiar si así lo usas
             if prev["municipio"] != muni_canon:
@@ -1616,17 +2881,20 @@ def api_invitation_update():
         # ======= ARCHIVO (igual que ya tenías) =======
         up = request.files.get("archivo")
         if f_del and inv.archivo_url:
-            delete_file_if_local(inv.archivo_url)
+            delete_file_if_local(inv.archivo_url, db, inv.archivo_sha256)
             inv.archivo_url    = None
+            inv.archivo_sha256 = None
             inv.archivo_nombre = None
             inv.archivo_mime   = None
             inv.archivo_tamano = None
             inv.archivo_ts     = None
 
         if up and getattr(up, "filename", ""):
-            meta = save_invitation_file(up, inv.id)
-            if prev["archivo_url"] and not _is_http_url(prev["archivo_url"]):
-                delete_file_if_local(prev["archivo_url"])
+            meta = save_invitation_file(up, inv.id, db)
+            # el anterior se suelta una sola vez: si eliminar_archivo ya lo hizo, aquí es None
+            if inv.archivo_url and not _is_http_url(inv.archivo_url):
+                delete_file_if_local(inv.archivo_url, db, inv.archivo_sha256)
+            inv.archivo_sha256 = meta["sha256"]
             inv.archivo_nombre = meta["nombre"]
             inv.archivo_mime   = meta["mime"]
             inv.archivo_tamano = meta["tamano"]
@@ -1651,6 +2919,7 @@ def api_invitation_update():
   
 @app.delete("/api/invitation/delete/<id>")
 @auth_required(['admin'])
+@query_budget(4)
 def api_invitation_delete(id):
     db = SessionLocal()
     try:
@@ -1658,6 +2927,9 @@ def api_invitation_delete(id):
         if not inv:
             return jsonify({"ok": False, "error": "Invitación no encontrada"}), 404
 
+        # Blob compartido: sólo suelta la referencia de esta invitación
+        if inv.archivo_sha256:
+            delete_file_if_local(inv.archivo_url, db, inv.archivo_sha256)
         db.delete(inv)
         db.commit()
         return jsonify({"ok": True})
@@ -1670,8 +2942,85 @@ def api_invitation_delete(id):
 # =============================================================================
 # Asignación (PARCHADO)
 # =============================================================================
+# Una fila de notificación por asignación (Asignado A / Rol / Estatus en `cambios`) en lugar
+# de una por campo. La fila lleva campo='Estatus' / valor_nuevo='Confirmado', así que el bot
+# la sigue leyendo igual; notificaciones_detalle la expande por campo.
+NOTIF_COALESCE     = os.getenv("NOTIF_COALESCE", "1") == "1"
+BULK_ASSIGN_MAX    = int(os.getenv("BULK_ASSIGN_MAX", "500"))
+NOTIF_INSERT_CHUNK = int(os.getenv("NOTIF_INSERT_CHUNK", "500"))   # filas por INSERT ... VALUES
+
+def _apply_assignment(db, inv, emit, persona=None, actor=None, rol_in="", comentario="",
+                      prev_persona=None, prev_actor=None):
+    """
+    Asigna `inv` a una persona o a un actor (la agenda ya se validó) y entrega cada
+    snapshot de notificación a emit(dict). Compartido por /api/assign y /api/assign/bulk.
+    """
+    prev_asig    = inv.asignado_a
+    prev_rol     = inv.rol
+    prev_estatus = inv.estatus
+    entrante     = persona if persona is not None else actor
+
+    def notif(campo, anterior, nuevo, persona_obj=None, actor_obj=None, estatus="Confirmado", cambios=None):
+        emit(notif_snapshot(
+            db, inv,
+            campo=campo,
+            valor_anterior=anterior or "",
+            valor_nuevo=nuevo or "",
+            comentario=comentario,
+            persona_obj=persona_obj,
+            actor_obj=actor_obj,
+            estatus_override=estatus,
+            cambios=cambios,
+        ))
+
+    # Si había una persona previa distinta, registra SUSTITUIDO con snapshot del saliente
+    if prev_persona and (persona is None or prev_persona.id != persona.id):
+        notif("Sustituido", prev_asig, entrante.nombre, persona_obj=prev_persona, estatus="Sustituido")
+
+    if persona is not None:
+        # El actor convocante permanece en inv.actor_id
+        inv.persona_id = persona.id
+        # IMPORTANTE: actor_obj=prev_actor para que la notificación llegue al actor también
+        snap_persona, snap_actor = persona, prev_actor
+    else:
+        # Asignación directa al actor (y desasigna persona)
+        inv.actor_id   = actor.id
+        inv.persona_id = None
+        snap_persona, snap_actor = None, actor
+
+    inv.asignado_a = entrante.nombre
+    inv.rol        = (rol_in if rol_in else (entrante.cargo or ""))
+    inv.estatus    = "Confirmado"
+
+    if comentario:
+        inv.observaciones = ((inv.observaciones or "") + (" | " if inv.observaciones else "") + comentario)
+
+    inv.fecha_asignacion     = datetime.utcnow()
+    inv.ultima_modificacion  = datetime.utcnow()
+    inv.modificado_por       = getattr(getattr(g, "user", None), "usuario", "atiapp")
+    # Mismo juego de columnas en cada UPDATE aunque el valor no cambie: el flush agrupa
+    # las filas de /api/assign/bulk en un solo executemany en lugar de un UPDATE por fila
+    for col in ("estatus", "asignado_a", "rol", "persona_id", "actor_id", "observaciones"):
+        flag_modified(inv, col)
+
+    # Notificaciones del ENTRANTE
+    deltas = [("Asignado A", prev_asig, inv.asignado_a)]
+    if (prev_rol or "") != (inv.rol or ""):
+        deltas.append(("Rol", prev_rol, inv.rol))
+    # ⚠️ ESTA es la que consume el bot (campo='Estatus' y valor_nuevo='Confirmado')
+    deltas.append(("Estatus", prev_estatus, "Confirmado"))
+
+    if NOTIF_COALESCE:
+        # Una sola fila: el encabezado es el delta de Estatus, el resto va en `cambios`
+        notif("Estatus", prev_estatus, "Confirmado", snap_persona, snap_actor,
+              cambios=[{"campo": c, "anterior": a or "", "nuevo": n or ""} for c, a, n in deltas])
+    else:
+        for campo, anterior, nuevo in deltas:
+            notif(campo, anterior, nuevo, snap_persona, snap_actor)
+
 @app.post("/api/assign")
 @auth_required(['admin'])
+@query_budget(10)
 def api_assign():
     data = request.get_json() or {}
 
@@ -1690,20 +3039,15 @@ def api_assign():
     db = SessionLocal()
     try:
         # Invitación
-        inv = db.query(Invitacion).filter(Invitacion.id == inv_id).first()
+        inv = db.query(Invitacion).options(*INV_RESPONSABLES).filter(Invitacion.id == inv_id).first()
         if not inv:
             return jsonify({"ok": False, "error": "Invitación no encontrada"}), 404
 
         # Guarda referencias previas (para snapshot del saliente y actor convocante)
-        prev_asig        = inv.asignado_a
-        prev_rol         = inv.rol
-        prev_estatus     = inv.estatus
-        prev_persona_id  = inv.persona_id
-        prev_actor_id    = inv.actor_id
-
-        prev_persona = db.get(Persona, prev_persona_id) if prev_persona_id else None
-        prev_actor   = db.get(Actor,   prev_actor_id)   if prev_actor_id   else None
+        prev_persona = db.get(Persona, inv.persona_id) if inv.persona_id else None
+        prev_actor   = db.get(Actor,   inv.actor_id)   if inv.actor_id   else None
 
+        p = a = None
         if persona_id_raw:
             # ========== Asignar PERSONA ==========
             try:
@@ -1714,113 +3058,6 @@ def api_assign():
             p = db.get(Persona, persona_id)
             if not p:
                 return jsonify({"ok": False, "error": "Persona no encontrada"}), 404
-
-            # Conflicto de agenda
-            # ===== Validación de agenda con duración, buffer y gap =====
-            if inv.fecha and inv.hora and not force:
-                # Trae eventos del mismo día para esa persona (excluye la propia invitación)
-                same_day = (
-                    db.query(Invitacion)
-                    .filter(Invitacion.persona_id == p.id)
-                    .filter(Invitacion.fecha == inv.fecha)
-                    .filter(Invitacion.estatus.in_(["Confirmado", "Sustituido"]))
-                    .filter(Invitacion.id != inv.id)
-                    .all()
-                )
-
-                inv_ini, inv_fin = _rango(inv)
-                if not inv_ini or not inv_fin:
-                    return jsonify({"ok": False, "error": "Falta hora para validar agenda"}), 400
-
-                chocan = []
-                for m in same_day:
-                    m_ini, m_fin = _rango(m)
-                    if _traslapan_con_gap(inv_ini, inv_fin, m_ini, m_fin):
-                        chocan.append(m)
-
-                if chocan:
-                    return jsonify({
-                        "ok": False,
-                        "error": "Conflicto de agenda (no hay suficiente separación entre eventos)",
-                        "detalles": [inv_to_dict(m) for m in chocan]
-                    }), 409
-            # ===== Fin validación =====
-
-            # Si había una persona previa distinta, registra SUSTITUIDO con snapshot del saliente
-            if prev_persona and prev_persona.id != p.id:
-                add_notif_for(
-                    db, inv,
-                    campo="Sustituido",
-                    valor_anterior=prev_asig or "",
-                    valor_nuevo=p.nombre or "",
-                    comentario=comentario,
-                    persona_obj=prev_persona,
-                    # el estatus que deseas congelar en esta notificación
-                    estatus_override="Sustituido"
-                )
-
-            # Actualiza asignación a persona (el actor convocante permanece en inv.actor_id)
-            inv.persona_id = p.id
-            inv.asignado_a = p.nombre
-            inv.rol        = (rol_in if rol_in else (p.cargo or ""))
-            inv.estatus    = "Confirmado"
-
-            if comentario:
-                inv.observaciones = ((inv.observaciones or "") + (" | " if inv.observaciones else "") + comentario)
-
-            inv.fecha_asignacion     = datetime.utcnow()
-            inv.ultima_modificacion  = datetime.utcnow()
-            inv.modificado_por       = getattr(getattr(g, "user", None), "usuario", "atiapp")
-
-            # Notificaciones del ENTRANTE (persona) — IMPORTANTE: incluir actor_obj=prev_actor
-            add_notif_for(
-                db, inv,
-                campo="Asignado A",
-                valor_anterior=prev_asig or "",
-                valor_nuevo=inv.asignado_a or "",
-                comentario=comentario,
-                persona_obj=p,
-                actor_obj=prev_actor,                 # ← para que llegue al actor también
-                estatus_override="Confirmado"
-            )
-
-            if (prev_rol or "") != (inv.rol or ""):
-                add_notif_for(
-                    db, inv,
-                    campo="Rol",
-                    valor_anterior=prev_rol or "",
-                    valor_nuevo=inv.rol or "",
-                    comentario=comentario,
-                    persona_obj=p,
-                    actor_obj=prev_actor,             # ← idem
-                    estatus_override="Confirmado"
-                )
-
-            # ⚠️ ESTA es la que consume el bot (campo='Estatus' y valor_nuevo='Confirmado')
-            add_notif_for(
-                db, inv,
-                campo="Estatus",
-                valor_anterior=(prev_estatus or ""),
-                valor_nuevo="Confirmado",
-                comentario=comentario,
-                persona_obj=p,
-                actor_obj=prev_actor,                 # ← CLAVE: teléfonos del actor en este snapshot
-                estatus_override="Confirmado"
-            )
-
-            # (Opcional) Snapshot informativo para auditoría (el bot NO lo usa)
-            # Manténlo si te sirve, pero no afecta envíos.
-            # if prev_actor_id:
-            #     add_notif_for(
-            #         db, inv,
-            #         campo="Asignado A (aviso a convoca)",
-            #         valor_anterior=prev_asig or "",
-            #         valor_nuevo=inv.asignado_a or "",
-            #         comentario=comentario,
-            #         actor_obj=prev_actor,
-            #         estatus_override=inv.estatus
-            #     )
-
         else:
             # ========== Asignar ACTOR ==========
             try:
@@ -1832,67 +3069,158 @@ def api_assign():
             if not a:
                 return jsonify({"ok": False, "error": "Actor no encontrado"}), 404
 
-            # Si había persona previa, déjala como SUSTITUIDA
-            if prev_persona:
-                add_notif_for(
-                    db, inv,
-                    campo="Sustituido",
-                    valor_anterior=prev_asig or "",
-                    valor_nuevo=a.nombre or "",
-                    comentario=comentario,
-                    persona_obj=prev_persona,
-                    estatus_override="Sustituido"
-                )
-
-            # Actualiza asignación al actor (y desasigna persona)
-            inv.actor_id   = a.id
-            inv.persona_id = None
-            inv.asignado_a = a.nombre
-            inv.rol        = (rol_in if rol_in else (a.cargo or ""))
-            inv.estatus    = "Confirmado"
+        # ===== Validación de agenda con duración, buffer y gap (misma regla para persona y actor) =====
+        if inv.fecha and inv.hora and not force:
+            chocan = (agenda_conflicts(db, inv, persona_id=p.id) if p is not None
+                      else agenda_conflicts(db, inv, actor_id=a.id))
+            if chocan:
+                return jsonify({
+                    "ok": False,
+                    "error": "Conflicto de agenda (no hay suficiente separación entre eventos)",
+                    "detalles": [inv_to_dict(m) for m in chocan]
+                }), 409
+
+        _apply_assignment(
+            db, inv, lambda d: db.add(Notificacion(**d)),
+            persona=p, actor=a, rol_in=rol_in, comentario=comentario,
+            prev_persona=prev_persona, prev_actor=prev_actor,
+        )
 
-            if comentario:
-                inv.observaciones = ((inv.observaciones or "") + (" | " if inv.observaciones else "") + comentario)
+        db.commit()
+        return jsonify({"ok": True})
 
-            inv.fecha_asignacion     = datetime.utcnow()
-            inv.ultima_modificacion  = datetime.utcnow()
-            inv.modificado_por       = getattr(getattr(g, "user", None), "usuario", "atiapp")
+    except Exception as e:
+        db.rollback()
+        return jsonify({"ok": False, "error": str(e)}), 500
+    finally:
+        db.close()
 
-            # Notifs del ENTRANTE (actor)
-            add_notif_for(
-                db, inv,
-                campo="Asignado A",
-                valor_anterior=prev_asig or "",
-                valor_nuevo=inv.asignado_a or "",
-                comentario=comentario,
-                actor_obj=a,
-                estatus_override="Confirmado"
-            )
+@app.post("/api/assign/bulk")
+@auth_required(['admin'])
+@query_budget(12)
+def api_assign_bulk():
+    """
+    Asignación masiva en una sola transacción.
+    Body: {"items": [{"id", "persona_id" | "actor_id", "rol"?, "comentario"?, "force"?}, ...], "force"?}
+    Invitaciones, personas, actores y agendas se cargan con pocas consultas IN; cada item se
+    valida contra la BD y contra los items previos del mismo lote. Las notificaciones se
+    escriben con INSERT multi-fila. Un item que falla (400/404/409) no aborta el lote.
+    """
+    data = request.get_json() or {}
+    items = data.get("items")
+    if not isinstance(items, list) or not items:
+        return jsonify({"ok": False, "error": "items debe ser una lista no vacía"}), 400
+    if len(items) > BULK_ASSIGN_MAX:
+        return jsonify({"ok": False, "error": f"Máximo {BULK_ASSIGN_MAX} items por lote"}), 400
+    force_all = bool(data.get("force", False))
+
+    results = [None] * len(items)
+
+    def fail(i, inv_id, status, error):
+        results[i] = {"index": i, "id": inv_id, "ok": False, "status": status, "error": error}
+
+    # ---- Validación de forma (sin BD) ----
+    parsed = []
+    for i, it in enumerate(items):
+        if not isinstance(it, dict):
+            fail(i, None, 400, "item inválido"); continue
+        inv_id = str(it.get("id") or "").strip()
+        if not inv_id:
+            fail(i, None, 400, "id inválido"); continue
+        persona_id_raw, actor_id_raw = it.get("persona_id"), it.get("actor_id")
+        if not persona_id_raw and not actor_id_raw:
+            fail(i, inv_id, 400, "Falta persona_id o actor_id"); continue
+        try:
+            persona_id = int(persona_id_raw) if persona_id_raw else None
+            actor_id   = None if persona_id else int(actor_id_raw)
+        except (TypeError, ValueError):
+            fail(i, inv_id, 400, "persona_id inválido" if persona_id_raw else "actor_id inválido"); continue
+        parsed.append((i, inv_id, persona_id, actor_id,
+                       (it.get("rol") or "").strip(),
+                       (it.get("comentario") or "").strip(),
+                       force_all or bool(it.get("force", False))))
 
-            if (prev_rol or "") != (inv.rol or ""):
-                add_notif_for(
-                    db, inv,
-                    campo="Rol",
-                    valor_anterior=prev_rol or "",
-                    valor_nuevo=inv.rol or "",
-                    comentario=comentario,
-                    actor_obj=a,
-                    estatus_override="Confirmado"
-                )
-
-            # ⚠️ ESTA dispara el bot (igual que en persona)
-            add_notif_for(
-                db, inv,
-                campo="Estatus",
-                valor_anterior=(prev_estatus or ""),
-                valor_nuevo="Confirmado",
-                comentario=comentario,
-                actor_obj=a,
-                estatus_override="Confirmado"
+    db = SessionLocal()
+    try:
+        # ---- Carga en bloque ----
+        inv_ids = {x[1] for x in parsed}
+        invs = {inv.id: inv for inv in db.query(Invitacion).filter(Invitacion.id.in_(inv_ids))} if inv_ids else {}
+
+        dest_personas = {x[2] for x in parsed if x[2]}
+        dest_actores  = {x[3] for x in parsed if x[3]}
+        persona_ids = dest_personas | {inv.persona_id for inv in invs.values() if inv.persona_id}
+        actor_ids   = dest_actores  | {inv.actor_id   for inv in invs.values() if inv.actor_id}
+        personas = {p.id: p for p in db.query(Persona).filter(Persona.id.in_(persona_ids))} if persona_ids else {}
+        actores  = {a.id: a for a in db.query(Actor).filter(Actor.id.in_(actor_ids))} if actor_ids else {}
+
+        agendas = load_agendas(db, {inv.fecha for inv in invs.values() if inv.fecha},
+                               persona_ids=dest_personas, actor_ids=dest_actores)
+
+        # ---- Aplicación item por item ----
+        notifs, conflictos = [], {}
+        for (i, inv_id, persona_id, actor_id, rol_in, comentario, force) in parsed:
+            inv = invs.get(inv_id)
+            if inv is None:
+                fail(i, inv_id, 404, "Invitación no encontrada"); continue
+            if persona_id:
+                p, a = personas.get(persona_id), None
+                if p is None:
+                    fail(i, inv_id, 404, "Persona no encontrada"); continue
+                key = ("persona", p.id, inv.fecha)
+            else:
+                p, a = None, actores.get(actor_id)
+                if a is None:
+                    fail(i, inv_id, 404, "Actor no encontrado"); continue
+                key = ("actor", a.id, inv.fecha)
+
+            if inv.fecha and inv.hora and not force and key in agendas:
+                inv_ini, inv_fin = _rango(inv)
+                chocan = agendas[key].conflicts(inv_ini, inv_fin, exclude_id=inv.id)
+                if chocan:
+                    fail(i, inv_id, 409, "Conflicto de agenda (no hay suficiente separación entre eventos)")
+                    conflictos[i] = chocan
+                    continue
+
+            # Sale de la agenda del responsable anterior (si está cargada) antes de reasignar
+            prev_key = (("persona", inv.persona_id, inv.fecha) if inv.persona_id
+                        else ("actor", inv.actor_id, inv.fecha))
+            if prev_key in agendas:
+                agendas[prev_key].discard(inv.id)
+
+            _apply_assignment(
+                db, inv, notifs.append,
+                persona=p, actor=a, rol_in=rol_in, comentario=comentario,
+                prev_persona=personas.get(inv.persona_id) if inv.persona_id else None,
+                prev_actor=actores.get(inv.actor_id) if inv.actor_id else None,
             )
 
+            # Entra a la agenda del nuevo responsable: los items siguientes la ven
+            inv_ini, inv_fin = _rango(inv)
+            if inv_ini:
+                agendas.setdefault(key, DayAgenda()).add(inv.id, inv_ini, inv_fin)
+            results[i] = {"index": i, "id": inv_id, "ok": True, "status": 200}
+
+        # ---- Detalle de conflictos (una sola consulta) ----
+        if conflictos:
+            ids = {x for chocan in conflictos.values() for x in chocan}
+            by_id = {m.id: m for m in db.query(Invitacion).options(*INV_DICT_LOAD).filter(Invitacion.id.in_(ids))}
+            for i, chocan in conflictos.items():
+                ms = sorted((by_id[x] for x in chocan if x in by_id), key=lambda m: m.hora or dtime.min)
+                results[i]["detalles"] = [inv_to_dict(m) for m in ms]
+
+        # ---- Notificaciones: INSERT ... VALUES multi-fila ----
+        for k in range(0, len(notifs), NOTIF_INSERT_CHUNK):
+            db.execute(insert(Notificacion.__table__).values(notifs[k:k + NOTIF_INSERT_CHUNK]))
+
         db.commit()
-        return jsonify({"ok": True})
+        aplicados = sum(1 for r in results if r["ok"])
+        return jsonify({
+            "ok": True,
+            "aplicados": aplicados,
+            "fallidos": len(results) - aplicados,
+            "notificaciones": len(notifs),
+            "results": results,
+        })
 
     except Exception as e:
         db.rollback()
@@ -1906,20 +3234,14 @@ def api_assign():
 # Helpers de snapshot
 # ================================
 def _sexo_nombre(db, sexo_id):
-    if not sexo_id:
-        return None
-    try:
-        # Asume modelo Sexo(id, nombre)
-        s = db.query(Sexo).get(int(sexo_id))
-        return s.nombre if s else None
-    except Exception:
-        return None
+    # Desde el caché de catálogos; `db` se conserva por compatibilidad de firma
+    return catalog_cache.sexo_nombre(sexo_id)
 
 def _only_digits(s):
     return "".join(ch for ch in (s or "") if ch.isdigit())
 
 # -- NUEVO: snapshot usando persona/actor "forzado" (saliente o entrante)
-def add_notif_for(
+def notif_snapshot(
     db,
     inv,                       # Invitacion
     campo,                     # str (usa "Estatus" para bot)
@@ -1928,18 +3250,10 @@ def add_notif_for(
     comentario=None,           # str | None
     persona_obj=None,          # Persona | None
     actor_obj=None,            # Actor | None
-    estatus_override=None      # str | None (p.ej. "Confirmado" o "Sustituido")
+    estatus_override=None,     # str | None (p.ej. "Confirmado" o "Sustituido")
+    cambios=None               # list[dict] | None (modo coalescido, ver NOTIF_COALESCE)
 ):
     # Helpers locales
-    def _sexo_nombre(db, sexo_id):
-        if not sexo_id:
-            return None
-        try:
-            s = db.query(Sexo).get(int(sexo_id))
-            return s.nombre if s else None
-        except Exception:
-            return None
-
     def _only_digits(s):
         return "".join(ch for ch in (s or "") if ch and str(ch).isdigit())
 
@@ -1971,7 +3285,9 @@ def add_notif_for(
         raw_p_ptel          = getattr(persona_obj, "particular_tel",    None)
         persona_part_tel    = _only_digits(raw_p_ptel) if raw_p_ptel else None
 
-    notif = Notificacion(
+    # Valores de columna de notificaciones (sirve para Notificacion(**d) o para insert multi-fila)
+    return dict(
+        ts                  = datetime.utcnow(),
         invitacion_id       = str(inv.id),
 
         # Qué cambió
@@ -2010,238 +3326,375 @@ def add_notif_for(
 
         enviado             = False,
         enviado_ts          = None,
+        cambios             = (json.dumps(cambios, ensure_ascii=False) if cambios else None),
     )
-    db.add(notif)
+
+def add_notif_for(db, inv, campo, valor_anterior, valor_nuevo, comentario=None,
+                  persona_obj=None, actor_obj=None, estatus_override=None):
+    db.add(Notificacion(**notif_snapshot(
+        db, inv, campo, valor_anterior, valor_nuevo, comentario,
+        persona_obj=persona_obj, actor_obj=actor_obj, estatus_override=estatus_override,
+    )))
 
 
 
        
+def notif_to_dict(n) -> dict:
+    # Sirve para objetos ORM y para filas de RETURNING (mismos nombres de columna)
+    return {
+        "id": n.id,
+        "ts": n.ts.isoformat() if n.ts else None,
+        "campo": n.campo,
+        "valor_anterior": n.valor_anterior,
+        "valor_nuevo": n.valor_nuevo,
+        "comentario": n.comentario,
+        "evento": n.evento,
+        "convoca": n.convoca,
+        "estatus": n.estatus,
+        "asignado_a_nombre": n.asignado_a_nombre,
+        "rol": n.rol,
+        "fecha": n.fecha.isoformat() if n.fecha else None,
+        "hora": n.hora.isoformat() if n.hora else None,
+        "municipio": n.municipio,
+        "lugar": n.lugar,
+        "convoca_cargo": n.convoca_cargo,
+        "actor_nombre": n.actor_nombre,
+        "actor_cargo": n.actor_cargo,
+        "actor_tel": n.actor_tel,
+        "actor_sexo": n.actor_sexo,
+        "actor_particular_nombre": n.actor_particular_nombre,
+        "actor_particular_cargo": n.actor_particular_cargo,
+        "actor_particular_tel": n.actor_particular_tel,
+        "persona_tel": n.persona_tel,
+        "persona_sexo": n.persona_sexo,
+        "persona_particular_nombre": n.persona_particular_nombre,
+        "persona_particular_cargo": n.persona_particular_cargo,
+        "persona_particular_tel": n.persona_particular_tel,
+        "enviado": n.enviado,
+        "enviado_ts": n.enviado_ts.isoformat() if n.enviado_ts else None,
+        "cambios": json.loads(n.cambios) if n.cambios else None,
+        "archivada": bool(getattr(n, "archivada", False))
+    }
+
 @app.get("/api/notificaciones/<inv_id>")
 @auth_required(['admin'])
+@query_budget(2)
 def api_notif_by_inv(inv_id):
+    """?historial=1 agrega las notificaciones archivadas (UNION ALL con notificaciones_archivo)."""
+    historial = (request.args.get("historial") or "").strip().lower() in {"1", "true", "si", "sí"}
     db = SessionLocal()
     try:
-        rows = (db.query(Notificacion)
-                  .filter(Notificacion.invitacion_id == str(inv_id))
-                  .order_by(Notificacion.ts.desc())
-                  .all())
-        out = []
-        for n in rows:
-            out.append({
-                "id": n.id,
-                "ts": n.ts.isoformat() if n.ts else None,
-                "campo": n.campo,
-                "valor_anterior": n.valor_anterior,
-                "valor_nuevo": n.valor_nuevo,
-                "comentario": n.comentario,
-                "evento": n.evento,
-                "convoca": n.convoca,
-                "estatus": n.estatus,
-                "asignado_a_nombre": n.asignado_a_nombre,
-                "rol": n.rol,
-                "fecha": n.fecha.isoformat() if n.fecha else None,
-                "hora": n.hora.isoformat() if n.hora else None,
-                "municipio": n.municipio,
-                "lugar": n.lugar,
-                "convoca_cargo": n.convoca_cargo,
-                "actor_nombre": n.actor_nombre,
-                "actor_cargo": n.actor_cargo,
-                "actor_tel": n.actor_tel,
-                "actor_sexo": n.actor_sexo,
-                "actor_particular_nombre": n.actor_particular_nombre,
-                "actor_particular_cargo": n.actor_particular_cargo,
-                "actor_particular_tel": n.actor_particular_tel,
-                "persona_tel": n.persona_tel,
-                "persona_sexo": n.persona_sexo,
-                "persona_particular_nombre": n.persona_particular_nombre,
-                "persona_particular_cargo": n.persona_particular_cargo,
-                "persona_particular_tel": n.persona_particular_tel,
-                "enviado": n.enviado,
-                "enviado_ts": n.enviado_ts.isoformat() if n.enviado_ts else None
-            })
-        return jsonify(out)
+        if not historial:
+            N = Notificacion.__table__
+            rows = read_rows(db, select(N).where(N.c.invitacion_id == str(inv_id)).order_by(N.c.ts.desc()))
+        else:
+            N, A = Notificacion.__table__, NotificacionArchivo
+            stmt = union_all(
+                select(*N.columns, literal_column("0").label("archivada")).where(N.c.invitacion_id == str(inv_id)),
+                select(*A.columns, literal_column("1").label("archivada")).where(A.c.invitacion_id == str(inv_id)),
+            )
+            rows = db.execute(stmt.order_by(stmt.selected_columns.ts.desc())).all()
+        return jsonify([notif_to_dict(n) for n in rows])
     finally:
         db.close()
-        
-from sqlalchemy import text
-import unicodedata
 
+# =============================================================================
+# Cola de notificaciones para el bot (lease + ack)
+# =============================================================================
+# El bot entra como cualquier cliente: POST /api/auth/login con un usuario admin y la
+# cookie de sesión en cada llamada.
+NOTIF_LEASE_SEC   = int(os.getenv("NOTIF_LEASE_SEC", "120"))    # si el bot muere, la fila vuelve a la cola
+NOTIF_CLAIM_MAX   = int(os.getenv("NOTIF_CLAIM_MAX", "500"))
+
+@app.post("/api/notificaciones/claim")
+@auth_required(['admin'])
+@query_budget(2)
+def api_notif_claim():
+    """
+    Toma en préstamo hasta `limit` notificaciones no enviadas (más antiguas primero) durante
+    `lease` segundos. Postgres: UPDATE ... WHERE id IN (SELECT ... FOR UPDATE SKIP LOCKED),
+    así varios bots no se pisan. SQLite: el mismo UPDATE ... RETURNING, atómico porque SQLite
+    serializa escritores. Una fila con lease vencido se puede volver a tomar.
+    """
+    try:
+        limit = int(request.args.get("limit", 50))
+        lease = int(request.args.get("lease", NOTIF_LEASE_SEC))
+    except ValueError:
+        return jsonify({"ok": False, "error": "limit/lease inválidos"}), 400
+    limit = max(1, min(limit, NOTIF_CLAIM_MAX))
+    lease = max(1, min(lease, 3600))
+    consumer = (request.args.get("consumer") or "").strip()[:64] or uuid4().hex
+
+    now = datetime.utcnow()
+    until = now + timedelta(seconds=lease)
+    N = Notificacion
+    pendientes = (select(N.id)
+                  .where(N.enviado == False,
+                         or_(N.lease_until.is_(None), N.lease_until < now))
+                  .order_by(N.id)
+                  .limit(limit))
+    if _IS_PG:
+        pendientes = pendientes.with_for_update(skip_locked=True)
+
+    db = SessionLocal()
+    try:
+        rows = db.execute(
+            update(N.__table__)
+            .where(N.id.in_(pendientes))
+            .values(lease_owner=consumer, lease_until=until)
+            .returning(*N.__table__.columns)
+        ).all()
+        db.commit()
+        rows.sort(key=lambda r: r.id)
+        return jsonify({
+            "ok": True,
+            "consumer": consumer,
+            "lease_until": until.isoformat(),
+            "items": [notif_to_dict(r) for r in rows],
+        })
+    except Exception as e:
+        db.rollback()
+        return jsonify({"ok": False, "error": str(e)}), 500
+    finally:
+        db.close()
+
+# ===== Retención: enviadas con más de NOTIF_RETENTION_DAYS pasan a notificaciones_archivo =====
+NOTIF_RETENTION_DAYS      = int(os.getenv("NOTIF_RETENTION_DAYS", "90"))
+NOTIF_ARCHIVE_EVERY_SEC   = int(os.getenv("NOTIF_ARCHIVE_EVERY_SEC", "3600"))   # 0 = sin hilo de fondo
+NOTIF_ARCHIVE_BATCH       = int(os.getenv("NOTIF_ARCHIVE_BATCH", "1000"))
+NOTIF_ARCHIVE_MAX_BATCHES = int(os.getenv("NOTIF_ARCHIVE_MAX_BATCHES", "100"))  # por pasada
+NOTIF_ARCHIVE_PAUSE       = float(os.getenv("NOTIF_ARCHIVE_PAUSE", "0.2"))      # entre lotes
+
+_archiver_started = False
+_archiver_lock = threading.Lock()
+_archiver_stats = {"ultima": None, "movidas_total": 0, "error": None}
+
+def archive_pass(max_batches=NOTIF_ARCHIVE_MAX_BATCHES) -> int:
+    try:
+        n = archive_notificaciones(engine, NOTIF_RETENTION_DAYS, NOTIF_ARCHIVE_BATCH,
+                                   max_batches=max_batches, pause=NOTIF_ARCHIVE_PAUSE)
+        _archiver_stats.update(ultima=datetime.utcnow().isoformat(), error=None)
+        _archiver_stats["movidas_total"] += n
+        return n
+    except Exception as e:
+        _archiver_stats.update(ultima=datetime.utcnow().isoformat(), error=str(e))
+        raise
+
+def _archive_forever():
+    while True:
+        # jitter para que los workers no arranquen juntos (el lock de Postgres igual los serializa)
+        time.sleep(NOTIF_ARCHIVE_EVERY_SEC * (0.9 + 0.2 * random.random()))
+        try:
+            archive_pass()
+        except Exception as e:
+            print(f"⚠️ Archivo de notificaciones: {e}")
+
+@app.before_request
+def _ensure_notif_archiver():
+    global _archiver_started
+    if _archiver_started or NOTIF_ARCHIVE_EVERY_SEC <= 0:
+        return
+    with _archiver_lock:
+        if not _archiver_started:
+            threading.Thread(target=_archive_forever, name="notif-archiver", daemon=True).start()
+            _archiver_started = True
+
+@app.post("/api/notificaciones/archivar")
+@auth_required(['admin'])
+@query_budget(3 * NOTIF_ARCHIVE_MAX_BATCHES + 4, repeat=NOTIF_ARCHIVE_MAX_BATCHES + 1)
+def api_notif_archivar():
+    """Corre una pasada de archivo ahora (acotada a NOTIF_ARCHIVE_MAX_BATCHES lotes)."""
+    try:
+        n = archive_pass()
+    except Exception as e:
+        return jsonify({"ok": False, "error": str(e)}), 500
+    return jsonify({"ok": True, "movidas": n, "horizonte_dias": NOTIF_RETENTION_DAYS, **_archiver_stats})
+
+@app.post("/api/notificaciones/ack")
+@auth_required(['admin'])
+@query_budget(2)
+def api_notif_ack():
+    """
+    Body: {"ids": [...], "consumer"?: str, "liberar"?: [...]}
+    `ids` se marcan enviado/enviado_ts en un solo UPDATE; `liberar` devuelve a la cola
+    (fallos de envío) sin esperar a que venza el lease. Con `consumer`, sólo afecta filas
+    cuyo lease sigue siendo suyo.
+    """
+    data = request.get_json() or {}
+    try:
+        ids     = [int(x) for x in (data.get("ids") or [])]
+        liberar = [int(x) for x in (data.get("liberar") or [])]
+    except (TypeError, ValueError):
+        return jsonify({"ok": False, "error": "ids inválidos"}), 400
+    if not ids and not liberar:
+        return jsonify({"ok": False, "error": "Faltan ids"}), 400
+    consumer = (data.get("consumer") or "").strip()
+
+    N = Notificacion
+    def _mine(stmt, id_list):
+        stmt = stmt.where(N.id.in_(id_list), N.enviado == False)
+        return stmt.where(N.lease_owner == consumer) if consumer else stmt
+
+    db = SessionLocal()
+    try:
+        enviados = liberados = 0
+        if ids:
+            enviados = db.execute(_mine(update(N.__table__), ids).values(
+                enviado=True, enviado_ts=datetime.utcnow(), lease_owner=None, lease_until=None
+            )).rowcount
+        if liberar:
+            liberados = db.execute(_mine(update(N.__table__), liberar).values(
+                lease_owner=None, lease_until=None
+            )).rowcount
+        db.commit()
+        return jsonify({"ok": True, "enviados": enviados, "liberados": liberados})
+    except Exception as e:
+        db.rollback()
+        return jsonify({"ok": False, "error": str(e)}), 500
+    finally:
+        db.close()
+
+
+
+EXPORT_COLUMNS = [
+    "Municipio",
+    "Región",
+    "Partido Político",
+    "Quien Convoca/Actor",
+    "Cargo Actor",
+    "Asignado/Persona",
+    "Cargo Persona",
+    "Unidad/Región",
+    "Fecha",
+    "Lugar",
+    "Hora",
+    "Quien convoca",
+]
+EXPORT_BATCH_SIZE = int(os.getenv("EXPORT_BATCH_SIZE", "1000"))
+EXPORT_SPOOL_MAX  = int(os.getenv("EXPORT_SPOOL_MAX", str(8 * 1024 * 1024)))  # bytes en RAM antes de ir a disco
+
+def _xl_date(d): return d.strftime("%Y-%m-%d") if d else ""
+def _xl_time(t): return t.strftime("%H:%M") if t else ""
+
+def export_row(row, region_names: dict, unmatched: dict) -> list:
+    """
+    Fila del xlsx (orden de EXPORT_COLUMNS) para una tupla de la consulta del export.
+    Anota en `unmatched` los municipios sin región para la hoja de diagnóstico.
+    """
+    (municipio, partido, fecha, hora, lugar, convoca,
+     per_nombre, per_cargo, per_unidad, per_region_id,
+     act_nombre, act_cargo) = row
+    municipio_raw = (municipio or "").strip()
+
+    region_id = None
+    region_nombre = None
+
+    # 1-3) match exacto normalizado, luego casi-coincidencias / contención
+    ids = municipio_resolver.region_ids(municipio_raw)
+    if ids:
+        region_id = ids[0]
+        region_nombre = region_names.get(region_id)
+
+    # 4) fallback: si persona asignada tiene region_id, usarlo
+    if region_id is None and per_region_id:
+        region_id = int(per_region_id)
+        region_nombre = region_names.get(region_id)
+
+    # 5) si aún no hay region_nombre, intentar unidad_region textual de persona
+    if not region_nombre and per_unidad:
+        region_nombre = per_unidad
+
+    # registrar unmatched para diagnóstico si no encontramos region
+    if not region_nombre:
+        muni_norm = normalize_muni(municipio_raw)
+        if muni_norm not in unmatched:
+            unmatched[muni_norm] = set()
+        unmatched[muni_norm].add(municipio_raw)
+
+    return [
+        municipio_raw or "",        # Municipio
+        region_nombre or "",        # Región
+        partido or "",              # Partido Político
+        act_nombre or "",           # Quien Convoca/Actor
+        act_cargo or "",            # Cargo Actor
+        per_nombre or "",           # Asignado/Persona
+        per_cargo or "",            # Cargo Persona
+        per_unidad or "",           # Unidad/Región
+        _xl_date(fecha),            # Fecha
+        lugar or "",                # Lugar
+        _xl_time(hora),             # Hora
+        convoca or "",              # Quien convoca
+    ]
 
 @app.get("/api/report/confirmados.xlsx")
 @auth_required(['admin','viewer'])
+@query_budget(4)
 def api_export_invitaciones_xlsx():
     """
     Exporta invitaciones e intenta mapear municipio -> región (columna "Región").
     Matching strategy:
-      - normaliza both sides (lower, quitar tildes, collapse spaces)
-      - exact match by normalized name
-      - contains / startsWith fallback
+      - municipio_resolver: match exacto normalizado (sin tildes, espacios colapsados)
+      - casi-coincidencias por trigramas / contención de palabra completa
+      - fallback a la región / unidad_region de la persona asignada
       - reportar municipios no mapeados para que puedas revisar
+    Las filas se leen con yield_per y se escriben a un libro write-only de openpyxl
+    sobre un SpooledTemporaryFile: la memoria no crece con el tamaño de la tabla.
     """
     db = SessionLocal()
     try:
-        def normalize_name(s):
-            if not s:
-                return ""
-            s = str(s).strip().lower()
-            s = unicodedata.normalize('NFD', s)
-            s = ''.join(ch for ch in s if not unicodedata.combining(ch))
-            s = ' '.join(s.split())
-            return s
-
         # --- cargar regiones (nombre por id) ---
         region_names = {}
         try:
-            regs = db.query(Region).all()
-            for r in regs:
-                region_names[getattr(r, 'id')] = getattr(r, 'nombre', '') or ''
+            regs = db.query(Region.id, Region.nombre).all()
+            for rid, rnombre in regs:
+                region_names[rid] = rnombre or ''
         except Exception:
             region_names = {}
 
-        # --- construir mapeo municipio_normalizado -> region_id leyendo la tabla region_municipios ---
-        muni_to_region = {}
-        try:
-            # lee filas si la tabla existe
-            q = text("SELECT region_id, municipio FROM region_municipios")
-            rows = db.execute(q).fetchall()
-            for row in rows:
-                # row puede ser RowMapping o tuple
-                try:
-                    region_id = row['region_id'] if 'region_id' in row.keys() else row[0]
-                    muni_raw  = row['municipio']   if 'municipio'   in row.keys() else row[1]
-                except Exception:
-                    # fallback tuple
-                    region_id = row[0]
-                    muni_raw = row[1]
-                key = normalize_name(muni_raw)
-                if key:
-                    muni_to_region[key] = int(region_id) if region_id is not None else None
-        except Exception:
-            # tabla no existe o error -> mapa vacío
-            muni_to_region = {}
+        # --- municipio -> región: índice compartido (exacto normalizado + casi-coincidencias) ---
+        municipio_resolver.ensure_loaded(db)
 
-        # --- Traer invitaciones (con persona y actor) ---
+        # --- Traer invitaciones (sólo columnas usadas, en lotes; no hidrata ORM) ---
         rows = (
-            db.query(Invitacion, Persona, Actor)
+            db.query(
+                Invitacion.municipio, Invitacion.partido_politico, Invitacion.fecha,
+                Invitacion.hora, Invitacion.lugar, Invitacion.convoca,
+                Persona.nombre, Persona.cargo, Persona.unidad_region, Persona.region_id,
+                Actor.nombre, Actor.cargo,
+            )
               .outerjoin(Persona, Persona.id == Invitacion.persona_id)
               .outerjoin(Actor,   Actor.id   == Invitacion.actor_id)
               .order_by(Invitacion.fecha.asc().nulls_last(),
                         Invitacion.hora.asc().nulls_last(),
                         Invitacion.id.asc())
-              .all()
+              .yield_per(EXPORT_BATCH_SIZE)
         )
 
-        def fmt_d(d): return d.strftime("%Y-%m-%d") if d else ""
-        def fmt_t(t): return t.strftime("%H:%M") if t else ""
-
-        out = []
         unmatched = {}  # muni_norm -> set of raw municipality examples (to inspect)
-        # Precompute sorted keys for fuzzy checks (longer keys first to prefer specific names)
-        muni_keys = sorted(muni_to_region.keys(), key=lambda x: -len(x))
-
-        for inv, per, act in rows:
-            municipio_raw = (inv.municipio or "").strip()
-            muni_norm = normalize_name(municipio_raw)
-
-            region_id = None
-            region_nombre = None
-
-            # 1) match exact
-            if muni_norm and muni_norm in muni_to_region:
-                region_id = muni_to_region[muni_norm]
-                region_nombre = region_names.get(region_id) if region_id is not None else None
-
-            # 2) fallback: buscar key del mapa que contenga muni_norm (preferir claves largas)
-            if region_id is None and muni_norm:
-                for k in muni_keys:
-                    # si el key contiene el valor normalizado (ej. "toluca" in "municipio de toluca")
-                    if k.find(muni_norm) != -1:
-                        region_id = muni_to_region.get(k)
-                        region_nombre = region_names.get(region_id) if region_id is not None else None
-                        break
-
-            # 3) fallback inverso: la muni_norm contiene alguna key (ej. muni_norm "san mateo atenco" contiene "mateo atenco")
-            if region_id is None and muni_norm:
-                for k in muni_keys:
-                    if muni_norm.find(k) != -1:
-                        region_id = muni_to_region.get(k)
-                        region_nombre = region_names.get(region_id) if region_id is not None else None
-                        break
-
-            # 4) fallback: si persona asignada tiene region_id, usarlo
-            if region_id is None and per is not None:
-                try:
-                    rpid = getattr(per, "region_id", None)
-                    if rpid:
-                        region_id = int(rpid)
-                        region_nombre = region_names.get(region_id) if region_id is not None else None
-                except Exception:
-                    pass
 
-            # 5) si aún no hay region_nombre, intentar unidad_region textual de persona
-            if not region_nombre and per is not None:
-                unidad_txt = getattr(per, "unidad_region", None)
-                if unidad_txt:
-                    region_nombre = unidad_txt
+        # Libro write-only: cada fila se serializa al agregarla; nada se acumula en memoria
+        wb = Workbook(write_only=True)
+        ws = wb.create_sheet("Invitaciones")
+        ws.append(EXPORT_COLUMNS)
 
-            # registrar unmatched para diagnóstico si no encontramos region
-            if not region_nombre:
-                if muni_norm not in unmatched:
-                    unmatched[muni_norm] = set()
-                unmatched[muni_norm].add(municipio_raw)
-
-            out.append({
-                "Municipio":             municipio_raw or "",
-                "Región":                region_nombre or "",
-                "Partido Político":      inv.partido_politico or "",
-                "Quien Convoca/Actor":   (act.nombre if act else "") or "",
-                "Cargo Actor":           (act.cargo  if act else "") or "",
-                "Asignado/Persona":      (per.nombre if per else "") or "",
-                "Cargo Persona":         (per.cargo  if per else "") or "",
-                "Unidad/Región":         (getattr(per, "unidad_region", None) or "") or "",
-                "Fecha":                 fmt_d(inv.fecha),
-                "Lugar":                 inv.lugar or "",
-                "Hora":                  fmt_t(inv.hora),
-                "Quien convoca":         inv.convoca or "",
-            })
+        for row in rows:
+            ws.append(export_row(row, region_names, unmatched))
 
-        # --- Crear DataFrame principal ---
-        df = pd.DataFrame(out, columns=[
-            "Municipio",
-            "Región",
-            "Partido Político",
-            "Quien Convoca/Actor",
-            "Cargo Actor",
-            "Asignado/Persona",
-            "Cargo Persona",
-            "Unidad/Región",
-            "Fecha",
-            "Lugar",
-            "Hora",
-            "Quien convoca",
-        ])
-
-        # --- (Opcional) generar hoja con municipios no mapeados para diagnosticar ---
-        # convierte unmatched sets a lista ordenada
-        unmatched_list = []
-        for k, s in unmatched.items():
-            unmatched_list.append({
-                "municipio_normalizado": k,
-                "ejemplos_raw": "; ".join(sorted(s))
-            })
-        df_unmatched = pd.DataFrame(unmatched_list)
+        # --- (Opcional) hoja con municipios no mapeados para diagnosticar ---
+        if unmatched:
+            ws_un = wb.create_sheet("Municipios_no_mapeados")
+            ws_un.append(["municipio_normalizado", "ejemplos_raw"])
+            for k, ejemplos in unmatched.items():
+                ws_un.append([k, "; ".join(sorted(ejemplos))])
 
-        bio = BytesIO()
-        with pd.ExcelWriter(bio, engine="openpyxl") as writer:
-            df.to_excel(writer, index=False, sheet_name="Invitaciones")
-            # solo escribe hoja de unmatched si hay datos
-            if not df_unmatched.empty:
-                df_unmatched.to_excel(writer, index=False, sheet_name="Municipios_no_mapeados")
-        bio.seek(0)
+        # Archivo temporal en memoria que pasa a disco si crece; se envía por bloques
+        out = tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_MAX)
+        wb.save(out)
+        out.seek(0)
 
         filename = f"invitaciones_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx"
         return send_file(
-            bio,
+            out,
             mimetype="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
             as_attachment=True,
             download_name=filename
@@ -2256,6 +3709,7 @@ def api_export_invitaciones_xlsx():
 # GET /api/invitaciones/updates?since=2025-11-12T10:00:00
 @app.get("/api/invitaciones/updates")
 @auth_required(['admin'])
+@query_budget(2)
 def api_invitaciones_updates():
     from datetime import datetime as dt
     since = (request.args.get("since") or "").strip()
@@ -2266,7 +3720,7 @@ def api_invitaciones_updates():
 
     db = SessionLocal()
     try:
-        q = db.query(Invitacion)
+        q = db.query(Invitacion).options(*INV_DICT_LOAD)
         if since_dt:
             q = q.filter(Invitacion.ultima_modificacion > since_dt)
         rows = (q.order_by(Invitacion.ultima_modificacion.desc())
@@ -2277,21 +3731,799 @@ def api_invitaciones_updates():
     finally:
         db.close()
 
+# =============================================================================
+# Push de cambios (Server-Sent Events)
+# =============================================================================
+# Cada worker tiene un EventHub. Los eventos se generan al hacer flush de Invitacion
+# y se publican sólo si la transacción hace commit. En Postgres viajan por
+# pg_notify para que lleguen a todos los workers con el mismo id (Last-Event-ID
+# sirve aunque el cliente reconecte a otro worker); en otros motores se publican
+# sólo en el proceso local. El id es un token opaco, no un orden: los eventos llegan
+# al backlog en orden de commit y la reanudación reenvía lo que está *después* de
+# Last-Event-ID en el backlog (comparar ids perdería transacciones que tomaron su id
+# antes pero hicieron commit después).
+SSE_CHANNEL      = "inv_events"
+SSE_MAX_CLIENTS  = int(os.getenv("SSE_MAX_CLIENTS", "32"))   # streams por worker (deja hilos libres)
+SSE_KEEPALIVE    = int(os.getenv("SSE_KEEPALIVE", "15"))     # seg. entre comentarios keep-alive
+SSE_MAX_AGE      = int(os.getenv("SSE_MAX_AGE", "300"))      # seg.; el navegador reconecta solo
+SSE_BACKLOG      = int(os.getenv("SSE_BACKLOG", "500"))      # eventos recientes para reanudar
+SSE_QUEUE_MAX    = int(os.getenv("SSE_QUEUE_MAX", "200"))    # pendientes por cliente antes de soltarlo
+
+_SSE_PRIORIDAD = {"created": 3, "deleted": 3, "assigned": 2, "updated": 1}
+_ASSIGN_ATTRS = ("persona_id", "actor_id", "asignado_a")
+
+class _Subscriber:
+    __slots__ = ("queue", "overflow")
+
+    def __init__(self):
+        self.queue = queue.Queue(maxsize=SSE_QUEUE_MAX)
+        self.overflow = False
+
+class EventHub:
+    """Fan-out acotado: backlog circular (en orden de publicación) + una cola por suscriptor."""
+
+    def __init__(self, backlog: int, max_clients: int):
+        self._backlog = deque()   # (posición, evento), a lo más backlog_max
+        self._pos = {}            # id de evento -> posición
+        self._next_pos = 0
+        self.backlog_max = backlog
+        self._subs = set()
+        self._lock = threading.Lock()
+        self.max_clients = max_clients
+
+    def subscribe(self, last_id: Optional[str] = None):
+        """
+        Devuelve (suscriptor, eventos a reenviar, reset) o None si se alcanzó el cupo.
+        Reenvía los eventos publicados después de last_id. reset=True si last_id no está
+        en el backlog (ya salió, o es de antes de que arrancara este worker): no se puede
+        garantizar continuidad y el cliente debe recargar todo.
+        """
+        with self._lock:
+            if len(self._subs) >= self.max_clients:
+                return None
+            sub = _Subscriber()
+            self._subs.add(sub)
+            replay, reset = [], False
+            if last_id is not None:
+                pos = self._pos.get(last_id)
+                if pos is None:
+                    reset = True
+                else:
+                    replay = [e for p, e in self._backlog if p > pos]
+            return sub, replay, reset
+
+    def unsubscribe(self, sub):
+        with self._lock:
+            self._subs.discard(sub)
+
+    def publish(self, evt: dict):
+        with self._lock:
+            if evt["id"] in self._pos:
+                return   # ya publicado (p. ej. NOTIFY repetido tras reconectar LISTEN)
+            if len(self._backlog) >= self.backlog_max:
+                _, viejo = self._backlog.popleft()
+                self._pos.pop(viejo["id"], None)
+            self._backlog.append((self._next_pos, evt))
+            self._pos[evt["id"]] = self._next_pos
+            self._next_pos += 1
+            for sub in list(self._subs):
+                try:
+                    sub.queue.put_nowait(evt)
+                except queue.Full:
+                    # Cliente lento: se suelta; al reconectar recibe 'reset'
+                    sub.overflow = True
+                    self._subs.discard(sub)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"clients": len(self._subs), "max_clients": self.max_clients, "backlog": len(self._backlog)}
+
+def _event_id() -> str:
+    return uuid4().hex[:16]   # sólo identifica al evento; el orden lo da el backlog
+
+inv_hub = EventHub(SSE_BACKLOG, SSE_MAX_CLIENTS)
+_IS_PG = engine.dialect.name == "postgresql"
+_pg_listener_started = False
+_pg_listener_lock = threading.Lock()
+
+@event.listens_for(SessionLocal, "before_flush")
+def _collect_inv_events(session, flush_context, instances):
+    pend = session.info.setdefault("inv_events", {})
+
+    def _add(tipo, inv_id):
+        prev = pend.get(inv_id)
+        if prev is None or _SSE_PRIORIDAD[tipo] > _SSE_PRIORIDAD[prev]:
+            pend[inv_id] = tipo
+
+    for obj in session.new:
+        if isinstance(obj, Invitacion):
+            _add("created", obj.id)
+    for obj in session.deleted:
+        if isinstance(obj, Invitacion):
+            _add("deleted", obj.id)
+    for obj in session.dirty:
+        if isinstance(obj, Invitacion) and session.is_modified(obj):
+            attrs = sa_inspect(obj).attrs
+            asignado = any(attrs[a].history.has_changes() for a in _ASSIGN_ATTRS)
+            _add("assigned" if asignado else "updated", obj.id)
+
+@event.listens_for(SessionLocal, "before_commit")
+def _notify_inv_events(session):
+    if not _IS_PG:
+        return
+    session.flush()   # que todo lo pendiente pase por _collect_inv_events
+    pend = session.info.pop("inv_events", None)
+    for inv_id, tipo in (pend or {}).items():
+        payload = json.dumps({"id": _event_id(), "tipo": tipo, "inv_id": str(inv_id)})
+        session.execute(text("SELECT pg_notify(:ch, :payload)"), {"ch": SSE_CHANNEL, "payload": payload})
+
+@event.listens_for(SessionLocal, "after_commit")
+def _publish_inv_events(session):
+    pend = session.info.pop("inv_events", None)
+    for inv_id, tipo in (pend or {}).items():
+        inv_hub.publish({"id": _event_id(), "tipo": tipo, "inv_id": str(inv_id)})
+
+@event.listens_for(SessionLocal, "after_rollback")
+def _discard_inv_events(session):
+    session.info.pop("inv_events", None)
+
+def _pg_listen_forever():
+    import psycopg
+    dsn = engine.url.set(drivername="postgresql").render_as_string(hide_password=False)
+    while True:
+        try:
+            with psycopg.connect(dsn, autocommit=True) as conn:
+                conn.execute(f"LISTEN {SSE_CHANNEL}")
+                for n in conn.notifies():
+                    try:
+                        inv_hub.publish(json.loads(n.payload))
+                    except ValueError:
+                        pass
+        except Exception as e:
+            print(f"⚠️ LISTEN {SSE_CHANNEL} se cayó, reintento en 5s: {e}")
+            time.sleep(5)
+
+def _ensure_pg_listener():
+    global _pg_listener_started
+    if not _IS_PG or _pg_listener_started:
+        return
+    with _pg_listener_lock:
+        if not _pg_listener_started:
+            threading.Thread(target=_pg_listen_forever, name="sse-pg-listen", daemon=True).start()
+            _pg_listener_started = True
+
+def _sse_format(evt: dict) -> str:
+    return f"id: {evt['id']}\nevent: invitacion\ndata: {json.dumps(evt)}\n\n"
+
+@app.get("/api/invitaciones/stream")
+@auth_required(['admin','viewer'])
+@query_budget(1)
+def api_invitaciones_stream():
+    """
+    text/event-stream con eventos 'invitacion' {id, tipo: created|updated|assigned|deleted, inv_id}.
+    Reanuda con Last-Event-ID; si no hay continuidad manda 'reset' (recargar todo).
+    El stream se cierra tras SSE_MAX_AGE y EventSource reconecta solo.
+    """
+    _ensure_pg_listener()
+
+    last_id = (request.headers.get("Last-Event-ID") or request.args.get("last_id") or "").strip()[:64] or None
+
+    got = inv_hub.subscribe(last_id)
+    if got is None:
+        return jsonify({"ok": False, "error": "Demasiados streams abiertos; usa polling"}), 503
+    sub, replay, reset = got
+
+    def gen():
+        try:
+            yield "retry: 5000\n\n"
+            if reset:
+                yield "event: reset\ndata: {}\n\n"
+            for evt in replay:
+                yield _sse_format(evt)
+            deadline = time.monotonic() + SSE_MAX_AGE
+            while time.monotonic() < deadline:
+                if sub.overflow and sub.queue.empty():
+                    # se perdieron eventos: que el cliente recargue
+                    yield "event: reset\ndata: {}\n\n"
+                    return
+                try:
+                    evt = sub.queue.get(timeout=SSE_KEEPALIVE)
+                except queue.Empty:
+                    yield ": keep-alive\n\n"
+                    continue
+                yield _sse_format(evt)
+        finally:
+            inv_hub.unsubscribe(sub)
+
+    resp = Response(gen(), mimetype="text/event-stream")
+    resp.headers["Cache-Control"] = "no-cache"
+    resp.headers["X-Accel-Buffering"] = "no"   # nginx: no bufferizar
+    return resp
+
+@app.get("/api/invitaciones/stream/stats")
+@auth_required(['admin'])
+@query_budget(1)
+def api_invitaciones_stream_stats():
+    return jsonify({"ok": True, **inv_hub.stats()})
+
 # =============================================================================
 # Archivos
 # =============================================================================
 @app.get("/api/files/<path:fname>")
+@query_budget(0)
 def api_files(fname):
     path = os.path.join(os.path.dirname(__file__), "uploads", fname)
     if not os.path.isfile(path):
         return jsonify({"ok": False, "error": "Archivo no encontrado"}), 404
-    mime = mimetypes.guess_type(path)[0] or "application/octet-stream"
-    return send_file(path, mimetype=mime, as_attachment=False, download_name=fname)
+    return send_attachment(Path(os.path.dirname(__file__)) / "uploads", fname,
+                           download_name=os.path.basename(fname), immutable=_ruta_por_contenido(fname))
+
+# =============================================================================
+# Métricas (formato de texto de Prometheus)
+# =============================================================================
+# Por endpoint de Flask: histograma de latencia (endpoint, método, status), peticiones
+# en curso, sentencias SQL y tiempo SQL; además la espera por conexión del pool.
+# Cada worker acumula en memoria y vuelca su estado a METRICS_DIR/<pid>.json cada
+# METRICS_FLUSH_SEC; /api/metrics suma los archivos de todos los workers del mismo
+# master (contadores de workers ya muertos se conservan; el gauge sólo cuenta vivos).
+METRICS_ENABLED   = os.getenv("METRICS_ENABLED", "1") == "1"
+METRICS_DIR       = os.getenv("METRICS_DIR") or os.path.join(tempfile.gettempdir(), f"secretario-metrics-{os.getppid()}")
+METRICS_FLUSH_SEC = float(os.getenv("METRICS_FLUSH_SEC", "5"))
+METRICS_TOKEN     = os.getenv("METRICS_TOKEN", "")   # Bearer para el scraper (además de sesión admin)
+METRICS_BUCKETS   = tuple(float(x) for x in os.getenv(
+    "METRICS_BUCKETS", "0.005,0.01,0.025,0.05,0.1,0.25,0.5,1,2.5,5,10").split(","))
+POOL_WAIT_BUCKETS = (0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 30)
+
+def _hist_new(buckets):
+    return {"b": [0] * (len(buckets) + 1), "sum": 0.0, "count": 0}
+
+def _hist_observe(h, buckets, v):
+    h["b"][bisect.bisect_left(buckets, v)] += 1
+    h["sum"] += v
+    h["count"] += 1
+
+class Metrics:
+    """Estado de un worker; las llaves de etiquetas se guardan como "a|b|c" (serializable)."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = {}   # "endpoint|method|status" -> hist
+        self.inflight = {}   # "endpoint" -> int
+        self.sql      = {}   # "endpoint" -> [sentencias, segundos]
+        self.pool_wait = _hist_new(POOL_WAIT_BUCKETS)
+        self._flushed = 0.0
+
+    def request_start(self, endpoint):
+        with self.lock:
+            self.inflight[endpoint] = self.inflight.get(endpoint, 0) + 1
+
+    def request_end(self, endpoint, method, status, seconds):
+        key = f"{endpoint}|{method}|{status}"
+        with self.lock:
+            self.inflight[endpoint] = self.inflight.get(endpoint, 1) - 1
+            h = self.requests.get(key)
+            if h is None:
+                h = self.requests[key] = _hist_new(METRICS_BUCKETS)
+            _hist_observe(h, METRICS_BUCKETS, seconds)
+        if time.monotonic() - self._flushed >= METRICS_FLUSH_SEC:
+            self.flush()
+
+    def sql_observe(self, endpoint, seconds):
+        with self.lock:
+            acc = self.sql.get(endpoint)
+            if acc is None:
+                acc = self.sql[endpoint] = [0, 0.0]
+            acc[0] += 1
+            acc[1] += seconds
+
+    def pool_wait_observe(self, seconds):
+        with self.lock:
+            _hist_observe(self.pool_wait, POOL_WAIT_BUCKETS, seconds)
+
+    def state(self) -> dict:
+        with self.lock:
+            return {
+                "pid": os.getpid(),
+                "requests": {k: {"b": list(h["b"]), "sum": h["sum"], "count": h["count"]}
+                             for k, h in self.requests.items()},
+                "inflight": dict(self.inflight),
+                "sql": {k: list(v) for k, v in self.sql.items()},
+                "pool_wait": {"b": list(self.pool_wait["b"]), "sum": self.pool_wait["sum"],
+                              "count": self.pool_wait["count"]},
+                "pool_checked_out": _pool_checked_out(),
+            }
+
+    def flush(self):
+        """Escritura atómica del estado de este worker (tmp + replace)."""
+        self._flushed = time.monotonic()
+        try:
+            os.makedirs(METRICS_DIR, exist_ok=True)
+            path = os.path.join(METRICS_DIR, f"{os.getpid()}.json")
+            tmp = f"{path}.tmp"
+            with open(tmp, "w", encoding="utf-8") as fh:
+                json.dump(self.state(), fh)
+            os.replace(tmp, path)
+        except OSError as e:
+            print(f"⚠️ Métricas: no se pudo escribir en {METRICS_DIR}: {e}")
+
+metrics = Metrics()
+_metrics_local = threading.local()   # endpoint de la petición en curso (para eventos SQL)
+
+def _pool_checked_out() -> int:
+    try:
+        return int(engine.pool.checkedout())
+    except Exception:
+        return 0
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+        return True
+    except ProcessLookupError:
+        return False
+    except OSError:
+        return True
+
+def metrics_snapshot() -> dict:
+    """Suma el estado de todos los workers (el propio se toma en vivo)."""
+    metrics.flush()
+    total = {"requests": {}, "inflight": {}, "sql": {}, "pool_wait": _hist_new(POOL_WAIT_BUCKETS),
+             "pool_checked_out": 0, "workers": 0}
+    try:
+        names = [n for n in os.listdir(METRICS_DIR) if n.endswith(".json")]
+    except OSError:
+        names = []
+    for name in names:
+        try:
+            with open(os.path.join(METRICS_DIR, name), encoding="utf-8") as fh:
+                st = json.load(fh)
+        except (OSError, ValueError):
+            continue
+        vivo = _pid_alive(int(st.get("pid") or 0))
+        for key, h in st["requests"].items():
+            acc = total["requests"].setdefault(key, _hist_new(METRICS_BUCKETS))
+            acc["b"] = [a + b for a, b in zip(acc["b"], h["b"])]
+            acc["sum"] += h["sum"]
+            acc["count"] += h["count"]
+        for key, (n, secs) in st["sql"].items():
+            acc = total["sql"].setdefault(key, [0, 0.0])
+            acc[0] += n
+            acc[1] += secs
+        pw = st["pool_wait"]
+        total["pool_wait"]["b"] = [a + b for a, b in zip(total["pool_wait"]["b"], pw["b"])]
+        total["pool_wait"]["sum"] += pw["sum"]
+        total["pool_wait"]["count"] += pw["count"]
+        if vivo:
+            total["workers"] += 1
+            total["pool_checked_out"] += st.get("pool_checked_out", 0)
+            for key, n in st["inflight"].items():
+                total["inflight"][key] = total["inflight"].get(key, 0) + n
+    return total
+
+def _prom_labels(**labels) -> str:
+    def esc(v):
+        return str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+    return "{" + ",".join(f'{k}="{esc(v)}"' for k, v in labels.items()) + "}"
+
+def _prom_histogram(out, name, buckets, h, **labels):
+    acumulado = 0
+    for le, n in zip((*buckets, "+Inf"), h["b"]):
+        acumulado += n
+        out.append(f"{name}_bucket{_prom_labels(**labels, le=le)} {acumulado}")
+    out.append(f"{name}_sum{_prom_labels(**labels) if labels else ''} {h['sum']:.6f}")
+    out.append(f"{name}_count{_prom_labels(**labels) if labels else ''} {h['count']}")
+
+def render_prometheus(snap: dict) -> str:
+    out = [
+        "# HELP http_request_duration_seconds Latencia de peticiones por endpoint de Flask.",
+        "# TYPE http_request_duration_seconds histogram",
+    ]
+    for key in sorted(snap["requests"]):
+        endpoint, method, status = key.split("|")
+        _prom_histogram(out, "http_request_duration_seconds", METRICS_BUCKETS, snap["requests"][key],
+                        endpoint=endpoint, method=method, status=status)
+    out += ["# HELP http_requests_in_flight Peticiones en curso por endpoint.",
+            "# TYPE http_requests_in_flight gauge"]
+    for endpoint, n in sorted(snap["inflight"].items()):
+        out.append(f"http_requests_in_flight{_prom_labels(endpoint=endpoint)} {n}")
+    out += ["# HELP db_statements_total Sentencias SQL ejecutadas por endpoint.",
+            "# TYPE db_statements_total counter"]
+    for endpoint, (n, _) in sorted(snap["sql"].items()):
+        out.append(f"db_statements_total{_prom_labels(endpoint=endpoint)} {n}")
+    out += ["# HELP db_statement_seconds_total Tiempo total en SQL por endpoint.",
+            "# TYPE db_statement_seconds_total counter"]
+    for endpoint, (_, secs) in sorted(snap["sql"].items()):
+        out.append(f"db_statement_seconds_total{_prom_labels(endpoint=endpoint)} {secs:.6f}")
+    out += ["# HELP db_pool_checkout_wait_seconds Espera por una conexión del pool.",
+            "# TYPE db_pool_checkout_wait_seconds histogram"]
+    _prom_histogram(out, "db_pool_checkout_wait_seconds", POOL_WAIT_BUCKETS, snap["pool_wait"])
+    out += ["# HELP db_pool_checked_out Conexiones prestadas ahora (suma de workers vivos).",
+            "# TYPE db_pool_checked_out gauge",
+            f"db_pool_checked_out {snap['pool_checked_out']}",
+            "# HELP app_workers Workers que reportan métricas.",
+            "# TYPE app_workers gauge",
+            f"app_workers {snap['workers']}"]
+    return "\n".join(out) + "\n"
+
+# --- instrumentación ---
+def _metrics_endpoint() -> str:
+    return getattr(_metrics_local, "endpoint", None) or "_background"
+
+@event.listens_for(engine, "before_cursor_execute")
+def _metrics_before_cursor(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("_metrics_t0", []).append(time.perf_counter())
+
+@event.listens_for(engine, "after_cursor_execute")
+def _metrics_after_cursor(conn, cursor, statement, parameters, context, executemany):
+    pila = conn.info.get("_metrics_t0")
+    if pila:
+        metrics.sql_observe(_metrics_endpoint(), time.perf_counter() - pila.pop())
+
+@event.listens_for(engine, "handle_error")
+def _metrics_cursor_error(ctx):
+    # la sentencia falló: no habrá after_cursor_execute; se cuenta igual y se retira su marca
+    pila = ctx.connection.info.get("_metrics_t0") if ctx.connection is not None else None
+    if pila:
+        metrics.sql_observe(_metrics_endpoint(), time.perf_counter() - pila.pop())
+
+def _instrument_pool_wait(pool):
+    """El pool no tiene evento "antes de checkout": se mide alrededor de _do_get."""
+    do_get = pool._do_get
+
+    def _timed_do_get():
+        t0 = time.perf_counter()
+        try:
+            return do_get()
+        finally:
+            metrics.pool_wait_observe(time.perf_counter() - t0)
+
+    pool._do_get = _timed_do_get
+
+if METRICS_ENABLED:
+    _instrument_pool_wait(engine.pool)
+
+@app.before_request
+def _metrics_before():
+    if not METRICS_ENABLED:
+        return
+    ep = request.endpoint or "_sin_ruta"   # 404: no se usa la URL (cardinalidad)
+    _metrics_local.endpoint = ep
+    g._metrics_t0 = time.perf_counter()
+    g._metrics_status = 500
+    metrics.request_start(ep)
+
+def _metrics_after(resp):
+    g._metrics_status = resp.status_code
+    return resp
+
+# after_request corre en orden inverso al de registro: al frente de la lista corre al
+# último y ve el status final (p. ej. el 500 de QUERY_CHECK=raise)
+app.after_request_funcs.setdefault(None, []).insert(0, _metrics_after)
+
+@app.teardown_request
+def _metrics_teardown(exc):
+    t0 = g.pop("_metrics_t0", None)
+    if t0 is None:
+        return
+    status = 500 if exc is not None else g.pop("_metrics_status", 500)
+    metrics.request_end(request.endpoint or "_sin_ruta", request.method, status, time.perf_counter() - t0)
+    _metrics_local.endpoint = None
+
+@app.get("/api/metrics")
+@query_budget(1)
+def api_metrics():
+    """Prometheus: Bearer METRICS_TOKEN (scraper) o sesión de admin."""
+    auth = request.headers.get("Authorization", "")
+    por_token = bool(METRICS_TOKEN) and hmac.compare_digest(
+        auth.encode("utf-8"), f"Bearer {METRICS_TOKEN}".encode("utf-8"))   # str no-ASCII: TypeError
+    if not por_token:
+        u = get_user_from_token()
+        if not u:
+            return jsonify({"ok": False, "error": "No autorizado"}), 401
+        if u.rol != "admin":
+            return jsonify({"ok": False, "error": "Prohibido"}), 403
+    resp = make_response(render_prometheus(metrics_snapshot()))
+    resp.headers["Content-Type"] = "text/plain; version=0.0.4; charset=utf-8"
+    resp.headers["Cache-Control"] = "no-store"
+    return resp
+
+# =============================================================================
+# Consultas lentas
+# =============================================================================
+# Cada sentencia que tarda más de SLOW_QUERY_MS (o que falla después de ese tiempo) se
+# escribe como una línea JSON en un log rotativo: endpoint que la disparó, duración, SQL
+# normalizado (sql_shape) y parámetros. Por defecto los parámetros van redactados: los
+# textos y bytes se reducen a su longitud; números, fechas y booleanos se conservan
+# para poder reproducir la consulta. En Postgres se toma una muestra de los SELECT
+# lentos (SLOW_QUERY_EXPLAIN_RATE, a lo más uno por forma cada
+# SLOW_QUERY_EXPLAIN_EVERY_SEC). La muestra se vuelve a correr con
+# EXPLAIN (ANALYZE, BUFFERS) en un hilo aparte, con conexión propia y statement_timeout,
+# y el plan se agrega al log. Como en METRICS_DIR, cada worker escribe y rota su propio
+# archivo SLOW_QUERY_DIR/<pid>.log (RotatingFileHandler no admite varios procesos sobre
+# el mismo archivo); /api/consultas_lentas lee todos, con sus respaldos (.1, .2, ...).
+# Los archivos de workers muertos se borran tras SLOW_QUERY_KEEP_DAYS sin escrituras.
+# Se mide execute() en el cursor: con psycopg eso incluye traer las filas; con SQLite
+# la lectura ocurre después y no cuenta.
+import logging
+import logging.handlers
+
+SLOW_QUERY_MS          = float(os.getenv("SLOW_QUERY_MS", "500"))     # 0 = apagado
+SLOW_QUERY_DIR         = os.getenv("SLOW_QUERY_DIR") or os.path.join(tempfile.gettempdir(), "secretario-consultas-lentas")
+SLOW_QUERY_LOG_MB      = float(os.getenv("SLOW_QUERY_LOG_MB", "10"))      # por worker
+SLOW_QUERY_LOG_BACKUPS = int(os.getenv("SLOW_QUERY_LOG_BACKUPS", "5"))
+SLOW_QUERY_KEEP_DAYS   = float(os.getenv("SLOW_QUERY_KEEP_DAYS", "7"))
+SLOW_QUERY_PARAMS      = os.getenv("SLOW_QUERY_PARAMS", "redact")      # redact | full | none
+SLOW_QUERY_SQL_MAX     = int(os.getenv("SLOW_QUERY_SQL_MAX", "4000"))  # caracteres de SQL por línea
+SLOW_QUERY_EXPLAIN_RATE       = float(os.getenv("SLOW_QUERY_EXPLAIN_RATE", "0.1"))   # sólo Postgres
+SLOW_QUERY_EXPLAIN_EVERY_SEC  = float(os.getenv("SLOW_QUERY_EXPLAIN_EVERY_SEC", "300"))
+SLOW_QUERY_EXPLAIN_TIMEOUT_MS = int(os.getenv("SLOW_QUERY_EXPLAIN_TIMEOUT_MS", "10000"))
+SLOW_QUERY_EXPLAIN_PENDING    = 4   # EXPLAIN en cola por worker; más se descartan
+
+_slow_log = logging.getLogger("secretario.consultas_lentas")
+_slow_log.propagate = False
+_slow_log.setLevel(logging.INFO)
+
+_slow_log_pid = None   # pid dueño del handler actual (con --preload el master importa la app)
+_slow_log_lock = threading.Lock()
+
+def slow_query_files() -> list:
+    """Logs de todos los workers (<pid>.log y respaldos), del más viejo al más nuevo."""
+    try:
+        names = [n for n in os.listdir(SLOW_QUERY_DIR) if re.fullmatch(r"\d+\.log(\.\d+)?", n)]
+    except OSError:
+        return []
+    paths = []
+    for n in names:
+        path = os.path.join(SLOW_QUERY_DIR, n)
+        try:
+            paths.append((os.path.getmtime(path), path))
+        except OSError:
+            continue   # rotó entre el listado y el stat
+    return [p for _, p in sorted(paths)]
+
+def _slow_prune():
+    """Borra logs de workers muertos sin escrituras en SLOW_QUERY_KEEP_DAYS."""
+    if SLOW_QUERY_KEEP_DAYS <= 0:
+        return
+    limite = time.time() - SLOW_QUERY_KEEP_DAYS * 86400
+    for path in slow_query_files():
+        pid = int(os.path.basename(path).split(".", 1)[0])
+        try:
+            if os.path.getmtime(path) < limite and not _pid_alive(pid):
+                os.remove(path)
+        except OSError:
+            pass
+
+def _slow_log_setup() -> bool:
+    global _slow_log_pid
+    try:
+        os.makedirs(SLOW_QUERY_DIR, exist_ok=True)
+    except OSError as e:
+        print(f"⚠️ Consultas lentas: no se pudo crear {SLOW_QUERY_DIR}: {e}")
+        return False
+    for old in list(_slow_log.handlers):
+        _slow_log.removeHandler(old)
+        old.close()
+    _slow_prune()
+    h = logging.handlers.RotatingFileHandler(
+        os.path.join(SLOW_QUERY_DIR, f"{os.getpid()}.log"), maxBytes=int(SLOW_QUERY_LOG_MB * 1024 * 1024),
+        backupCount=SLOW_QUERY_LOG_BACKUPS, encoding="utf-8", delay=True)
+    h.setFormatter(logging.Formatter("%(message)s"))
+    _slow_log.addHandler(h)
+    _slow_log_pid = os.getpid()
+    return True
+
+def _slow_write(rec: dict):
+    if _slow_log_pid != os.getpid():
+        with _slow_log_lock:
+            if _slow_log_pid != os.getpid() and not _slow_log_setup():
+                return
+    _slow_log.info(json.dumps(rec, ensure_ascii=False, default=str))
+
+def _param_value(v, full: bool):
+    if v is None or isinstance(v, (bool, int, float)):
+        return v
+    if isinstance(v, (date, dtime)):   # datetime es subclase de date
+        return v.isoformat()
+    if isinstance(v, str):
+        return v if full else f"<texto:{len(v)}>"
+    if isinstance(v, (bytes, bytearray, memoryview)):
+        return f"<bytes:{len(v)}>"
+    if isinstance(v, (list, tuple)):
+        return [_param_value(x, full) for x in v]
+    return repr(v) if full else f"<{type(v).__name__}>"
+
+def redact_params(parameters, executemany: bool = False):
+    """Parámetros del DBAPI listos para el log según SLOW_QUERY_PARAMS."""
+    if SLOW_QUERY_PARAMS == "none" or parameters is None:
+        return None
+    full = SLOW_QUERY_PARAMS == "full"
+    if executemany:
+        filas = list(parameters)
+        return {"filas": len(filas), "primera": redact_params(filas[0]) if filas else None}
+    if isinstance(parameters, dict):
+        return {k: _param_value(v, full) for k, v in parameters.items()}
+    return _param_value(parameters, full)
+
+def _forma_id(shape: str) -> str:
+    return hashlib.sha1(shape.encode("utf-8")).hexdigest()[:12]
+
+# --- EXPLAIN muestreado (Postgres) ---
+_EXPLAIN_SELECT = re.compile(r"^\s*SELECT\b", re.I)
+_EXPLAIN_NUNCA  = re.compile(r"\b(INSERT|UPDATE|DELETE|MERGE|SHARE|NEXTVAL|SETVAL|PG_ADVISORY\w*)\b", re.I)
+_explain_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="explain")
+_explain_lock = threading.Lock()
+_explain_last = {}      # forma -> time.monotonic() del último EXPLAIN
+_explain_pending = 0
+
+def _explain_sample(forma: str, statement: str, executemany: bool) -> bool:
+    """Sólo SELECT sin efectos (EXPLAIN ANALYZE ejecuta la sentencia), muestreado y espaciado."""
+    global _explain_pending
+    if not _IS_PG or SLOW_QUERY_EXPLAIN_RATE <= 0 or executemany:
+        return False
+    if not _EXPLAIN_SELECT.match(statement) or _EXPLAIN_NUNCA.search(statement):
+        return False
+    if random.random() >= SLOW_QUERY_EXPLAIN_RATE:
+        return False
+    now = time.monotonic()
+    with _explain_lock:
+        last = _explain_last.get(forma)
+        if _explain_pending >= SLOW_QUERY_EXPLAIN_PENDING or (
+                last is not None and now - last < SLOW_QUERY_EXPLAIN_EVERY_SEC):
+            return False
+        _explain_last[forma] = now
+        _explain_pending += 1
+    return True
+
+def explain_analyze(statement: str, parameters) -> str:
+    """EXPLAIN (ANALYZE, BUFFERS) en una conexión cruda del pool; siempre hace rollback."""
+    raw = engine.raw_connection()
+    try:
+        cur = raw.cursor()
+        cur.execute(f"SET LOCAL statement_timeout = {int(SLOW_QUERY_EXPLAIN_TIMEOUT_MS)}")
+        cur.execute("EXPLAIN (ANALYZE, BUFFERS) " + statement, parameters)
+        return "\n".join(r[0] for r in cur.fetchall())
+    finally:
+        try:
+            raw.rollback()
+        finally:
+            raw.close()
+
+_PLAN_LITERAL = re.compile(r"'(?:[^']|'')*'")
+_ERROR_LITERAL = re.compile(r"'(?:[^']|'')*'|\"(?:[^\"]|\"\")*\"")
+
+def mask_plan_literals(texto: Optional[str], patron=_PLAN_LITERAL) -> Optional[str]:
+    """
+    EXPLAIN ANALYZE escribe los parámetros como literales ('%juan%'::text). Salvo con
+    SLOW_QUERY_PARAMS=full se reducen a su longitud, igual que en redact_params.
+    """
+    if not texto or SLOW_QUERY_PARAMS == "full":
+        return texto
+    return patron.sub(lambda m: f"'<texto:{len(m.group(0)) - 2}>'", texto)
+
+def _explain_job(forma: str, endpoint: str, statement: str, parameters):
+    global _explain_pending
+    plan = error = None
+    try:
+        plan = mask_plan_literals(explain_analyze(statement, parameters))
+    except Exception as e:
+        # los errores de Postgres citan el valor ("invalid input syntax ...: \"abc\"")
+        error = mask_plan_literals(f"{type(e).__name__}: {e}", _ERROR_LITERAL)
+    finally:
+        with _explain_lock:
+            _explain_pending -= 1
+    _slow_write({"tipo": "explain", "ts": datetime.utcnow().isoformat(timespec="milliseconds"),
+                 "pid": os.getpid(), "forma": forma, "endpoint": endpoint, "plan": plan, "error": error})
+
+# --- registro ---
+def _slow_record(statement, parameters, executemany, ms, error=None):
+    if has_request_context():
+        endpoint, method = request.endpoint or "_sin_ruta", request.method
+    else:
+        endpoint, method = "_background", None
+    shape = sql_shape(statement)
+    forma = _forma_id(shape)
+    _slow_write({
+        "tipo": "lenta", "ts": datetime.utcnow().isoformat(timespec="milliseconds"), "pid": os.getpid(),
+        "endpoint": endpoint, "method": method, "ms": round(ms, 2), "forma": forma,
+        "sql": shape[:SLOW_QUERY_SQL_MAX], "params": redact_params(parameters, executemany),
+        "executemany": bool(executemany), "error": error,
+    })
+    if error is None and _explain_sample(forma, statement, executemany):
+        _explain_pool.submit(_explain_job, forma, endpoint, statement, parameters)
+
+def _slow_before_cursor(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("_slow_t0", []).append(time.perf_counter())
+
+def _slow_after_cursor(conn, cursor, statement, parameters, context, executemany):
+    pila = conn.info.get("_slow_t0")
+    if pila:
+        ms = (time.perf_counter() - pila.pop()) * 1000
+        if ms >= SLOW_QUERY_MS:
+            _slow_record(statement, parameters, executemany, ms)
+
+def _slow_cursor_error(ctx):
+    # un statement_timeout también es una consulta lenta: se registra con su error
+    pila = ctx.connection.info.get("_slow_t0") if ctx.connection is not None else None
+    if pila:
+        ms = (time.perf_counter() - pila.pop()) * 1000
+        if ms >= SLOW_QUERY_MS and ctx.statement:
+            ctx_exec = ctx.execution_context
+            _slow_record(ctx.statement, ctx.parameters, bool(ctx_exec and ctx_exec.executemany), ms,
+                         error=type(ctx.original_exception).__name__)
+
+if SLOW_QUERY_MS > 0 and _slow_log_setup():
+    event.listen(engine, "before_cursor_execute", _slow_before_cursor)
+    event.listen(engine, "after_cursor_execute", _slow_after_cursor)
+    event.listen(engine, "handle_error", _slow_cursor_error)
+
+# --- resumen ---
+def slow_query_top(limit: int = 20, endpoint: Optional[str] = None, desde: Optional[str] = None) -> list:
+    """Formas de SQL ordenadas por tiempo total; cada una con su último EXPLAIN si lo hay."""
+    grupos, planes = {}, {}
+    for path in slow_query_files():
+        try:
+            fh = open(path, encoding="utf-8", errors="replace")
+        except OSError:
+            continue   # rotó entre el listado y la apertura
+        with fh:
+            for line in fh:
+                try:
+                    rec = json.loads(line)
+                except ValueError:
+                    continue
+                forma = rec.get("forma")
+                ts = rec.get("ts") or ""
+                if rec.get("tipo") == "explain":
+                    if ts >= (planes.get(forma) or {}).get("ts", ""):
+                        planes[forma] = {k: rec.get(k) for k in ("ts", "plan", "error")}
+                    continue
+                if (endpoint and rec.get("endpoint") != endpoint) or (desde and ts < desde):
+                    continue
+                gr = grupos.get(forma)
+                if gr is None:
+                    gr = grupos[forma] = {"forma": forma, "sql": rec.get("sql"), "veces": 0, "total_ms": 0.0,
+                                          "max_ms": 0.0, "errores": 0, "endpoints": {}}
+                ms = float(rec.get("ms") or 0)
+                gr["veces"] += 1
+                gr["total_ms"] += ms
+                if ms >= gr["max_ms"]:
+                    gr["max_ms"], gr["params_max"] = ms, rec.get("params")
+                gr["errores"] += 1 if rec.get("error") else 0
+                ep = rec.get("endpoint") or "_background"
+                gr["endpoints"][ep] = gr["endpoints"].get(ep, 0) + 1
+                gr["ultima"] = max(gr.get("ultima") or "", ts)
+    top = sorted(grupos.values(), key=lambda x: x["total_ms"], reverse=True)[:limit]
+    for gr in top:
+        gr["total_ms"] = round(gr["total_ms"], 2)
+        gr["prom_ms"] = round(gr["total_ms"] / gr["veces"], 2)
+        gr["explain"] = planes.get(gr["forma"])
+    return top
+
+@app.get("/api/consultas_lentas")
+@auth_required(['admin'])
+@query_budget(1)
+def api_consultas_lentas():
+    """?limit=20&endpoint=api_invitations_list&desde=2025-01-01T00:00 (UTC, ISO)"""
+    try:
+        limit = max(1, min(int(request.args.get("limit", 20)), 500))
+    except ValueError:
+        return jsonify({"ok": False, "error": "limit inválido"}), 400
+    endpoint = (request.args.get("endpoint") or "").strip() or None
+    desde = (request.args.get("desde") or "").strip() or None
+    return jsonify({
+        "ok": True,
+        "umbral_ms": SLOW_QUERY_MS,
+        "explain": _IS_PG and SLOW_QUERY_EXPLAIN_RATE > 0,
+        "archivos": slow_query_files(),
+        "items": slow_query_top(limit, endpoint, desde),
+    })
 
 # =============================================================================
 # Salud
 # =============================================================================
 @app.get("/api/health")
+@query_budget(1)
 def api_health():
     u = get_user_from_token()
     return jsonify({"ok": True, "ts": datetime.utcnow().isoformat(), "auth": bool(u)})
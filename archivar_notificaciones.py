@@ -0,0 +1,30 @@
+# archivar_notificaciones.py
+"""
+Mueve notificaciones enviadas más viejas que el horizonte a notificaciones_archivo.
+Útil para cron o para la primera pasada sobre una tabla grande (el hilo de la app
+sólo mueve NOTIF_ARCHIVE_MAX_BATCHES lotes por pasada).
+
+Uso:
+  python archivar_notificaciones.py                 # 90 días, lotes de 1000, hasta terminar
+  python archivar_notificaciones.py --dias 30 --lote 5000 --pausa 0.5
+"""
+import argparse
+import time
+
+from db import Base, engine, archive_notificaciones
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--dias", type=int, default=90, help="horizonte de retención en la tabla caliente")
+    ap.add_argument("--lote", type=int, default=1000, help="filas por transacción")
+    ap.add_argument("--max-lotes", type=int, default=None)
+    ap.add_argument("--pausa", type=float, default=0.0, help="segundos entre lotes")
+    args = ap.parse_args()
+
+    Base.metadata.create_all(engine)   # crea notificaciones_archivo si falta
+    t0 = time.perf_counter()
+    n = archive_notificaciones(engine, args.dias, args.lote, max_batches=args.max_lotes, pause=args.pausa)
+    print(f"OK: {n} notificaciones archivadas en {time.perf_counter() - t0:.1f}s")
+
+if __name__ == "__main__":
+    main()
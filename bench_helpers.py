@@ -0,0 +1,293 @@
+# bench_helpers.py
+"""
+Micro-benchmarks de los helpers en Python puro que corren por fila/por invitación:
+agenda (_rango/_traslapan_con_gap, DayAgenda), ambas variantes de inv_to_dict,
+snapshot de notificación, municipios, parse_time_flexible y el ciclo de filas del xlsx.
+
+Uso:
+  python bench_helpers.py                                   # tabla, tamaños 100/1k/10k
+  python bench_helpers.py --save bench_baseline.json        # guarda línea base
+  python bench_helpers.py --compare bench_baseline.json     # falla (exit 1) si algo empeora
+  python bench_helpers.py --compare base.json --threshold 10 --filter muni
+
+Se reporta µs por elemento: cada corrida repite el caso hasta juntar al menos --min-time
+segundos (timeit autorange) y se toma la mejor de --repeat corridas; el mínimo es mucho más
+estable que la mediana para casos de menos de un milisegundo. Compara sólo contra líneas
+base tomadas en la misma máquina: el umbral es relativo (por defecto 20%).
+"""
+import os
+import sys
+import ast
+import json
+import random
+import argparse
+import io
+import platform
+import tempfile
+import timeit
+from datetime import date, datetime, time as dtime, timedelta
+from pathlib import Path
+
+def _args():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--sizes", default="100,1000,10000")
+    ap.add_argument("--repeat", type=int, default=5, help="corridas por caso (se toma la mejor)")
+    ap.add_argument("--min-time", type=float, default=0.2, help="segundos mínimos por corrida")
+    ap.add_argument("--filter", default="", help="sólo casos cuyo nombre contenga este texto")
+    ap.add_argument("--save", metavar="JSON", help="guardar resultados como línea base")
+    ap.add_argument("--compare", metavar="JSON", help="comparar contra una línea base")
+    ap.add_argument("--threshold", type=float, default=20.0, help="%% de empeoramiento permitido")
+    ap.add_argument("--json", action="store_true", help="salida JSON en lugar de tabla")
+    return ap.parse_args()
+
+args = _args()
+# BD desechable: sólo la usan los catálogos en caché (sexo) al construir snapshots
+if not os.getenv("DB_URL"):
+    os.environ["DB_URL"] = "sqlite:///" + os.path.join(tempfile.mkdtemp(prefix="bench_helpers_"), "bench.db")
+os.environ.setdefault("NOTIF_ARCHIVE_EVERY_SEC", "0")
+
+from openpyxl import Workbook
+from db import Base, engine, SessionLocal, Sexo, Persona, Actor, Invitacion
+import app as webapp
+
+NOMBRES = ["José Pérez", "María López", "Juan Hernández", "Ana García", "Luis Martínez"]
+CARGOS  = ["Delegado", "Enlace", "Coordinadora", "Diputado", "Regidor"]
+HORAS   = ["9:30", "09:30:00", "5 pm", "5:15pm", "12 am", "7.45", "18:05", "", "x", "23:59:59"]
+
+# ----------------- datos sintéticos -----------------
+def _municipios(rnd, n):
+    """Grafías reales: exactas, sin acentos, mayúsculas, con prefijo y con typo."""
+    out = []
+    for _ in range(n):
+        m = rnd.choice(webapp.MUNICIPIOS_EDOMEX)
+        v = rnd.randrange(5)
+        if v == 1:
+            m = webapp.fold_text(m)
+        elif v == 2:
+            m = m.upper()
+        elif v == 3:
+            m = f"Mpio. de {m}"
+        elif v == 4 and len(m) > 5:
+            i = rnd.randrange(1, len(m) - 1)
+            m = m[:i] + m[i + 1:]
+        out.append(m)
+    return out
+
+def _invitaciones(n, seed=1):
+    rnd = random.Random(seed)
+    actores = [Actor(id=i, nombre=f"Actor {i}", cargo=rnd.choice(CARGOS), telefono="55 1234 5678",
+                     sexo_id=1 + i % 2, particular_nombre="Part", particular_tel="(55) 8765-4321")
+               for i in range(1, 21)]
+    personas = [Persona(id=i, nombre=rnd.choice(NOMBRES), cargo=rnd.choice(CARGOS), telefono="55-1111-2222",
+                        sexo_id=1 + i % 2, unidad_region="Norte", region_id=1 + i % 3)
+                for i in range(1, 51)]
+    munis = _municipios(rnd, n)
+    invs = []
+    for i in range(n):
+        a = rnd.choice(actores)
+        p = rnd.choice(personas) if i % 3 else None
+        inv = Invitacion(
+            id=f"b{i:07d}", fecha=date(2025, 1, 1) + timedelta(days=i % 30),
+            hora=dtime(7 + rnd.randrange(14), rnd.choice((0, 15, 30, 45))),
+            evento=f"Evento {i}", convoca_cargo="Diputado", convoca=a.nombre, partido_politico="MORENA",
+            municipio=munis[i], lugar="Plaza cívica", estatus="Confirmado" if p else "Pendiente",
+            asignado_a=p.nombre if p else None, rol=p.cargo if p else None, observaciones="obs",
+            ultima_modificacion=datetime(2025, 1, 1), archivo_nombre="flyer.pdf",
+        )
+        inv.actor, inv.actor_id = a, a.id
+        inv.persona, inv.persona_id = p, (p.id if p else None)
+        invs.append(inv)
+    return invs
+
+def _inv_to_dict_variants():
+    """app.py define inv_to_dict dos veces (la segunda gana); compila cada una por separado."""
+    tree = ast.parse(Path(webapp.__file__).read_text(encoding="utf-8"))
+    out = []
+    for node in tree.body:
+        if isinstance(node, ast.FunctionDef) and node.name == "inv_to_dict":
+            ns = dict(vars(webapp))
+            exec(compile(ast.Module(body=[node], type_ignores=[]), webapp.__file__, "exec"), ns)
+            out.append((f"inv_to_dict[L{node.lineno}]", ns["inv_to_dict"]))
+    return out
+
+# ----------------- casos: setup(n) -> callable que procesa n elementos -----------------
+def case_rango_traslape(n):
+    invs = sorted(_invitaciones(n), key=lambda i: (i.fecha, i.hora))
+    def run():
+        prev = None
+        for inv in invs:
+            r = webapp._rango(inv)
+            if prev is not None:
+                webapp._traslapan_con_gap(prev[0], prev[1], r[0], r[1])
+            prev = r
+    return run
+
+def case_day_agenda(n):
+    invs = _invitaciones(n)
+    rangos = [(inv.id, *webapp._rango(inv)) for inv in invs]
+    def run():
+        ag = webapp.DayAgenda()
+        for inv_id, ini, fin in rangos:
+            ag.conflicts(ini, fin, exclude_id=inv_id)
+            ag.add(inv_id, ini, fin)
+    return run
+
+def case_notif_snapshot(n):
+    invs = _invitaciones(n)
+    def run():
+        for inv in invs:
+            webapp.notif_snapshot(None, inv, "Estatus", "Pendiente", "Confirmado", "c",
+                                  persona_obj=inv.persona, actor_obj=inv.actor,
+                                  estatus_override="Confirmado")
+    return run
+
+def case_normalize_muni(n):
+    raws = _municipios(random.Random(2), n)
+    def run():
+        for m in raws:
+            webapp.normalize_muni(m)
+    return run
+
+def case_muni_canonical(n):
+    raws = _municipios(random.Random(3), n)
+    def run():
+        for m in raws:
+            webapp.municipio_resolver.canonical(m)
+    return run
+
+def case_muni_region_ids(n):
+    raws = _municipios(random.Random(4), n)
+    def run():
+        for m in raws:
+            webapp.municipio_resolver.region_ids(m)
+    return run
+
+def case_parse_time(n):
+    raws = [HORAS[i % len(HORAS)] for i in range(n)]
+    def run():
+        for v in raws:
+            webapp.parse_time_flexible(v)
+    return run
+
+def case_export_rows(n):
+    rows = [(inv.municipio, inv.partido_politico, inv.fecha, inv.hora, inv.lugar, inv.convoca,
+             *((inv.persona.nombre, inv.persona.cargo, inv.persona.unidad_region, inv.persona.region_id)
+               if inv.persona else (None, None, None, None)),
+             inv.actor.nombre, inv.actor.cargo)
+            for inv in _invitaciones(n)]
+    region_names = {1: "Norte", 2: "Sur", 3: "Oriente"}
+    def run():
+        wb = Workbook(write_only=True)
+        ws = wb.create_sheet("Invitaciones")
+        unmatched = {}
+        for row in rows:
+            ws.append(webapp.export_row(row, region_names, unmatched))
+        wb.save(io.BytesIO())   # cierra el archivo temporal del write-only
+    return run
+
+def _case_inv_to_dict(fn):
+    def setup(n):
+        invs = _invitaciones(n)
+        def run():
+            for inv in invs:
+                fn(inv)
+        return run
+    return setup
+
+def _cases():
+    cases = [
+        ("rango+traslape", case_rango_traslape),
+        ("day_agenda", case_day_agenda),
+        *((name, _case_inv_to_dict(fn)) for name, fn in _inv_to_dict_variants()),
+        ("notif_snapshot", case_notif_snapshot),
+        ("normalize_muni", case_normalize_muni),
+        ("muni_canonical", case_muni_canonical),
+        ("muni_region_ids", case_muni_region_ids),
+        ("parse_time_flexible", case_parse_time),
+        ("export_rows", case_export_rows),
+    ]
+    return [(name, fn) for name, fn in cases if args.filter in name]
+
+# ----------------- ejecución -----------------
+def _prepare():
+    Base.metadata.create_all(engine)
+    db = SessionLocal()
+    try:
+        if not db.query(Sexo).first():
+            db.add_all([Sexo(id=1, nombre="Hombre"), Sexo(id=2, nombre="Mujer")])
+            db.commit()
+    finally:
+        db.close()
+    pairs = [(1 + i % 3, m) for i, m in enumerate(webapp.MUNICIPIOS_EDOMEX)]
+    webapp.municipio_resolver.load_regions(pairs)
+    webapp.MUNI_RESOLVER_TTL = 10 ** 9   # que ensure_loaded no vaya a la BD a media corrida
+
+def _measure(run, n, repeat, min_time):
+    run()   # calentamiento (memos, cachés de catálogos)
+    timer = timeit.Timer(run)
+    number = 1
+    while True:   # como Timer.autorange, pero hasta min_time
+        if timer.timeit(number) >= min_time:
+            break
+        number *= 2
+    best = min(timer.repeat(repeat, number)) / number
+    return best / n * 1e6   # µs por elemento
+
+def run_all():
+    sizes = sorted(int(x) for x in args.sizes.split(","))
+    results = {}
+    for name, setup in _cases():
+        for n in sizes:
+            results[f"{name}@{n}"] = round(_measure(setup(n), n, args.repeat, args.min_time), 4)
+            print(f"  {name}@{n}: {results[f'{name}@{n}']} µs", file=sys.stderr)
+    return results
+
+def compare(results, baseline, threshold):
+    rows, regressions = [], []
+    for key, us in results.items():
+        base = baseline.get(key)
+        delta = None if not base else (us - base) / base * 100
+        rows.append((key, base, us, delta))
+        if delta is not None and delta > threshold:
+            regressions.append(key)
+    return rows, regressions
+
+def main():
+    _prepare()
+    results = run_all()
+    meta = {"python": platform.python_version(), "machine": platform.machine(),
+            "ts": datetime.utcnow().isoformat(timespec="seconds"), "repeat": args.repeat,
+            "min_time": args.min_time}
+
+    if args.save:
+        Path(args.save).write_text(json.dumps({"meta": meta, "results": results}, indent=2), encoding="utf-8")
+        print(f"Línea base guardada en {args.save}", file=sys.stderr)
+
+    if not args.compare:
+        if args.json:
+            print(json.dumps({"meta": meta, "results": results}, indent=2))
+        else:
+            print(f"{'caso':<32} {'µs/elem':>10}")
+            print("-" * 43)
+            for key, us in results.items():
+                print(f"{key:<32} {us:>10}")
+        return
+
+    baseline = json.loads(Path(args.compare).read_text(encoding="utf-8"))["results"]
+    rows, regressions = compare(results, baseline, args.threshold)
+    if args.json:
+        print(json.dumps({"meta": meta, "threshold": args.threshold, "regressions": regressions,
+                          "rows": [dict(zip(("case", "base_us", "us", "delta_pct"), r)) for r in rows]}, indent=2))
+    else:
+        print(f"{'caso':<32} {'base µs':>10} {'ahora µs':>10} {'Δ %':>8}")
+        print("-" * 63)
+        for key, base, us, delta in rows:
+            mark = "  ← regresión" if key in regressions else ""
+            d = f"{delta:+.1f}" if delta is not None else "n/a"
+            print(f"{key:<32} {base if base is not None else '-':>10} {us:>10} {d:>8}{mark}")
+    if regressions:
+        print(f"{len(regressions)} caso(s) empeoraron más de {args.threshold}%", file=sys.stderr)
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
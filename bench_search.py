@@ -0,0 +1,130 @@
+# bench_search.py
+"""
+Compara la búsqueda libre de /api/invitations: ilike original vs índice (FTS5 / pg_trgm).
+
+Uso:
+  python bench_search.py                         # SQLite temporal, 10k/100k/1M filas
+  python bench_search.py --sizes 10000,100000
+  DB_URL=postgresql://... python bench_search.py --force   # BD desechable de Postgres
+
+Las filas se agregan de forma incremental (10k -> 100k -> 1M) sobre la misma BD.
+"""
+import os
+import sys
+import json
+import random
+import argparse
+import tempfile
+import time
+from datetime import date, time as dtime, timedelta
+
+TERMS = ["toluca", "reunión vecinal", "jose", "plaza civica", "morena", "xyzw"]
+
+def _args():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--sizes", default="10000,100000,1000000")
+    ap.add_argument("--repeat", type=int, default=5, help="repeticiones por consulta (se reporta la mediana)")
+    ap.add_argument("--json", action="store_true", help="salida JSON en lugar de tabla")
+    ap.add_argument("--force", action="store_true", help="permitir DB_URL con invitaciones existentes")
+    return ap.parse_args()
+
+args = _args()
+if not os.getenv("DB_URL"):
+    os.environ["DB_URL"] = "sqlite:///" + os.path.join(tempfile.mkdtemp(prefix="bench_search_"), "bench.db")
+
+from sqlalchemy import insert, func
+from db import Base, engine, SessionLocal, Invitacion, inv_busqueda, setup_search
+import app as webapp
+
+EVENTOS = ["Reunión vecinal", "Informe de actividades", "Arranque de obra", "Foro juvenil",
+           "Entrega de apoyos", "Asamblea informativa", "Festival cultural", "Mesa de trabajo"]
+LUGARES = ["Plaza cívica", "Auditorio municipal", "Casa de cultura", "Explanada", "Salón ejidal"]
+NOMBRES = ["José Pérez", "María López", "Juan Hernández", "Ana García", "Luis Martínez"]
+PARTIDOS = ["MORENA", "PAN", "PRI", "PRD", "MC", "PVEM"]
+
+def _fill(target: int, start: int, batch: int = 10000):
+    rnd = random.Random(start)
+    d0 = date(2023, 1, 1)
+    i = start
+    while i < target:
+        rows = []
+        for _ in range(min(batch, target - i)):
+            r = {
+                "id": f"bench{i:08d}",
+                "fecha": d0 + timedelta(days=rnd.randrange(1100)),
+                "hora": dtime(rnd.randrange(7, 21), rnd.choice((0, 15, 30, 45))),
+                "evento": f"{rnd.choice(EVENTOS)} {rnd.randrange(1000)}",
+                "convoca_cargo": "Diputado",
+                "convoca": rnd.choice(NOMBRES),
+                "partido_politico": rnd.choice(PARTIDOS),
+                "municipio": rnd.choice(webapp.MUNICIPIOS_EDOMEX),
+                "lugar": rnd.choice(LUGARES),
+                "estatus": "Pendiente",
+            }
+            r["busqueda"] = inv_busqueda(r)
+            rows.append(r)
+            i += 1
+        with engine.begin() as conn:
+            conn.execute(insert(Invitacion.__table__), rows)
+    return i
+
+def _median_ms(fn, repeat):
+    ts = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        ts.append((time.perf_counter() - t0) * 1000)
+    ts.sort()
+    return ts[len(ts) // 2]
+
+def _bench(size, repeat):
+    out = []
+    db = SessionLocal()
+    try:
+        for term in TERMS:
+            row = {"rows": size, "term": term}
+            for mode in ("ilike", "indexed"):
+                m = "ilike" if mode == "ilike" else webapp._detect_search_backend(db)
+
+                def page():
+                    q, _ = webapp.apply_inv_search(db, db.query(Invitacion.id), term, mode=m)
+                    q.order_by(Invitacion.fecha.desc(), Invitacion.hora.desc(), Invitacion.id.desc()).limit(200).all()
+
+                def count():
+                    q, _ = webapp.apply_inv_search(db, db.query(func.count(Invitacion.id)), term, mode=m)
+                    row[f"{mode}_hits"] = q.scalar()
+
+                row[f"{mode}_page_ms"] = round(_median_ms(page, repeat), 2)
+                row[f"{mode}_count_ms"] = round(_median_ms(count, repeat), 2)
+            out.append(row)
+    finally:
+        db.close()
+    return out
+
+def main():
+    Base.metadata.create_all(engine)
+    with engine.connect() as conn:
+        existing = conn.execute(func.count(Invitacion.id).select()).scalar()
+    if existing and not args.force:
+        sys.exit(f"La BD ya tiene {existing} invitaciones; usa una BD desechable o --force")
+    print(f"Índice: {setup_search(engine)} sobre {engine.url.render_as_string()}", file=sys.stderr)
+
+    results, n = [], existing
+    for size in sorted(int(x) for x in args.sizes.split(",")):
+        t0 = time.perf_counter()
+        n = _fill(size, n)
+        print(f"{size} filas cargadas en {time.perf_counter() - t0:.1f}s", file=sys.stderr)
+        results += _bench(size, args.repeat)
+
+    if args.json:
+        print(json.dumps(results, ensure_ascii=False, indent=2))
+        return
+    hdr = f"{'filas':>8} {'término':<16} {'ilike pág':>10} {'idx pág':>9} {'ilike cnt':>10} {'idx cnt':>9} {'hits':>8}"
+    print(hdr)
+    print("-" * len(hdr))
+    for r in results:
+        print(f"{r['rows']:>8} {r['term']:<16} {r['ilike_page_ms']:>10} {r['indexed_page_ms']:>9} "
+              f"{r['ilike_count_ms']:>10} {r['indexed_count_ms']:>9} {r['indexed_hits']:>8}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,303 @@
+# check_queries.py
+"""
+Verifica el presupuesto de consultas (@query_budget) de cada endpoint contra una BD sembrada.
+
+Levanta la app en proceso con QUERY_CHECK=raise sobre una BD SQLite temporal sembrada con
+generar_datos.py, recorre las rutas (lecturas y escrituras típicas) con los cachés en memoria
+vacíos (peor caso) y falla (exit 1) si:
+  - un endpoint excede su presupuesto o repite la misma forma de SQL (N+1)
+  - un endpoint recorrido no declara presupuesto
+  - reemplazar un adjunto compartido (eliminar_archivo + archivo nuevo) no baja el
+    refcount del blob anterior exactamente en 1
+
+Además mide, por caso, las filas y bytes que se leen de la BD y los bytes de la respuesta;
+con --save/--compare se guarda una línea base y se comparan planes de carga antes/después.
+
+Uso:
+  python check_queries.py                     # tabla + exit code (para CI)
+  python check_queries.py --invitaciones 5000 --json
+  python check_queries.py --save volumen_base.json
+  python check_queries.py --compare volumen_base.json     # Δ filas/bytes por caso
+  DB_URL=postgresql://... python check_queries.py --force   # BD desechable de Postgres
+"""
+import os
+import sys
+import json
+import argparse
+import tempfile
+import contextlib
+import hashlib
+import io
+from pathlib import Path
+from typing import Optional
+
+def _args():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--invitaciones", type=int, default=3000)
+    ap.add_argument("--personas", type=int, default=200)
+    ap.add_argument("--actores", type=int, default=40)
+    ap.add_argument("--json", action="store_true", help="salida JSON en lugar de tabla")
+    ap.add_argument("--sql", action="store_true", help="mostrar las sentencias de cada caso")
+    ap.add_argument("--force", action="store_true", help="permitir DB_URL con invitaciones existentes")
+    ap.add_argument("--save", metavar="JSON", help="guardar sentencias/filas/bytes por caso como línea base")
+    ap.add_argument("--compare", metavar="JSON", help="comparar filas/bytes contra una línea base")
+    return ap.parse_args()
+
+args = _args()
+if not os.getenv("DB_URL"):
+    os.environ["DB_URL"] = "sqlite:///" + os.path.join(tempfile.mkdtemp(prefix="check_queries_"), "check.db")
+os.environ["QUERY_CHECK"] = "raise"
+os.environ.setdefault("NOTIF_ARCHIVE_EVERY_SEC", "0")
+os.environ.setdefault("METRICS_ENABLED", "0")
+os.environ.setdefault("PREVIEW_ENABLED", "0")
+os.environ.setdefault("SLOW_QUERY_MS", "0")
+
+from passlib.hash import bcrypt
+from sqlalchemy import event
+from db import engine, SessionLocal, Usuario, Blob
+import generar_datos
+import app as webapp
+
+USUARIO, PASSWORD = "check", "check"
+
+def _sembrar():
+    argv = ["--invitaciones", str(args.invitaciones), "--personas", str(args.personas),
+            "--actores", str(args.actores), "--lote", "2000"]
+    with contextlib.redirect_stdout(sys.stderr):   # stdout queda limpio para --json
+        generar_datos.main(argv + (["--force"] if args.force else []))
+    db = SessionLocal()
+    try:
+        if not db.query(Usuario).filter(Usuario.usuario == USUARIO).first():
+            db.add(Usuario(usuario=USUARIO, pwd_hash=bcrypt.hash(PASSWORD), rol="admin", activo=True))
+            db.commit()
+    finally:
+        db.close()
+
+def _enfriar():
+    """Vacía los cachés en memoria: el presupuesto debe alcanzar también para recargarlos."""
+    webapp.catalog_cache.bump()
+    webapp.municipio_resolver.invalidate()
+    webapp.typeahead_index.invalidate()
+    with webapp._auth_lock:
+        webapp._auth_cache.clear()
+
+def _tam(v):
+    if v is None:
+        return 0
+    if isinstance(v, str):
+        return len(v.encode("utf-8"))
+    if isinstance(v, (bytes, bytearray, memoryview)):
+        return len(v)
+    return len(str(v))
+
+class _CursorContado:
+    """Proxy del cursor DBAPI que suma las filas y bytes leídos (no depende del driver)."""
+    def __init__(self, cur, medida):
+        self._cur, self._medida = cur, medida
+    def __getattr__(self, k):
+        return getattr(self._cur, k)
+    def _contar(self, rows):
+        self._medida["filas"] += len(rows)
+        self._medida["bytes"] += sum(_tam(v) for r in rows for v in r)
+        return rows
+    def fetchone(self):
+        r = self._cur.fetchone()
+        if r is not None:
+            self._contar((r,))
+        return r
+    def fetchmany(self, *a):
+        return self._contar(self._cur.fetchmany(*a))
+    def fetchall(self):
+        return self._contar(self._cur.fetchall())
+
+def _casos(c):
+    """(nombre, método, ruta, kwargs del test client); ids reales de la BD sembrada."""
+    items = c.get("/api/invitations?limit=50").get_json()["items"]
+    inv_ids = [i["ID"] for i in items]
+    personas = c.get("/api/personas").get_json()
+    p_ids = [p["ID"] for p in personas]
+    actores = c.get("/api/actores").get_json()
+    a_id = (actores[0].get("ID") or actores[0].get("id")) if actores else None
+    region_id = c.get("/api/regiones").get_json()
+    region_id = (region_id[0]["id"] if isinstance(region_id, list) and region_id else 1)
+    muni = webapp.MUNICIPIOS_EDOMEX[0]
+    return [
+        ("me",               "GET",    "/api/auth/me", {}),
+        ("partidos",         "GET",    "/api/partidos", {}),
+        ("sexo",             "GET",    "/api/catalogo/sexo", {}),
+        ("catalog",          "GET",    "/api/catalog", {}),
+        ("personas",         "GET",    "/api/personas", {}),
+        ("actores",          "GET",    "/api/actores", {}),
+        ("regiones",         "GET",    "/api/regiones", {}),
+        ("region_personas",  "GET",    f"/api/regiones/{region_id}/personas", {}),
+        ("region_munis",     "GET",    "/api/region_municipios_all", {}),
+        ("recomendadas",     "GET",    f"/api/personas/recomendadas?municipio={muni}", {}),
+        ("by_persona",       "GET",    f"/api/invitaciones/by_persona?persona_id={p_ids[0]}", {}),
+        ("typeahead",        "GET",    "/api/typeahead?q=jose&tipo=todos", {}),
+        ("inv_lista",        "GET",    "/api/invitations", {}),
+        ("inv_pagina",       "GET",    "/api/invitations?limit=50", {}),
+        ("inv_busqueda",     "GET",    "/api/invitations?q=plaza&limit=50", {}),
+        ("updates",          "GET",    "/api/invitaciones/updates", {}),
+        ("notif_inv",        "GET",    f"/api/notificaciones/{inv_ids[0]}", {}),
+        ("notif_historial",  "GET",    f"/api/notificaciones/{inv_ids[0]}?historial=1", {}),
+        ("export",           "GET",    "/api/report/confirmados.xlsx", {}),
+        ("stream_stats",     "GET",    "/api/invitaciones/stream/stats", {}),
+        ("health",           "GET",    "/api/health", {}),
+        ("assign",           "POST",   "/api/assign",
+         {"json": {"id": inv_ids[1], "persona_id": p_ids[1], "force": True}}),
+        ("assign_bulk",      "POST",   "/api/assign/bulk",
+         {"json": {"force": True, "items": [{"id": i, "persona_id": p} for i, p in zip(inv_ids[2:22], p_ids[2:22])]}}),
+        ("inv_create",       "POST",   "/api/invitation/create",
+         {"data": {"actor_id": str(a_id), "fecha": "2030-01-15", "hora": "10:00", "evento": "Evento Check",
+                   "convoca_cargo": "Diputado", "partido_politico": "MORENA", "municipio": muni,
+                   "lugar": "Plaza cívica"}}),
+        ("inv_archivo",      "GET",    f"/api/invitation/{inv_ids[0]}/archivo", {}),
+        ("inv_preview",      "GET",    f"/api/invitation/{inv_ids[0]}/preview", {}),
+        ("stream",           "GET",    "/api/invitaciones/stream", {}),
+        ("files",            "GET",    "/api/files/no-existe.pdf", {}),
+        ("home",             "GET",    "/", {}),
+        ("login_page",       "GET",    "/login", {}),
+        ("inv_update",       "POST",   "/api/invitation/update",
+         {"data": {"id": inv_ids[3], "observaciones": "check", "hora": "23:15"}}),
+        ("person_create",    "POST",   "/api/person/create",
+         {"json": {"Nombre": "Persona Check", "Cargo": "Enlace", "RegionID": region_id}}),
+        ("person_update",    "POST",   "/api/person/update",
+         {"json": {"ID": p_ids[0], "Nombre": "Persona Check", "Cargo": "Coordinador"}}),
+        ("actor_create",     "POST",   "/api/actor/create", {"json": {"Nombre": "Actor Check", "Cargo": "Regidor"}}),
+        ("actor_update",     "POST",   "/api/actor/update", {"json": {"id": a_id, "Cargo": "Síndico"}}),
+        ("notif_claim",      "POST",   "/api/notificaciones/claim?limit=50&consumer=check", {}),
+        ("notif_ack",        "POST",   "/api/notificaciones/ack", {"json": {"ids": list(range(1, 21))}}),
+        ("notif_archivar",   "POST",   "/api/notificaciones/archivar", {}),
+        ("inv_delete",       "DELETE", f"/api/invitation/delete/{inv_ids[-1]}", {}),
+        ("person_delete",    "POST",   "/api/person/delete", {"json": {"ID": p_ids[-1]}}),
+        ("actor_delete",     "DELETE", f"/api/actor/delete/{actores[-1].get('ID') or actores[-1].get('id')}", {}),
+        ("auth_cache",       "GET",    "/api/auth/cache", {}),
+        ("metrics",          "GET",    "/api/metrics", {}),
+        ("consultas_lentas", "GET",    "/api/consultas_lentas", {}),
+        ("logout",           "POST",   "/api/auth/logout", {}),
+        ("login",            "POST",   "/api/auth/login", {"json": {"usuario": USUARIO, "password": PASSWORD}}),
+    ]
+
+def _refcount(digest):
+    db = SessionLocal()
+    try:
+        b = db.get(Blob, digest)
+        return b.refcount if b else 0
+    finally:
+        db.close()
+
+def _verificar_refcount(c) -> Optional[str]:
+    """Dos invitaciones comparten blob; reemplazar el de una debe soltarlo una sola vez."""
+    inv_ids = [i["ID"] for i in c.get("/api/invitations?limit=50").get_json()["items"]]
+    contenido = b"%PDF-1.4 check_queries refcount"
+    digest = hashlib.sha256(contenido).hexdigest()
+    a, b = inv_ids[30], inv_ids[31]
+    for inv_id in (a, b):
+        r = c.post("/api/invitation/update", content_type="multipart/form-data",
+                   data={"id": inv_id, "archivo": (io.BytesIO(contenido), "compartido.pdf")})
+        if r.status_code != 200:
+            return f"subir adjunto a {inv_id}: HTTP {r.status_code}"
+    antes = _refcount(digest)
+    r = c.post("/api/invitation/update", content_type="multipart/form-data",
+               data={"id": a, "eliminar_archivo": "1",
+                     "archivo": (io.BytesIO(b"%PDF-1.4 reemplazo"), "nuevo.pdf")})
+    if r.status_code != 200:
+        return f"reemplazar adjunto de {a}: HTTP {r.status_code}"
+    despues = _refcount(digest)
+    if despues != antes - 1:
+        return f"refcount del blob compartido pasó de {antes} a {despues} (se esperaba {antes - 1})"
+    return None
+
+def main():
+    _sembrar()
+    c = webapp.app.test_client()
+    r = c.post("/api/auth/login", json={"usuario": USUARIO, "password": PASSWORD})
+    if r.status_code != 200:
+        sys.exit(f"Login falló: {r.status_code}")
+
+    capturadas, medida = [], {"filas": 0, "bytes": 0}
+    event.listen(engine, "before_cursor_execute",
+                 lambda conn, cur, stmt, *a: capturadas.append(webapp.sql_shape(stmt)))
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def _contar_filas(conn, cursor, stmt, params, context, executemany):
+        # el resultado se arma después de este evento con context.cursor
+        if context is not None and context.cursor is cursor:
+            context.cursor = _CursorContado(cursor, medida)
+
+    resultados, fallas = [], []
+    for nombre, method, path, kw in _casos(c):
+        _enfriar()
+        capturadas.clear()
+        medida.update(filas=0, bytes=0)
+        with contextlib.redirect_stdout(sys.stderr):   # avisos de la app, fuera de --json
+            resp = c.open(path, method=method, **kw)
+            cuerpo_bytes = 0 if resp.mimetype == "text/event-stream" else len(resp.get_data())
+            resp.close()   # SSE: no consumir el stream
+        endpoint = webapp.app.url_map.bind("").match(path.split("?")[0], method=method)[0]
+        view = webapp.app.view_functions[endpoint]
+        budget = getattr(view, "query_budget", None)
+        cuerpo = resp.get_json(silent=True) or {}
+        detalle = cuerpo.get("detalle") if resp.status_code == 500 else None
+        fila = {"caso": nombre, "endpoint": endpoint, "status": resp.status_code,
+                "queries": int(resp.headers.get("X-Query-Count", -1)),
+                "budget": budget["max"] if budget else None,
+                "filas": medida["filas"], "bytes_bd": medida["bytes"], "bytes_resp": cuerpo_bytes,
+                "repetidas": (detalle or {}).get("repetidas", []), "sql": list(capturadas)}
+        if detalle or budget is None or resp.status_code >= 500:
+            fila["falla"] = ("sin presupuesto" if budget is None and not detalle else
+                             "N+1" if fila["repetidas"] else
+                             "excede presupuesto" if detalle else f"HTTP {resp.status_code}")
+            fallas.append(fila)
+        resultados.append(fila)
+
+    with contextlib.redirect_stdout(sys.stderr):
+        error_refcount = _verificar_refcount(c)
+
+    recorridos = {r["endpoint"] for r in resultados}
+    sin_cubrir = sorted(ep for ep in webapp.app.view_functions if ep not in recorridos and ep != "static")
+
+    if args.save:
+        base = {r["caso"]: {k: r[k] for k in ("queries", "filas", "bytes_bd", "bytes_resp")} for r in resultados}
+        Path(args.save).write_text(json.dumps(base, indent=2), encoding="utf-8")
+        print(f"Línea base guardada en {args.save}", file=sys.stderr)
+    base = json.loads(Path(args.compare).read_text(encoding="utf-8")) if args.compare else {}
+
+    if args.json:
+        if base:
+            for r in resultados:
+                r["base"] = base.get(r["caso"])
+        if not args.sql:
+            for r in resultados:
+                r.pop("sql")
+        print(json.dumps({"resultados": resultados, "sin_cubrir": sin_cubrir, "refcount": error_refcount or "ok"},
+                         ensure_ascii=False, indent=2))
+    else:
+        print(f"{'caso':<17} {'endpoint':<34} {'http':>4} {'sql':>4} {'presup.':>7} "
+              f"{'filas':>7} {'KB bd':>8} {'KB resp':>8}  estado")
+        print("-" * 108)
+        for r in resultados:
+            estado = r.get("falla", "ok")
+            print(f"{r['caso']:<17} {r['endpoint']:<34} {r['status']:>4} {r['queries']:>4} "
+                  f"{r['budget'] if r['budget'] is not None else '-':>7} {r['filas']:>7} "
+                  f"{r['bytes_bd'] / 1024:>8.1f} {r['bytes_resp'] / 1024:>8.1f}  {estado}")
+            b = base.get(r["caso"])
+            if b:
+                print(f"{'':<17} antes: sql {b['queries']}, filas {b['filas']}, "
+                      f"KB bd {b['bytes_bd'] / 1024:.1f}, KB resp {b['bytes_resp'] / 1024:.1f}")
+            for rep in r["repetidas"][:3]:
+                print(f"{'':<17} ×{rep['veces']}: {rep['sql'][:120]}")
+            if args.sql:
+                for stmt in r["sql"]:
+                    print(f"{'':<17} · {stmt[:160]}")
+        if sin_cubrir:
+            print(f"\nEndpoints sin caso en check_queries.py: {', '.join(sin_cubrir)}", file=sys.stderr)
+    if error_refcount:
+        print(f"\nRefcount de adjuntos: {error_refcount}", file=sys.stderr)
+    if fallas:
+        print(f"\n{len(fallas)} endpoint(s) fuera de presupuesto o sin declarar", file=sys.stderr)
+    if fallas or error_refcount:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,11 @@
 # db.py
 import os
-from datetime import datetime
+import time
+import unicodedata
+from datetime import datetime, timedelta
 from sqlalchemy import (
     create_engine, Column, Integer, String, Text, Boolean, Date, Time, DateTime,
-    ForeignKey, Index
+    ForeignKey, Index, Table, event, text, inspect, select, insert, delete
 )
 from sqlalchemy.orm import declarative_base, relationship, sessionmaker
 
@@ -16,6 +18,9 @@ SessionLocal = sessionmaker(bind=engine, expire_on_commit=False, future=True)
 Base = declarative_base()
 
 # ----------------- MODELOS -----------------
+# Las relaciones son lazy="raise": nada se carga implícitamente. Cada endpoint declara su
+# plan de carga (joinedload/selectinload/load_only) o lee columnas; un acceso no previsto
+# truena con InvalidRequestError en vez de disparar una consulta por fila.
 
 class Sexo(Base):
     __tablename__ = "sexo"
@@ -58,7 +63,7 @@ class Actor(Base):
     particular_cargo  = Column(Text)
     particular_tel    = Column(Text)
 
-    sexo      = relationship("Sexo")
+    sexo      = relationship("Sexo", lazy="raise")
 
 class Persona(Base):
     __tablename__ = "personas"
@@ -76,9 +81,9 @@ class Persona(Base):
     particular_tel    = Column(Text)
      # ... lo que ya tienes ...
     region_id         = Column(Integer, ForeignKey("regiones.id", ondelete="SET NULL"))
-    region        = relationship("Region", back_populates="personas")
-    sexo          = relationship("Sexo")
-    invitaciones  = relationship("Invitacion", back_populates="persona", lazy="selectin")
+    region        = relationship("Region", back_populates="personas", lazy="raise")
+    sexo          = relationship("Sexo", lazy="raise")
+    invitaciones  = relationship("Invitacion", back_populates="persona", lazy="raise")
 
 class Invitacion(Base):
     __tablename__ = "invitaciones"
@@ -106,24 +111,159 @@ class Invitacion(Base):
     actor_id             = Column(Integer, ForeignKey("actores.id", ondelete="SET NULL"), nullable=True)
     persona_id           = Column(Integer, ForeignKey("personas.id", ondelete="SET NULL"), nullable=True)
 
-    actor                = relationship("Actor", lazy="joined")
-    persona              = relationship("Persona", back_populates="invitaciones", lazy="joined")
+    actor                = relationship("Actor", lazy="raise")
+    persona              = relationship("Persona", back_populates="invitaciones", lazy="raise")
 
     archivo_url          = Column(Text)
     archivo_nombre       = Column(Text)
     archivo_mime         = Column(Text)
     archivo_tamano       = Column(Integer)
     archivo_ts           = Column(DateTime)
+    # sha256 del contenido cuando el archivo vive en el almacén por contenido (blobs/)
+    archivo_sha256       = Column(String(64), index=True)
     grupo_token          = Column(Text)
     sub_tipo             = Column(Text)
 
+    # texto de búsqueda sin acentos/minúsculas (lo llena before_insert/before_update)
+    busqueda             = Column(Text)
+
     __table_args__ = (
         Index("idx_invitaciones_estatus", "estatus"),
         Index("idx_invitaciones_fecha", "fecha"),
         Index("idx_invitaciones_actor", "actor_id"),
         Index("idx_invitaciones_persona", "persona_id"),
+        # orden de /api/invitations (paginación keyset)
+        Index("idx_invitaciones_fecha_hora_id", "fecha", "hora", "id"),
+        # agenda por responsable (validación de traslapes en /api/assign)
+        Index("idx_invitaciones_persona_agenda", "persona_id", "fecha", "estatus"),
+        Index("idx_invitaciones_actor_agenda", "actor_id", "fecha", "estatus"),
     )
 
+# ----------------- BÚSQUEDA -----------------
+
+def fold_text(s) -> str:
+    """Minúsculas, sin diacríticos y con espacios colapsados ("José  PÉREZ" -> "jose perez")."""
+    if not s:
+        return ""
+    t = unicodedata.normalize("NFD", " ".join(str(s).split()))
+    return "".join(ch for ch in t if not unicodedata.combining(ch)).casefold()
+
+SEARCH_FIELDS = ("evento", "lugar", "convoca", "partido_politico", "municipio")
+
+def inv_busqueda(values) -> str:
+    """Texto de Invitacion.busqueda a partir de un objeto o un dict con SEARCH_FIELDS."""
+    get = values.get if isinstance(values, dict) else (lambda k: getattr(values, k, None))
+    return fold_text(" ".join(str(get(k) or "") for k in SEARCH_FIELDS))
+
+@event.listens_for(Invitacion, "before_insert")
+@event.listens_for(Invitacion, "before_update")
+def _set_busqueda(mapper, connection, target):
+    target.busqueda = inv_busqueda(target)
+
+FTS_TRIGGERS = ("invitaciones_fts_ai", "invitaciones_fts_ad", "invitaciones_fts_au")
+
+def setup_search(bind) -> str:
+    """
+    Índice de búsqueda según el motor (idempotente). Devuelve el modo instalado:
+      - postgresql: extensión pg_trgm + índice GIN trigram sobre invitaciones.busqueda
+      - sqlite: tabla FTS5 (tokenizer trigram) sincronizada por triggers
+
+    En SQLite la FTS5 (external content) va ligada a invitaciones.fts_id, una columna
+    INTEGER explícita que sólo existe en SQLite (no está en el modelo): invitaciones
+    tiene PK de texto, y su rowid implícito puede renumerarse con VACUUM, lo que dejaría
+    al índice apuntando a otras filas. fts_id la asigna el trigger de INSERT (MAX + 1)
+    y no cambia nunca. Índices creados con la versión anterior (content_rowid='rowid')
+    se reemplazan aquí; cada llamada termina con un 'rebuild' completo.
+    """
+    dialect = bind.dialect.name
+    with bind.begin() as conn:
+        if dialect == "postgresql":
+            conn.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+            conn.execute(text(
+                "CREATE INDEX IF NOT EXISTS idx_invitaciones_busqueda_trgm "
+                "ON invitaciones USING gin (busqueda gin_trgm_ops)"
+            ))
+            return "pg_trgm"
+        if dialect == "sqlite":
+            cols = {r[1] for r in conn.execute(text("PRAGMA table_info(invitaciones)"))}
+            if "fts_id" not in cols:
+                conn.execute(text("ALTER TABLE invitaciones ADD COLUMN fts_id INTEGER"))
+            # filas sin fts_id (previas a la columna): rowid es único, se suma al máximo actual
+            conn.execute(text(
+                "UPDATE invitaciones SET fts_id = rowid + "
+                "(SELECT COALESCE(MAX(fts_id), 0) FROM invitaciones) WHERE fts_id IS NULL"
+            ))
+            conn.execute(text(
+                "CREATE UNIQUE INDEX IF NOT EXISTS idx_invitaciones_fts_id ON invitaciones (fts_id)"
+            ))
+            ddl = conn.execute(text(
+                "SELECT sql FROM sqlite_master WHERE name = 'invitaciones_fts'"
+            )).scalar()
+            if ddl and "content_rowid='fts_id'" not in ddl:
+                conn.execute(text("DROP TABLE invitaciones_fts"))
+            for trg in FTS_TRIGGERS:
+                conn.execute(text(f"DROP TRIGGER IF EXISTS {trg}"))
+            conn.execute(text(
+                "CREATE VIRTUAL TABLE IF NOT EXISTS invitaciones_fts USING fts5("
+                "busqueda, content='invitaciones', content_rowid='fts_id', tokenize='trigram')"
+            ))
+            conn.execute(text(
+                "CREATE TRIGGER invitaciones_fts_ai AFTER INSERT ON invitaciones BEGIN "
+                "UPDATE invitaciones SET fts_id = (SELECT COALESCE(MAX(fts_id), 0) + 1 FROM invitaciones) "
+                "WHERE rowid = new.rowid AND fts_id IS NULL; "
+                "INSERT INTO invitaciones_fts(rowid, busqueda) "
+                "SELECT fts_id, busqueda FROM invitaciones WHERE rowid = new.rowid; END"
+            ))
+            conn.execute(text(
+                "CREATE TRIGGER invitaciones_fts_ad AFTER DELETE ON invitaciones BEGIN "
+                "INSERT INTO invitaciones_fts(invitaciones_fts, rowid, busqueda) VALUES ('delete', old.fts_id, old.busqueda); END"
+            ))
+            conn.execute(text(
+                "CREATE TRIGGER invitaciones_fts_au AFTER UPDATE OF busqueda ON invitaciones BEGIN "
+                "INSERT INTO invitaciones_fts(invitaciones_fts, rowid, busqueda) VALUES ('delete', old.fts_id, old.busqueda); "
+                "INSERT INTO invitaciones_fts(rowid, busqueda) VALUES (new.fts_id, new.busqueda); END"
+            ))
+            conn.execute(text("INSERT INTO invitaciones_fts(invitaciones_fts) VALUES ('rebuild')"))
+            return "fts5"
+    return "none"
+
+def backfill_busqueda(bind, batch: int = 5000) -> int:
+    """Llena invitaciones.busqueda donde esté vacía (filas previas a la columna)."""
+    total = 0
+    cols = ", ".join(SEARCH_FIELDS)
+    while True:
+        with bind.begin() as conn:
+            rows = conn.execute(
+                text(f"SELECT id, {cols} FROM invitaciones WHERE busqueda IS NULL LIMIT :n"), {"n": batch}
+            ).mappings().all()
+            if not rows:
+                return total
+            conn.execute(
+                text("UPDATE invitaciones SET busqueda = :b WHERE id = :id"),
+                [{"id": r["id"], "b": inv_busqueda(dict(r))} for r in rows],
+            )
+            total += len(rows)
+
+def add_missing_columns(bind) -> list:
+    """
+    create_all no altera tablas existentes: agrega aquí las columnas nuevas de los
+    modelos que falten en la BD (siempre nullable, sin default).
+    """
+    added = []
+    insp = inspect(bind)
+    existing_tables = set(insp.get_table_names())
+    with bind.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            if table.name not in existing_tables:
+                continue
+            have = {c["name"] for c in insp.get_columns(table.name)}
+            for col in table.columns:
+                if col.name not in have:
+                    ddl = col.type.compile(dialect=bind.dialect)
+                    conn.execute(text(f'ALTER TABLE {table.name} ADD COLUMN {col.name} {ddl}'))
+                    added.append(f"{table.name}.{col.name}")
+    return added
+
 class Notificacion(Base):
     __tablename__ = "notificaciones"
     id                = Column(Integer, primary_key=True)
@@ -164,8 +304,21 @@ class Notificacion(Base):
     enviado           = Column(Boolean, default=False, nullable=False)
     enviado_ts        = Column(DateTime)
 
+    # Modo coalescido: JSON [{"campo","anterior","nuevo"}, ...] con todos los cambios de la
+    # misma operación; campo/valor_* guardan el cambio principal (el que lee el bot).
+    # NULL en filas clásicas (un cambio por fila). Ver vista notificaciones_detalle.
+    cambios           = Column(Text)
+
+    # Lease del bot (/api/notificaciones/claim): quién la tomó y hasta cuándo
+    lease_owner       = Column(String(64))
+    lease_until       = Column(DateTime)
+
     __table_args__ = (
         Index("idx_notif_enviado", "enviado"),
+        # Parcial: sólo filas pendientes, en orden de id (lo que recorre el claim; el
+        # predicado coincide con `enviado = false` tal como lo compila SQLAlchemy)
+        Index("idx_notif_pendientes", "id", "lease_until",
+              postgresql_where=text("enviado = false"), sqlite_where=text("enviado = 0")),
         Index("idx_notif_ts", "ts"),
         Index("idx_notif_inv_id", "invitacion_id"),
     )
@@ -178,8 +331,8 @@ class Region(Base):
     slug   = Column(Text, unique=True)
     color  = Column(Text)   # opcional (para mapita / badges)
 
-    municipios = relationship("RegionMunicipio", back_populates="region", lazy="joined")
-    personas   = relationship("Persona", back_populates="region", lazy="selectin")
+    municipios = relationship("RegionMunicipio", back_populates="region", lazy="raise")
+    personas   = relationship("Persona", back_populates="region", lazy="raise")
 
 
 class RegionMunicipio(Base):
@@ -189,4 +342,119 @@ class RegionMunicipio(Base):
     region_id = Column(Integer, ForeignKey("regiones.id", ondelete="CASCADE"), nullable=False)
     municipio = Column(Text, nullable=False)  # usa el nombre canónico tal como lo valida VALID_MUNICIPIOS
 
-    region = relationship("Region", back_populates="municipios")
+    region = relationship("Region", back_populates="municipios", lazy="raise")
+
+
+# Contador de cambios por colección (ETag de los listados). Lo incrementa app.py
+# en la misma transacción que modifica la colección.
+COLECCIONES = ("invitaciones", "personas", "actores", "regiones")
+
+class ColeccionVersion(Base):
+    __tablename__ = "colecciones_version"
+
+    nombre  = Column(String(40), primary_key=True)
+    version = Column(Integer, nullable=False, default=0)
+
+class Blob(Base):
+    """Archivo subido, guardado una sola vez bajo su sha256; refcount = invitaciones que lo usan."""
+    __tablename__ = "blobs"
+
+    digest   = Column(String(64), primary_key=True)
+    tamano   = Column(Integer)
+    mime     = Column(Text)
+    refcount = Column(Integer, nullable=False, default=0)
+    creado   = Column(DateTime, default=datetime.utcnow)
+
+# ----------------- RETENCIÓN DE NOTIFICACIONES -----------------
+# Notificaciones enviadas y viejas salen de la tabla caliente a notificaciones_archivo
+# (mismas columnas). En Postgres el archivo está particionado por mes sobre ts; en SQLite
+# es una tabla simple. PK (id, ts): la llave de partición debe ser parte de la PK.
+NotificacionArchivo = Table(
+    "notificaciones_archivo", Base.metadata,
+    *[Column(c.name, c.type, primary_key=c.name in ("id", "ts"), autoincrement=False)
+      for c in Notificacion.__table__.columns],
+    Index("idx_notif_arch_inv_ts", "invitacion_id", "ts"),
+    postgresql_partition_by="RANGE (ts)",
+)
+
+_ARCHIVO_LOCK = 0x6E6F7469   # pg_advisory lock: un solo worker archivando a la vez
+
+def ensure_archivo_partitions(conn, meses) -> None:
+    """Crea (si faltan) las particiones mensuales de notificaciones_archivo. `meses`: dates día 1."""
+    if conn.dialect.name != "postgresql":
+        return
+    for m in sorted(set(meses)):
+        sig = (m.replace(day=28) + timedelta(days=4)).replace(day=1)
+        conn.execute(text(
+            f"CREATE TABLE IF NOT EXISTS notificaciones_archivo_{m:%Y%m} "
+            f"PARTITION OF notificaciones_archivo FOR VALUES FROM ('{m:%Y-%m-%d}') TO ('{sig:%Y-%m-%d}')"
+        ))
+
+def archive_notificaciones(bind, older_than_days: int = 90, batch: int = 1000,
+                           max_batches: int = None, pause: float = 0.0) -> int:
+    """
+    Mueve a notificaciones_archivo las notificaciones ENVIADAS con ts anterior al horizonte.
+    Lotes acotados, cada uno en su propia transacción (INSERT ... SELECT + DELETE por id),
+    para no bloquear la tabla caliente. Devuelve cuántas filas movió.
+    """
+    N, A = Notificacion.__table__, NotificacionArchivo
+    cols = [c.name for c in N.columns]
+    cutoff = datetime.utcnow() - timedelta(days=older_than_days)
+    moved = lotes = 0
+    while max_batches is None or lotes < max_batches:
+        with bind.begin() as conn:
+            if conn.dialect.name == "postgresql" and not conn.execute(
+                text("SELECT pg_try_advisory_xact_lock(:k)"), {"k": _ARCHIVO_LOCK}
+            ).scalar():
+                return moved    # otro worker está archivando
+            rows = conn.execute(
+                select(N.c.id, N.c.ts)
+                .where(N.c.enviado == True, N.c.ts < cutoff)
+                .order_by(N.c.ts)
+                .limit(batch)
+            ).all()
+            if not rows:
+                return moved
+            ids = [r.id for r in rows]
+            ensure_archivo_partitions(conn, (r.ts.date().replace(day=1) for r in rows))
+            conn.execute(insert(A).from_select(cols, select(*(N.c[c] for c in cols)).where(N.c.id.in_(ids))))
+            conn.execute(delete(N).where(N.c.id.in_(ids)))
+        moved += len(ids)
+        lotes += 1
+        if pause:
+            time.sleep(pause)
+    return moved
+
+# Columnas de la vista que vienen de cada cambio (el resto se copia de la fila)
+_NOTIF_DELTA_COLS = ("campo", "valor_anterior", "valor_nuevo")
+
+def setup_notif_views(bind) -> None:
+    """
+    Vista de compatibilidad notificaciones_detalle: una fila por cambio, como antes de
+    coalescer. Filas clásicas pasan tal cual; filas con `cambios` se expanden por delta
+    (json_each en SQLite, jsonb_array_elements en Postgres). `id` es el de la fila base,
+    así que marcar enviado sigue siendo UPDATE notificaciones ... WHERE id = :id.
+    """
+    dialect = bind.dialect.name
+    if dialect == "postgresql":
+        expand = "CROSS JOIN LATERAL jsonb_array_elements(n.cambios::jsonb) AS c"
+        delta = "c.value->>'{}'"
+    elif dialect == "sqlite":
+        expand = "JOIN json_each(n.cambios) AS c"
+        delta = "json_extract(c.value, '$.{}')"
+    else:
+        return
+    cols = [c.name for c in Notificacion.__table__.columns if c.name != "cambios"]
+    plain = ", ".join(f"n.{c}" for c in cols)
+    keys = {"campo": "campo", "valor_anterior": "anterior", "valor_nuevo": "nuevo"}
+    expanded = ", ".join(
+        f"{delta.format(keys[c])} AS {c}" if c in _NOTIF_DELTA_COLS else f"n.{c}" for c in cols
+    )
+    with bind.begin() as conn:
+        conn.execute(text("DROP VIEW IF EXISTS notificaciones_detalle"))
+        conn.execute(text(
+            "CREATE VIEW notificaciones_detalle AS "
+            f"SELECT {plain} FROM notificaciones n WHERE n.cambios IS NULL "
+            "UNION ALL "
+            f"SELECT {expanded} FROM notificaciones n {expand} WHERE n.cambios IS NOT NULL"
+        ))
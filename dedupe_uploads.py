@@ -0,0 +1,132 @@
+# dedupe_uploads.py
+"""
+Migra los archivos subidos al almacén por contenido (UPLOAD_ROOT/blobs/<sha256>).
+
+  1. Cada invitación con archivo local fuera de blobs/ se hashea y pasa a apuntar al blob
+     (archivo_url + archivo_sha256); copias idénticas de un mismo grupo quedan en un solo blob.
+     Los originales se borran al final.
+  2. Recalcula blobs.refcount a partir de invitaciones (repara contadores).
+  3. Limpieza: blobs sin referencias (y sus vistas previas) y temporales viejos de blobs/tmp.
+
+Uso:
+  python dedupe_uploads.py --dry-run     # sólo reporta
+  python dedupe_uploads.py
+"""
+import os
+import sys
+import hashlib
+import time
+import argparse
+
+from sqlalchemy import select, update, delete, func
+
+from db import Base, engine, SessionLocal, Invitacion, Blob, add_missing_columns
+import app as webapp
+
+def _args():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--dry-run", action="store_true")
+    ap.add_argument("--lote", type=int, default=200, help="invitaciones por transacción")
+    ap.add_argument("--gracia", type=int, default=3600,
+                    help="segundos: no borra blobs/temporales más nuevos que esto (subidas en curso)")
+    return ap.parse_args()
+
+def migrar(args) -> dict:
+    root = webapp.UPLOAD_ROOT
+    db = SessionLocal()
+    stats = {"invitaciones": 0, "faltantes": 0, "bytes": 0, "blobs": set()}
+    originales = set()
+    try:
+        pendientes = (db.query(Invitacion)
+                        .filter(Invitacion.archivo_url.isnot(None), Invitacion.archivo_sha256.is_(None))
+                        .order_by(Invitacion.id)
+                        .all())
+        for k, inv in enumerate(pendientes, 1):
+            rel = (inv.archivo_url or "").strip().lstrip("/")
+            if not rel or webapp._is_http_url(rel) or rel.startswith("blobs/"):
+                continue
+            path = root / rel
+            if not path.is_file():
+                stats["faltantes"] += 1
+                print(f"⚠️ {inv.id}: no existe {path}", file=sys.stderr)
+                continue
+            stats["invitaciones"] += 1
+            if args.dry_run:
+                h = hashlib.sha256()
+                with open(path, "rb") as f:
+                    for chunk in iter(lambda: f.read(webapp.UPLOAD_CHUNK), b""):
+                        h.update(chunk)
+                digest = h.hexdigest()
+                if digest not in stats["blobs"]:
+                    stats["bytes"] += path.stat().st_size
+                stats["blobs"].add(digest)
+                continue
+            with open(path, "rb") as f:
+                digest, tamano, tmp = webapp.write_hashed(f)
+            if digest not in stats["blobs"]:
+                stats["bytes"] += tamano
+            stats["blobs"].add(digest)
+            webapp.blob_ref(db, digest, tamano, inv.archivo_mime)
+            webapp._blob_pending(db)["mover"].append((tmp, root / webapp.blob_relpath(digest)))
+            inv.archivo_url = webapp.blob_relpath(digest)
+            inv.archivo_sha256 = digest
+            originales.add(path)
+            if k % args.lote == 0:
+                db.commit()
+        if not args.dry_run:
+            db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+
+    # Originales: ya nadie apunta a ellos
+    for path in originales:
+        try:
+            path.unlink()
+            if not any(path.parent.iterdir()):
+                path.parent.rmdir()
+        except OSError as e:
+            print(f"⚠️ No se pudo borrar {path}: {e}", file=sys.stderr)
+    stats["blobs"] = len(stats["blobs"])
+    return stats
+
+def recontar() -> int:
+    refs = (select(func.count(Invitacion.id))
+            .where(Invitacion.archivo_sha256 == Blob.digest)
+            .scalar_subquery())
+    with engine.begin() as conn:
+        n = conn.execute(update(Blob.__table__).values(refcount=refs)).rowcount
+        conn.execute(delete(Blob.__table__).where(Blob.refcount <= 0))
+    return n
+
+def limpiar(args) -> int:
+    with engine.connect() as conn:
+        vivos = {d for (d,) in conn.execute(select(Blob.digest).where(Blob.refcount > 0))}
+    limite = time.time() - args.gracia
+    borrados = 0
+    for dirpath, _, files in os.walk(webapp.UPLOAD_BLOB_PATH):
+        for name in files:
+            p = os.path.join(dirpath, name)
+            es_tmp = os.path.basename(dirpath) == "tmp"
+            # derivados (<sha256>.preview-*) siguen la suerte de su blob
+            if (es_tmp or name.split(".", 1)[0] not in vivos) and os.path.getmtime(p) < limite:
+                if not args.dry_run:
+                    os.unlink(p)
+                borrados += 1
+    return borrados
+
+def main():
+    args = _args()
+    Base.metadata.create_all(engine)   # tabla blobs
+    add_missing_columns(engine)        # invitaciones.archivo_sha256
+    s = migrar(args)
+    print(f"{'[dry-run] ' if args.dry_run else ''}{s['invitaciones']} archivos -> {s['blobs']} blobs "
+          f"({s['bytes'] / 1e6:.1f} MB únicos), {s['faltantes']} faltantes")
+    if not args.dry_run:
+        print(f"refcount recalculado en {recontar()} blobs")
+    print(f"{'[dry-run] ' if args.dry_run else ''}{limpiar(args)} archivos sin referencia eliminados")
+
+if __name__ == "__main__":
+    main()
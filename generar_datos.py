@@ -0,0 +1,343 @@
+# generar_datos.py
+"""
+Genera un conjunto de datos sintético con volúmenes de producción para reproducir
+localmente los endpoints lentos (listados, agenda, reportes, notificaciones).
+
+  - regiones y region_municipios cubriendo los 125 municipios (si aún no hay regiones)
+  - miles de personas repartidas en las regiones y cientos de actores
+  - 100k-1M invitaciones sobre MUNICIPIOS_EDOMEX con mezcla realista de estatus,
+    grupos (grupo_token pre/publico) y agendas densas en el mismo día
+  - historial de notificaciones coherente con cada asignación (snapshot de notif_snapshot)
+
+Todo se inserta con executemany por lotes (Core, sin ORM); busqueda se llena con
+inv_busqueda y al final se corre init_db (índices, FTS/pg_trgm, vistas) y se
+incrementa colecciones_version para invalidar cachés/ETags de una app en marcha.
+
+Uso:
+  DB_URL=sqlite:///carga.db python generar_datos.py                    # 100k invitaciones
+  DB_URL=sqlite:///carga.db python generar_datos.py --invitaciones 1000000 --personas 5000
+  DB_URL=postgresql://... python generar_datos.py --force              # BD con datos
+"""
+import sys
+import random
+import argparse
+import time
+from datetime import date, datetime, time as dtime, timedelta
+from types import SimpleNamespace
+
+from sqlalchemy import insert, select, func, text
+
+import init_db
+from db import (
+    Base, engine, SessionLocal, Sexo, Partido, Region, RegionMunicipio, Persona, Actor,
+    Invitacion, Notificacion, COLECCIONES, inv_busqueda, add_missing_columns
+)
+import app as webapp
+
+NOMBRES   = ["José", "María", "Juan", "Guadalupe", "Luis", "Ana", "Carlos", "Verónica", "Miguel",
+             "Alejandra", "Jorge", "Leticia", "Francisco", "Rosa", "Héctor", "Gabriela", "Raúl", "Patricia"]
+APELLIDOS = ["Hernández", "García", "Martínez", "López", "González", "Pérez", "Rodríguez", "Sánchez",
+             "Ramírez", "Cruz", "Flores", "Gómez", "Morales", "Vázquez", "Jiménez", "Reyes", "Díaz", "Núñez"]
+CARGOS_P  = ["Enlace municipal", "Coordinador regional", "Delegada", "Subdelegado", "Asesor",
+             "Director de área", "Jefa de departamento", "Secretario técnico"]
+CARGOS_A  = ["Diputado local", "Diputada federal", "Presidente municipal", "Presidenta municipal",
+             "Senador", "Regidor", "Síndica", "Secretario de Estado", "Delegado federal"]
+EVENTOS   = ["Reunión vecinal", "Informe de actividades", "Arranque de obra", "Foro juvenil",
+             "Entrega de apoyos", "Asamblea informativa", "Festival cultural", "Mesa de trabajo",
+             "Inauguración de pozo", "Jornada de salud", "Encuentro con comerciantes", "Gira de trabajo"]
+LUGARES   = ["Plaza cívica", "Auditorio municipal", "Casa de cultura", "Explanada", "Salón ejidal",
+             "Deportivo", "Escuela primaria", "Mercado municipal", "Palacio municipal", "Unidad habitacional"]
+PARTIDOS  = ["MORENA", "PAN", "PRI", "PRD", "MC", "PVEM", "INDEPENDIENTE"]
+COLORES   = ["#1f77b4", "#ff7f0e", "#2ca02c", "#d62728", "#9467bd", "#8c564b", "#e377c2", "#7f7f7f"]
+# hora de inicio: agenda cargada en la mañana y al final de la tarde
+HORAS     = [7, 8, 9, 10, 11, 12, 13, 14, 15, 16, 17, 18, 19, 20]
+HORAS_W   = [2, 5, 9, 10, 10, 8, 6, 4, 4, 6, 8, 7, 4, 2]
+# mezcla de estatus según si el evento ya pasó
+ESTATUS   = ["Pendiente", "Confirmado", "Sustituido", "Cancelado"]
+MEZCLA_PASADO = [20, 58, 8, 14]
+MEZCLA_FUTURO = [62, 28, 4, 6]
+
+def _args(argv=None):
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--invitaciones", type=int, default=100_000)
+    ap.add_argument("--personas", type=int, default=3000)
+    ap.add_argument("--actores", type=int, default=400)
+    ap.add_argument("--regiones", type=int, default=8, help="sólo si la BD aún no tiene regiones")
+    ap.add_argument("--dias", type=int, default=540, help="ventana de fechas (termina 60 días en el futuro)")
+    ap.add_argument("--grupos", type=float, default=0.15, help="fracción de invitaciones en grupo (grupo_token)")
+    ap.add_argument("--lote", type=int, default=10_000, help="filas por executemany")
+    ap.add_argument("--seed", type=int, default=2025)
+    ap.add_argument("--sin-notificaciones", action="store_true")
+    ap.add_argument("--force", action="store_true", help="permitir una BD que ya tiene invitaciones")
+    return ap.parse_args(argv)
+
+def _nombre(rnd):
+    return f"{rnd.choice(NOMBRES)} {rnd.choice(APELLIDOS)} {rnd.choice(APELLIDOS)}"
+
+def _tel(rnd):
+    return f"55 {rnd.randrange(1000, 9999)} {rnd.randrange(1000, 9999)}"
+
+def _next_id(conn, model):
+    return (conn.execute(select(func.max(model.id))).scalar() or 0) + 1
+
+def _bulk(conn, table, rows, lote):
+    for i in range(0, len(rows), lote):
+        conn.execute(insert(table), rows[i:i + lote])
+
+def _sync_sequences(conn, *tables):
+    """En Postgres los ids explícitos no mueven la secuencia serial; se reajusta al máximo."""
+    if conn.dialect.name != "postgresql":
+        return
+    for t in tables:
+        conn.execute(text(
+            f"SELECT setval(pg_get_serial_sequence('{t}', 'id'), COALESCE((SELECT MAX(id) FROM {t}), 1))"
+        ))
+
+# ----------------- catálogos -----------------
+def sembrar_catalogos(conn):
+    for model, nombres in ((Sexo, ["Hombre", "Mujer", "No especificado"]), (Partido, PARTIDOS)):
+        existentes = set(conn.execute(select(model.nombre)).scalars())
+        faltan = [{"nombre": n} for n in nombres if n not in existentes]
+        if faltan:
+            conn.execute(insert(model.__table__), faltan)
+    return [i for (i,) in conn.execute(select(Sexo.id).order_by(Sexo.id))]
+
+def generar_regiones(conn, rnd, n_regiones):
+    """Devuelve {municipio: region_id}; crea regiones sólo si la tabla está vacía."""
+    pares = conn.execute(select(RegionMunicipio.municipio, RegionMunicipio.region_id)).all()
+    if pares:
+        return dict(pares)
+    munis = list(webapp.MUNICIPIOS_EDOMEX)
+    rnd.shuffle(munis)
+    base = _next_id(conn, Region)
+    regiones = [{"id": base + k, "nombre": f"Región {k + 1}", "slug": f"region-{k + 1}",
+                 "color": COLORES[k % len(COLORES)]} for k in range(n_regiones)]
+    conn.execute(insert(Region.__table__), regiones)
+    asignacion = {m: regiones[k % n_regiones]["id"] for k, m in enumerate(munis)}
+    conn.execute(insert(RegionMunicipio.__table__),
+                 [{"region_id": r, "municipio": m} for m, r in asignacion.items()])
+    return asignacion
+
+def generar_personas(conn, rnd, n, sexos, region_nombres, lote):
+    base = _next_id(conn, Persona)
+    rows = []
+    for k in range(n):
+        region_id = rnd.choice(list(region_nombres))
+        rows.append({
+            "id": base + k, "nombre": _nombre(rnd), "cargo": rnd.choice(CARGOS_P), "telefono": _tel(rnd),
+            "correo": f"persona{base + k}@ejemplo.mx", "unidad_region": region_nombres[region_id],
+            "activo": rnd.random() > 0.05, "sexo_id": rnd.choice(sexos), "region_id": region_id,
+            "particular_nombre": _nombre(rnd) if rnd.random() < 0.3 else None,
+            "particular_cargo": "Secretario particular" if rnd.random() < 0.3 else None,
+            "particular_tel": _tel(rnd) if rnd.random() < 0.3 else None,
+        })
+    _bulk(conn, Persona.__table__, rows, lote)
+    return rows
+
+def generar_actores(conn, rnd, n, sexos, lote):
+    base = _next_id(conn, Actor)
+    rows = [{
+        "id": base + k, "nombre": _nombre(rnd), "cargo": rnd.choice(CARGOS_A), "telefono": _tel(rnd),
+        "sexo_id": rnd.choice(sexos), "activo": rnd.random() > 0.03,
+        "particular_nombre": _nombre(rnd), "particular_cargo": "Secretaria particular",
+        "particular_tel": _tel(rnd),
+    } for k in range(n)]
+    _bulk(conn, Actor.__table__, rows, lote)
+    return rows
+
+# ----------------- invitaciones + notificaciones -----------------
+class Generador:
+    """Produce invitaciones por lotes; cada una trae su historial de notificaciones."""
+
+    def __init__(self, rnd, args, personas, actores, muni_region):
+        self.rnd, self.args = rnd, args
+        hoy = date.today()
+        self.dias = [hoy + timedelta(days=60 - d) for d in range(args.dias)]
+        # entre semana hay más eventos que en fin de semana
+        self.dias_w = [(1.0, 1.0, 1.0, 1.0, 1.0, 0.7, 0.4)[d.weekday()] for d in self.dias]
+        self.hoy = hoy
+        self.now = datetime.utcnow()
+        # pocos municipios concentran la mayoría (Zipf suave)
+        munis = list(webapp.MUNICIPIOS_EDOMEX)
+        rnd.shuffle(munis)
+        self.munis, self.munis_w = munis, [1 / (k + 1) ** 0.8 for k in range(len(munis))]
+        # actores y personas "ocupados": 20% concentra ~80% de la carga -> agendas densas
+        self.actores = actores
+        self.actores_w = [5 if rnd.random() < 0.2 else 1 for _ in actores]
+        activas = [p for p in personas if p["activo"]] or personas
+        por_region = {}
+        for p in activas:
+            por_region.setdefault(p["region_id"], []).append(p)
+        self.por_region = {r: (ps, [16 if rnd.random() < 0.2 else 1 for _ in ps]) for r, ps in por_region.items()}
+        self.todas = (activas, [1] * len(activas))
+        self.muni_region = muni_region
+        # objetos con atributos para notif_snapshot (espera Persona/Actor)
+        self.p_ns = {p["id"]: SimpleNamespace(**p) for p in personas}
+        self.a_ns = {a["id"]: SimpleNamespace(**a) for a in actores}
+
+    def _persona_para(self, muni):
+        ps, w = self.por_region.get(self.muni_region.get(muni), self.todas)
+        return self.rnd.choices(ps, w)[0]
+
+    def _inv_id(self):
+        return "%032x" % self.rnd.getrandbits(128)
+
+    def _base(self, fecha, hora, actor, muni, lugar, evento, grupo_token=None, sub_tipo=None):
+        r = {
+            "id": self._inv_id(), "fecha": fecha, "hora": hora, "evento": evento,
+            "convoca_cargo": actor["cargo"], "convoca": actor["nombre"],
+            "partido_politico": self.rnd.choice(PARTIDOS), "municipio": muni, "lugar": lugar,
+            "estatus": "Pendiente", "asignado_a": None, "rol": None,
+            "observaciones": "Acude con equipo de logística" if self.rnd.random() < 0.1 else None,
+            "fecha_asignacion": None, "actor_id": actor["id"], "persona_id": None,
+            "grupo_token": grupo_token, "sub_tipo": sub_tipo, "modificado_por": "generador",
+        }
+        r["ultima_modificacion"] = datetime.combine(fecha, dtime()) - timedelta(days=self.rnd.randrange(3, 30))
+        r["busqueda"] = inv_busqueda(r)
+        return r
+
+    def invitaciones(self, n):
+        """Genera n filas (los grupos comparten fecha, lugar, actor y grupo_token)."""
+        rnd, out = self.rnd, []
+        while len(out) < n:
+            fecha = rnd.choices(self.dias, self.dias_w)[0]
+            muni = rnd.choices(self.munis, self.munis_w)[0]
+            actor = rnd.choices(self.actores, self.actores_w)[0]
+            lugar = f"{rnd.choice(LUGARES)}, {muni}"
+            evento = f"{rnd.choice(EVENTOS)} {rnd.randrange(1, 500)}"
+            h = rnd.choices(HORAS, HORAS_W)[0]
+            m = rnd.choice((0, 0, 15, 30, 30, 45))
+            if rnd.random() < self.args.grupos and n - len(out) >= 2:
+                token = "%016x" % rnd.getrandbits(64)
+                partes = [("pre", -1), ("publico", 0)] + ([("mixto", 1)] if rnd.random() < 0.3 else [])
+                for sub, dh in partes:
+                    hh = min(max(h + dh, 6), 22)
+                    out.append(self._base(fecha, dtime(hh, m), actor, muni, lugar, evento, token, sub))
+            else:
+                out.append(self._base(fecha, dtime(h, m), actor, muni, lugar, evento))
+        return out[:n]
+
+    def asignar(self, inv, actor):
+        """Aplica estatus y devuelve las notificaciones (misma forma que _apply_assignment)."""
+        rnd = self.rnd
+        pasado = inv["fecha"] < self.hoy
+        estatus = rnd.choices(ESTATUS, MEZCLA_PASADO if pasado else MEZCLA_FUTURO)[0]
+        if estatus == "Pendiente":
+            return []
+
+        ts = min(inv["ultima_modificacion"] + timedelta(days=rnd.randrange(0, 3), minutes=rnd.randrange(600)),
+                 self.now - timedelta(minutes=5))
+        inv_ns = None   # snapshot de la invitación (se fija antes de cada snap)
+        notifs = []
+
+        def snap(campo, anterior, nuevo, persona_obj=None, actor_obj=None, estatus_snap=None, cambios=None, cuando=ts):
+            d = webapp.notif_snapshot(None, inv_ns, campo, anterior, nuevo, None,
+                                      persona_obj=persona_obj, actor_obj=actor_obj,
+                                      estatus_override=estatus_snap, cambios=cambios)
+            d["ts"] = cuando
+            # lo viejo ya lo mandó el bot; lo de las últimas horas sigue en cola
+            if cuando < self.now - timedelta(hours=6):
+                d["enviado"], d["enviado_ts"] = True, cuando + timedelta(seconds=rnd.randrange(5, 900))
+            notifs.append(d)
+
+        if estatus == "Cancelado":
+            inv.update(estatus="Cancelado", ultima_modificacion=ts)
+            inv_ns = SimpleNamespace(**inv)
+            snap("Estatus", "Pendiente", "Cancelado", actor_obj=self.a_ns[actor["id"]], estatus_snap="Cancelado")
+            return notifs
+
+        directo = rnd.random() < 0.1   # asignación directa al actor convocante
+        persona = None if directo else self._persona_para(inv["municipio"])
+        entrante = actor if directo else persona
+        prev = None
+        if estatus == "Sustituido" or rnd.random() < 0.08:
+            prev = self._persona_para(inv["municipio"])
+            if persona is not None and prev["id"] == persona["id"]:
+                prev = None
+
+        inv.update(
+            estatus=estatus, persona_id=(None if directo else persona["id"]),
+            asignado_a=entrante["nombre"], rol=entrante["cargo"],
+            fecha_asignacion=ts, ultima_modificacion=ts,
+        )
+        inv_ns = SimpleNamespace(**inv)
+        anterior = "Pendiente"
+        if prev is not None:
+            t0 = ts - timedelta(days=rnd.randrange(1, 5))
+            inv_ns.asignado_a, inv_ns.rol = prev["nombre"], prev["cargo"]
+            snap("Estatus", "Pendiente", "Confirmado", self.p_ns[prev["id"]], self.a_ns[actor["id"]],
+                 "Confirmado", cuando=t0)
+            inv_ns.asignado_a, inv_ns.rol = inv["asignado_a"], inv["rol"]
+            snap("Sustituido", prev["nombre"], entrante["nombre"], persona_obj=self.p_ns[prev["id"]],
+                 estatus_snap="Sustituido")
+            anterior = "Confirmado"
+
+        deltas = [("Asignado A", prev["nombre"] if prev else "", inv["asignado_a"]),
+                  ("Rol", prev["cargo"] if prev else "", inv["rol"]),
+                  ("Estatus", anterior, "Confirmado")]
+        snap_persona = None if directo else self.p_ns[persona["id"]]
+        if webapp.NOTIF_COALESCE:
+            snap("Estatus", anterior, "Confirmado", snap_persona, self.a_ns[actor["id"]], "Confirmado",
+                 cambios=[{"campo": c, "anterior": a or "", "nuevo": n or ""} for c, a, n in deltas])
+        else:
+            for campo, a, n in deltas:
+                snap(campo, a, n, snap_persona, self.a_ns[actor["id"]], "Confirmado")
+        return notifs
+
+def generar_invitaciones(gen, args):
+    actores = {a["id"]: a for a in gen.actores}
+    total_inv = total_notif = 0
+    t0 = time.perf_counter()
+    while total_inv < args.invitaciones:
+        invs = gen.invitaciones(min(args.lote, args.invitaciones - total_inv))
+        notifs = []
+        for inv in invs:
+            n = gen.asignar(inv, actores[inv["actor_id"]])
+            if not args.sin_notificaciones:
+                notifs.extend(n)
+        with engine.begin() as conn:
+            conn.execute(insert(Invitacion.__table__), invs)
+            _bulk(conn, Notificacion.__table__, notifs, args.lote)
+        total_inv += len(invs)
+        total_notif += len(notifs)
+        rate = total_inv / max(time.perf_counter() - t0, 1e-9)
+        print(f"  {total_inv:>9} invitaciones, {total_notif:>9} notificaciones ({rate:,.0f} inv/s)", file=sys.stderr)
+    return total_inv, total_notif
+
+def main(argv=None):
+    args = _args(argv)
+    rnd = random.Random(args.seed)
+    Base.metadata.create_all(engine)
+    add_missing_columns(engine)
+    with engine.connect() as conn:
+        existing = conn.execute(select(func.count(Invitacion.id))).scalar()
+    if existing and not args.force:
+        sys.exit(f"La BD ya tiene {existing} invitaciones; usa una BD desechable o --force")
+    print(f"Generando en {engine.url.render_as_string()}", file=sys.stderr)
+
+    t0 = time.perf_counter()
+    with engine.begin() as conn:
+        sexos = sembrar_catalogos(conn)
+        muni_region = generar_regiones(conn, rnd, args.regiones)
+        region_nombres = dict(conn.execute(select(Region.id, Region.nombre)).all())
+        personas = generar_personas(conn, rnd, args.personas, sexos, region_nombres, args.lote)
+        actores = generar_actores(conn, rnd, args.actores, sexos, args.lote)
+        _sync_sequences(conn, "regiones", "region_municipios", "personas", "actores")
+    print(f"{len(region_nombres)} regiones, {len(personas)} personas, {len(actores)} actores "
+          f"({time.perf_counter() - t0:.1f}s)", file=sys.stderr)
+
+    gen = Generador(rnd, args, personas, actores, muni_region)
+    n_inv, n_notif = generar_invitaciones(gen, args)
+
+    # índices, FTS/pg_trgm (rebuild en SQLite), vistas y colecciones_version
+    init_db.main()
+    db = SessionLocal()
+    try:
+        webapp.bump_colecciones(db, *COLECCIONES)
+        db.commit()
+    finally:
+        db.close()
+    print(f"OK: {n_inv} invitaciones y {n_notif} notificaciones en {time.perf_counter() - t0:.1f}s")
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,17 @@
 # init_db.py
-from db import Base, engine, SessionLocal, Sexo, Partido
+from db import (
+    Base, engine, SessionLocal, Sexo, Partido, ColeccionVersion, COLECCIONES,
+    add_missing_columns, backfill_busqueda, setup_search, setup_notif_views
+)
 
 def main():
     Base.metadata.create_all(engine)
+    for col in add_missing_columns(engine):
+        print(f"+ columna {col}")
+    # create_all no agrega índices nuevos a tablas que ya existían
+    for table in Base.metadata.sorted_tables:
+        for idx in table.indexes:
+            idx.create(engine, checkfirst=True)
     # siembra mínima (por si no está)
     db = SessionLocal()
     try:
@@ -12,7 +21,13 @@ def main():
         for p in ["MORENA","PAN","PRI","PRD","MC","PVEM","INDEPENDIENTE"]:
             if not db.query(Partido).filter_by(nombre=p).first():
                 db.add(Partido(nombre=p))
+        for c in COLECCIONES:
+            if not db.get(ColeccionVersion, c):
+                db.add(ColeccionVersion(nombre=c, version=0))
         db.commit()
+        n = backfill_busqueda(engine)
+        print(f"Búsqueda: {setup_search(engine)} ({n} filas indexadas)")
+        setup_notif_views(engine)
         print("OK: tablas listas y catálogos sembrados.")
     finally:
         db.close()
@@ -0,0 +1,374 @@
+# prueba_carga.py
+"""
+Prueba de carga de punta a punta contra la app (gunicorn) con una mezcla de operador:
+listados, polling, asignaciones, ediciones y exportación.
+
+Cada usuario virtual es un hilo con su propia conexión keep-alive: inicia sesión por
+/api/auth/login, guarda la cookie y repite la mezcla ponderada (los GET usan
+If-None-Match como el navegador). Al final reporta por endpoint p50/p95/p99, rps y
+tasa de error; la salida JSON (--out) se puede comparar entre versiones (--compare).
+
+Uso:
+  # BD sembrada + servidor local con los workers/threads del Procfile
+  DB_URL=sqlite:///carga.db python generar_datos.py --invitaciones 200000
+  DB_URL=sqlite:///carga.db python prueba_carga.py --servidor --crear-usuario --out carga.json
+
+  # contra un servidor ya levantado
+  python prueba_carga.py --url http://127.0.0.1:8000 --usuarios 32 --duracion 120
+  python prueba_carga.py --mix list=40,poll=40,assign=20 --compare carga.json --threshold 25
+"""
+import os
+import re
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+import threading
+import subprocess
+import http.client
+from datetime import datetime
+from pathlib import Path
+from urllib.parse import urlsplit, urlencode
+
+# nombre -> peso por defecto (ver OPERACIONES)
+MIX = {"list": 24, "search": 8, "poll": 30, "personas": 5, "actores": 3, "notif": 6,
+       "assign": 10, "update": 8, "export": 1}
+TERMS = ["toluca", "reunión", "plaza", "morena", "informe", "ecatepec"]
+
+def _procfile_defaults():
+    """--workers/--threads tal como los declara el Procfile (lo que corre en producción)."""
+    workers, threads = 2, 8
+    try:
+        txt = (Path(__file__).parent / "Procfile").read_text(encoding="utf-8")
+        workers = int(re.search(r"--workers\s+(\d+)", txt).group(1))
+        threads = int(re.search(r"--threads\s+(\d+)", txt).group(1))
+    except (OSError, AttributeError, ValueError):
+        pass
+    return workers, threads
+
+def _args():
+    workers, threads = _procfile_defaults()
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--url", default="http://127.0.0.1:8000")
+    ap.add_argument("--usuario", default=os.getenv("CARGA_USUARIO", "carga"))
+    ap.add_argument("--password", default=os.getenv("CARGA_PASSWORD", "carga"))
+    ap.add_argument("--usuarios", type=int, default=16, help="usuarios virtuales concurrentes")
+    ap.add_argument("--duracion", type=float, default=60, help="segundos de medición")
+    ap.add_argument("--calentamiento", type=float, default=5, help="segundos sin medir al inicio")
+    ap.add_argument("--pausa", type=float, default=0.0, help="segundos de 'think time' entre peticiones")
+    ap.add_argument("--mix", default="", help="pesos, p.ej. list=30,poll=30,assign=10 (los omitidos = 0)")
+    ap.add_argument("--seed", type=int, default=7)
+    ap.add_argument("--servidor", action="store_true", help="levanta gunicorn local con DB_URL del entorno")
+    ap.add_argument("--workers", type=int, default=workers)
+    ap.add_argument("--threads", type=int, default=threads)
+    ap.add_argument("--crear-usuario", action="store_true", help="crea el usuario admin de carga en DB_URL")
+    ap.add_argument("--out", metavar="JSON", help="guardar resultados")
+    ap.add_argument("--compare", metavar="JSON", help="comparar p95/rps contra una corrida previa")
+    ap.add_argument("--threshold", type=float, default=20.0, help="%% de empeoramiento de p95 permitido")
+    return ap.parse_args()
+
+# ----------------- cliente -----------------
+class Cliente:
+    """Conexión keep-alive con cookie de sesión y caché de ETags por ruta."""
+
+    def __init__(self, url, timeout=120):
+        u = urlsplit(url)
+        self.host, self.port = u.hostname, u.port or 80
+        self.timeout = timeout
+        self.conn = None
+        self.cookie = None
+        self.etags = {}
+
+    def request(self, method, path, body=None, ctype=None):
+        headers = {"Accept": "application/json"}
+        if self.cookie:
+            headers["Cookie"] = self.cookie
+        if ctype:
+            headers["Content-Type"] = ctype
+        if method == "GET" and path in self.etags:
+            headers["If-None-Match"] = self.etags[path]
+        for intento in (1, 2):
+            if self.conn is None:
+                self.conn = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+            try:
+                self.conn.request(method, path, body=body, headers=headers)
+                resp = self.conn.getresponse()
+                data = resp.read()
+                break
+            except (http.client.HTTPException, ConnectionError):
+                # el servidor cerró la conexión keep-alive: reintenta una vez en limpio
+                self.conn.close()
+                self.conn = None
+                if intento == 2:
+                    raise
+        if method == "GET" and resp.getheader("ETag"):
+            self.etags[path] = resp.getheader("ETag")
+        cookie = resp.getheader("Set-Cookie")
+        if cookie:
+            self.cookie = cookie.split(";", 1)[0]
+        return resp.status, data
+
+    def json(self, method, path, payload=None):
+        body = json.dumps(payload).encode() if payload is not None else None
+        return self.request(method, path, body, "application/json" if body else None)
+
+    def form(self, path, fields):
+        return self.request("POST", path, urlencode(fields).encode(), "application/x-www-form-urlencoded")
+
+    def login(self, usuario, password):
+        status, data = self.json("POST", "/api/auth/login", {"usuario": usuario, "password": password})
+        if status != 200:
+            raise SystemExit(f"Login falló ({status}): {data[:200]!r}")
+        return status
+
+# ----------------- operaciones -----------------
+class Datos:
+    """Ids reales para asignar/editar (se leen una vez al inicio)."""
+
+    def __init__(self, cli):
+        status, data = cli.json("GET", "/api/invitations?limit=500")
+        items = json.loads(data).get("items", []) if status == 200 else []
+        self.invitaciones = [i.get("ID") or i.get("id") for i in items if i.get("ID") or i.get("id")]
+        status, data = cli.json("GET", "/api/personas")
+        personas = json.loads(data) if status == 200 else []
+        if isinstance(personas, dict):
+            personas = personas.get("items") or personas.get("personas") or []
+        self.personas = [p.get("ID") or p.get("id") for p in personas if p.get("ID") or p.get("id")]
+        if not self.invitaciones or not self.personas:
+            raise SystemExit("La BD no tiene invitaciones/personas: siembra con generar_datos.py")
+
+def op_list(cli, rnd, datos, st):
+    return cli.json("GET", "/api/invitations?limit=50")[0]
+
+def op_search(cli, rnd, datos, st):
+    return cli.json("GET", "/api/invitations?" + urlencode({"q": rnd.choice(TERMS), "limit": 50}))[0]
+
+def op_poll(cli, rnd, datos, st):
+    qs = "?" + urlencode({"since": st["since"]}) if st.get("since") else ""
+    status, data = cli.json("GET", "/api/invitaciones/updates" + qs)
+    if status == 200:
+        st["since"] = json.loads(data).get("now")
+    return status
+
+def op_personas(cli, rnd, datos, st):
+    return cli.json("GET", "/api/personas")[0]
+
+def op_actores(cli, rnd, datos, st):
+    return cli.json("GET", "/api/actores")[0]
+
+def op_notif(cli, rnd, datos, st):
+    return cli.json("GET", f"/api/notificaciones/{rnd.choice(datos.invitaciones)}")[0]
+
+def op_assign(cli, rnd, datos, st):
+    payload = {"id": rnd.choice(datos.invitaciones), "persona_id": rnd.choice(datos.personas),
+               "comentario": "prueba de carga", "force": True}
+    return cli.json("POST", "/api/assign", payload)[0]
+
+def op_update(cli, rnd, datos, st):
+    fields = {"id": rnd.choice(datos.invitaciones), "observaciones": f"carga {rnd.randrange(10 ** 6)}"}
+    return cli.form("/api/invitation/update", fields)[0]
+
+def op_export(cli, rnd, datos, st):
+    return cli.request("GET", "/api/report/confirmados.xlsx")[0]
+
+OPERACIONES = {"list": op_list, "search": op_search, "poll": op_poll, "personas": op_personas,
+               "actores": op_actores, "notif": op_notif, "assign": op_assign, "update": op_update,
+               "export": op_export}
+
+# ----------------- ejecución -----------------
+def _mix(txt):
+    if not txt:
+        return dict(MIX)
+    out = {k: 0 for k in MIX}
+    for part in txt.split(","):
+        k, _, v = part.partition("=")
+        if k.strip() not in OPERACIONES:
+            raise SystemExit(f"Operación desconocida en --mix: {k!r} (opciones: {', '.join(OPERACIONES)})")
+        out[k.strip()] = float(v or 1)
+    return out
+
+def _usuario_virtual(k, args, datos, mix, t_ini, t_fin, muestras, lock):
+    rnd = random.Random(args.seed * 1000 + k)
+    cli = Cliente(args.url)
+    t0 = time.perf_counter()
+    cli.login(args.usuario, args.password)
+    local = [("login", time.perf_counter() - t0, 200, time.monotonic())]
+    nombres, pesos = zip(*[(n, w) for n, w in mix.items() if w > 0])
+    st = {}
+    while time.monotonic() < t_fin:
+        op = rnd.choices(nombres, pesos)[0]
+        t0 = time.perf_counter()
+        try:
+            status = OPERACIONES[op](cli, rnd, datos, st)
+        except Exception as e:   # timeout/conexión: cuenta como error
+            status = f"{type(e).__name__}"
+        local.append((op, time.perf_counter() - t0, status, time.monotonic()))
+        if args.pausa:
+            time.sleep(rnd.expovariate(1 / args.pausa))
+    with lock:
+        muestras.extend(s for s in local if s[0] == "login" or s[3] >= t_ini)
+
+def _pct(sorted_vals, p):
+    if not sorted_vals:
+        return None
+    k = min(len(sorted_vals) - 1, max(0, int(round(p / 100 * len(sorted_vals) + 0.5)) - 1))
+    return sorted_vals[k]
+
+def _resumen(muestras, ventana):
+    por_op = {}
+    for op, dt, status, _ in muestras:
+        por_op.setdefault(op, []).append((dt, status))
+    out = {}
+    for op, vals in sorted(por_op.items()):
+        lat = sorted(dt * 1000 for dt, _ in vals)
+        errores = sum(1 for _, s in vals if not (isinstance(s, int) and s < 400))
+        out[op] = {
+            "count": len(vals),
+            "errors": errores,
+            "error_rate": round(errores / len(vals), 4),
+            "rps": round(len(vals) / ventana, 2) if op != "login" else None,
+            "p50_ms": round(_pct(lat, 50), 2),
+            "p95_ms": round(_pct(lat, 95), 2),
+            "p99_ms": round(_pct(lat, 99), 2),
+            "max_ms": round(lat[-1], 2),
+            "mean_ms": round(sum(lat) / len(lat), 2),
+            "status": _conteo_status(vals),
+        }
+    medidas = [(dt, s) for op, dt, s, _ in muestras if op != "login"]
+    lat = sorted(dt * 1000 for dt, _ in medidas)
+    errores = sum(1 for _, s in medidas if not (isinstance(s, int) and s < 400))
+    total = {"count": len(medidas), "errors": errores,
+             "error_rate": round(errores / len(medidas), 4) if medidas else 0,
+             "rps": round(len(medidas) / ventana, 2),
+             "p50_ms": _round(_pct(lat, 50)), "p95_ms": _round(_pct(lat, 95)), "p99_ms": _round(_pct(lat, 99))}
+    return out, total
+
+def _round(v):
+    return round(v, 2) if v is not None else None
+
+def _conteo_status(vals):
+    out = {}
+    for _, s in vals:
+        out[str(s)] = out.get(str(s), 0) + 1
+    return out
+
+def _esperar_salud(url, timeout=60):
+    t_fin = time.monotonic() + timeout
+    while time.monotonic() < t_fin:
+        try:
+            if Cliente(url, timeout=2).request("GET", "/api/health")[0] == 200:
+                return
+        except OSError:
+            pass
+        time.sleep(0.3)
+    raise SystemExit(f"El servidor no respondió en {url} tras {timeout}s")
+
+def _levantar_servidor(args):
+    u = urlsplit(args.url)
+    cmd = [sys.executable, "-m", "gunicorn", "app:app", "--workers", str(args.workers),
+           "--threads", str(args.threads), "--timeout", "120",
+           "--bind", f"{u.hostname}:{u.port or 80}", "--log-level", "warning"]
+    print(f"Servidor: {' '.join(cmd[2:])}", file=sys.stderr)
+    proc = subprocess.Popen(cmd, cwd=Path(__file__).parent)
+    try:
+        _esperar_salud(args.url)
+    except SystemExit:
+        proc.terminate()
+        raise
+    return proc
+
+def _crear_usuario(args):
+    from passlib.hash import bcrypt
+    from db import Base, engine, SessionLocal, Usuario
+    Base.metadata.create_all(engine)
+    db = SessionLocal()
+    try:
+        u = db.query(Usuario).filter(Usuario.usuario == args.usuario).first()
+        if u is None:
+            db.add(Usuario(usuario=args.usuario, pwd_hash=bcrypt.hash(args.password), rol="admin", activo=True))
+        else:
+            u.pwd_hash, u.rol, u.activo = bcrypt.hash(args.password), "admin", True
+        db.commit()
+    finally:
+        db.close()
+
+def _comparar(actual, previo, threshold):
+    """Imprime Δ p95 y Δ rps por endpoint; regresa los endpoints cuyo p95 empeoró más del umbral."""
+    regresiones = []
+    print(f"{'endpoint':<10} {'p95 antes':>10} {'p95 ahora':>10} {'Δ p95':>8} {'rps antes':>10} {'rps ahora':>10}")
+    print("-" * 63)
+    for op, r in actual["endpoints"].items():
+        b = previo.get("endpoints", {}).get(op)
+        if not b:
+            continue
+        d = (r["p95_ms"] - b["p95_ms"]) / b["p95_ms"] * 100 if b["p95_ms"] else 0.0
+        mark = ""
+        if op != "login" and d > threshold:
+            regresiones.append(op)
+            mark = "  ← regresión"
+        print(f"{op:<10} {b['p95_ms']:>10} {r['p95_ms']:>10} {d:>+7.1f}% "
+              f"{b.get('rps') or '-':>10} {r.get('rps') or '-':>10}{mark}")
+    return regresiones
+
+def main():
+    args = _args()
+    mix = _mix(args.mix)
+    if args.crear_usuario:
+        _crear_usuario(args)
+    proc = _levantar_servidor(args) if args.servidor else None
+    try:
+        admin = Cliente(args.url)
+        admin.login(args.usuario, args.password)
+        datos = Datos(admin)
+
+        muestras, lock = [], threading.Lock()
+        t_ini = time.monotonic() + args.calentamiento
+        t_fin = t_ini + args.duracion
+        hilos = [threading.Thread(target=_usuario_virtual, daemon=True,
+                                  args=(k, args, datos, mix, t_ini, t_fin, muestras, lock))
+                 for k in range(args.usuarios)]
+        print(f"{args.usuarios} usuarios, {args.calentamiento:g}s calentamiento + {args.duracion:g}s contra "
+              f"{args.url}", file=sys.stderr)
+        for h in hilos:
+            h.start()
+        for h in hilos:
+            h.join()
+    finally:
+        if proc is not None:
+            proc.terminate()
+            proc.wait(timeout=30)
+
+    endpoints, total = _resumen(muestras, args.duracion)
+    resultado = {
+        "meta": {"url": args.url, "usuarios": args.usuarios, "duracion_s": args.duracion,
+                 "pausa_s": args.pausa, "mix": mix, "workers": args.workers if args.servidor else None,
+                 "threads": args.threads if args.servidor else None, "python": platform.python_version(),
+                 "ts": datetime.utcnow().isoformat(timespec="seconds")},
+        "total": total,
+        "endpoints": endpoints,
+    }
+    if args.out:
+        Path(args.out).write_text(json.dumps(resultado, ensure_ascii=False, indent=2), encoding="utf-8")
+        print(f"Resultados en {args.out}", file=sys.stderr)
+
+    if args.compare:
+        previo = json.loads(Path(args.compare).read_text(encoding="utf-8"))
+        regresiones = _comparar(resultado, previo, args.threshold)
+        if regresiones:
+            print(f"p95 empeoró más de {args.threshold}% en: {', '.join(regresiones)}", file=sys.stderr)
+            sys.exit(1)
+        return
+    if not args.out:
+        print(json.dumps(resultado, ensure_ascii=False, indent=2))
+        return
+    hdr = f"{'endpoint':<10} {'n':>7} {'rps':>8} {'p50':>8} {'p95':>8} {'p99':>8} {'err %':>7}"
+    print(hdr)
+    print("-" * len(hdr))
+    for op, r in {**endpoints, "TOTAL": total}.items():
+        print(f"{op:<10} {r['count']:>7} {r['rps'] or '-':>8} {r['p50_ms']:>8} {r['p95_ms']:>8} "
+              f"{r['p99_ms']:>8} {r['error_rate'] * 100:>6.2f}")
+
+if __name__ == "__main__":
+    main()
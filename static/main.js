@@ -21,6 +21,12 @@ let LAST_GROUP_TOKEN = '';
 const $  = (sel) => document.querySelector(sel);
 const $$ = (sel) => Array.from(document.querySelectorAll(sel));
 
+// URL del adjunto por ID; con ?v=<sha256> el servidor deja cachearla (cambia si se reemplaza)
+function archivoUrl(inv) {
+  const base = `/api/invitation/${encodeURIComponent(inv.ID)}/archivo`;
+  return inv.ArchivoSHA256 ? `${base}?v=${encodeURIComponent(inv.ArchivoSHA256)}` : base;
+}
+
 const coloresPartidos = {
   'MORENA':'#831E30','PAN':'#0056a4','PRI':'#FF0000','PRD':'#ffcf00',
   'PT':'#F8AE42','PVEM':'#78be20','MC':'#f58025','INDEPENDIENTE':'#888','OTRO':'#666'
@@ -237,17 +243,27 @@ document.addEventListener('DOMContentLoaded', () => {
 document.addEventListener('shown.bs.modal', (e) => {
   applyRoleUI();
 });
-// ===== Fetch helpers (no cache) =====
+// ===== Fetch helpers (no cache del navegador; revalidación propia por ETag) =====
+const ETAG_CACHE = new Map();   // url sin _ts -> { etag, text }
 async function fetchJSON(url, opts = {}) {
   const u = new URL(url, window.location.origin);
+  const key = u.toString();
+  const isGet = !opts.method || opts.method.toUpperCase() === 'GET';
+  const prev = isGet ? ETAG_CACHE.get(key) : null;
+  const headers = { ...(opts.headers || {}) };
+  if (prev) headers['If-None-Match'] = prev.etag;
   u.searchParams.set('_ts', Date.now()); // cache-buster
-  const res = await fetch(u, { cache: 'no-store', credentials: 'same-origin', ...opts });
+  const res = await fetch(u, { cache: 'no-store', credentials: 'same-origin', ...opts, headers });
+  if (res.status === 304 && prev) return JSON.parse(prev.text); // sin cambios en el servidor
   if (!res.ok) {
     let msg = `${res.status} ${res.statusText}`;
     try { const j = await res.json(); if (j && j.error) msg = j.error; } catch {}
     throw new Error(msg);
   }
-  return res.json();
+  const text = await res.text();
+  const etag = res.headers.get('ETag');
+  if (isGet && etag) ETAG_CACHE.set(key, { etag, text });
+  return JSON.parse(text);
 }
 const apiGet  = (url) => fetchJSON(url);
 const apiPost = (url, body={}) => fetchJSON(url, {
@@ -574,7 +590,7 @@ function renderListInto(list, sel){
     const lugar        = safe(x.Lugar || '');
     const archivoHTML = x.ArchivoNombre ? `
     <a class="btn btn-sm btn-outline-secondary p-1"
-      href="/api/invitation/${encodeURIComponent(x.ID)}/archivo"
+      href="${archivoUrl(x)}"
       target="_blank" rel="noopener"
       title="Ver archivo adjunto">
       <i class="bi bi-paperclip"></i>
@@ -3010,7 +3026,10 @@ function showDetails(inv){
   // ===== Archivo: SIEMPRE usa tu endpoint por ID (sirve local o redirige) =====
   // Mostramos bloque si hay metadata (nombre/url guardados)
   const hasFile  = !!(inv.ArchivoNombre || inv.ArchivoURL);
-  const fileUrl  = `/api/invitation/${encodeURIComponent(inv.ID)}/archivo`;
+  const fileUrl  = archivoUrl(inv);
+  // Vista previa chica (1a página del PDF / imagen reducida); si no hay, se usa el original
+  const previewUrl = `/api/invitation/${encodeURIComponent(inv.ID)}/preview`
+    + (inv.ArchivoSHA256 ? `?v=${encodeURIComponent(inv.ArchivoSHA256)}` : '');
   const fileName = inv.ArchivoNombre || 'Archivo adjunto';
   const mime     = (inv.ArchivoMime || '').toLowerCase();
   const ext      = (inv.ArchivoNombre || '').split('.').pop().toLowerCase();
@@ -3028,14 +3047,12 @@ function showDetails(inv){
             <i class="bi bi-box-arrow-up-right"></i> Abrir
           </a>
         </div>
-        ${isImage ? `
-          <div class="mt-3">
-            <img src="${fileUrl}" alt="${safe(fileName)}" class="img-fluid rounded border">
-          </div>` : ''
-        }
-        ${isPDF ? `
-          <div class="mt-3">
-            <embed src="${fileUrl}" type="application/pdf" width="100%" height="420px" class="rounded border"/>
+        ${(isImage || isPDF) ? `
+          <div class="mt-3 inv-preview">
+            <a href="${fileUrl}" target="_blank" rel="noopener" title="Abrir archivo">
+              <img src="${previewUrl}" alt="${safe(fileName)}" loading="lazy" class="img-fluid rounded border"
+                   onerror="this.onerror=null; ${isImage ? `this.src='${fileUrl}'` : `this.closest('.inv-preview').remove()`}">
+            </a>
           </div>` : ''
         }
       </div>
@@ -3327,6 +3344,11 @@ const MUNICIPIOS =
 
 // Helpers: cargar catálogo para el selector
 async function loadPersonasForPanel(q = '') {
+  // Con texto: índice typeahead del servidor (sólo los mejores resultados)
+  if (q) {
+    const r = await apiGet('/api/typeahead?tipo=personas&limit=50&q=' + encodeURIComponent(q));
+    return r.items || [];
+  }
   const params = new URLSearchParams();
   if (q) params.set('q', q);
   params.set('limit', '300');     // ajusta si quieres
@@ -3419,9 +3441,31 @@ async function pollInvitaciones() {
   }
 }
 
+// ===== Push por SSE; el polling queda sólo como respaldo =====
+let pollTimer = null;
+let pollDebounce = null;
+function startPolling(){ if (!pollTimer) pollTimer = setInterval(pollInvitaciones, 15000); }
+function stopPolling(){ if (pollTimer) { clearInterval(pollTimer); pollTimer = null; } }
+function schedulePoll(){ clearTimeout(pollDebounce); pollDebounce = setTimeout(pollInvitaciones, 300); }
+
+function startInvStream(){
+  if (!window.EventSource) { startPolling(); return; }
+  const es = new EventSource('/api/invitaciones/stream', { withCredentials: true });
+  es.addEventListener('open', () => { stopPolling(); schedulePoll(); }); // recupera lo perdido mientras no hubo stream
+  es.addEventListener('invitacion', (ev) => {
+    let data = {};
+    try { data = JSON.parse(ev.data); } catch {}
+    // un borrado no aparece en /updates: recarga (barata gracias al ETag)
+    if (data.tipo === 'deleted') window.reloadUI?.(); else schedulePoll();
+  });
+  es.addEventListener('reset', () => { window.reloadUI?.(); schedulePoll(); });
+  // EventSource reintenta solo; si el servidor respondió 503 (cupo) queda CLOSED → polling
+  es.addEventListener('error', () => { startPolling(); });
+}
+
 // Inicia: primera corrida “full” (sin since)
 pollInvitaciones();
-setInterval(pollInvitaciones, 15000); // cada 15s (ajusta si quieres)
+startInvStream();
 
 function renderGroupModal(grupoToken) {
   const modalEl = document.getElementById('modalGrupo');